@@ -0,0 +1,20 @@
+"""Application configuration, for Django 1.7 and later."""
+
+from __future__ import unicode_literals
+
+from django.apps import AppConfig
+from django.core.files.storage import default_storage
+
+from .settings import get_setting
+
+
+class RestoConfig(AppConfig):
+
+    name = 'django_resto'
+    verbose_name = 'django-resto'
+
+    def ready(self):
+        # Instantiating the default storage opens connections to the media
+        # servers, if it's a django-resto storage, before the first request.
+        if get_setting('PREWARM'):
+            getattr(default_storage, 'hosts', None)
@@ -0,0 +1,362 @@
+"""Adaptive limits on the number of concurrent requests to each media server,
+with priority lanes, a budget for the memory used by request bodies, a helper
+to run requests concurrently, and coalescing of identical requests.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import contextlib
+import itertools
+import socket
+import threading
+import time
+try:                                                        # cover: disable
+    import http.client as httplib
+    from urllib.request import HTTPError, URLError
+except ImportError:
+    import httplib
+    from urllib2 import HTTPError, URLError
+
+from .settings import get_setting
+
+
+# Priorities of operations, from the highest to the lowest. They're set with
+# http_client.operation(priority=...).
+
+INTERACTIVE = 'interactive'
+NORMAL = 'normal'
+BULK = 'bulk'
+
+LANES = (INTERACTIVE, NORMAL, BULK)
+
+
+def is_overload(exc):
+    """Tell if an exception shows that a host is overloaded.
+
+    Timeouts, connection errors, invalid responses and 5xx status codes count,
+    other HTTP errors don't: they're the host's answer to a request it had
+    time to process.
+    """
+    if isinstance(exc, HTTPError):
+        return exc.code >= 500
+    return isinstance(exc, (URLError, socket.error, httplib.HTTPException))
+
+
+class HostLimiter(object):
+
+    """Limit the number of concurrent requests to a host.
+
+    The limit adapts with an AIMD controller: it increases by one every time
+    `limit` requests complete within RESTO_LATENCY_TARGET seconds, and it's
+    halved whenever a request fails because the host is overloaded. It stays
+    between 1 and max_limit.
+
+    Requests waiting for the host are served by priority, then in order of
+    arrival. Bulk requests take at most RESTO_BULK_SHARE of the limit, so
+    other requests find room quickly. A request moves up one lane every
+    `aging` seconds it waits, so lower lanes aren't starved.
+    """
+
+    latency_target = get_setting('LATENCY_TARGET')
+    bulk_share = get_setting('BULK_SHARE')
+
+    aging = 1.0
+
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max(1, max_limit // 2))
+        self.in_flight = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # queue holds a (start, lane index, ticket) tuple for each waiting
+        # request.
+        self.queue = []
+        self.tickets = itertools.count()
+        self.lanes = dict((lane, dict(in_flight=0, waiting=0, acquired=0,
+                total_wait=0.0, max_wait=0.0)) for lane in LANES)
+        self.condition = threading.Condition()
+
+    def acquire(self, priority=NORMAL):
+        """Wait until a request with the given priority can be sent."""
+        start = time.time()
+        lane = self.lanes[priority]
+        with self.condition:
+            waiter = (start, LANES.index(priority), next(self.tickets))
+            self.waiting += 1
+            lane['waiting'] += 1
+            self.queue.append(waiter)
+            while self._next() != waiter:
+                self.condition.wait()
+            self.queue.remove(waiter)
+            self.waiting -= 1
+            lane['waiting'] -= 1
+            self.in_flight += 1
+            lane['in_flight'] += 1
+            wait = time.time() - start
+            self.acquired += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            lane['acquired'] += 1
+            lane['total_wait'] += wait
+            lane['max_wait'] = max(lane['max_wait'], wait)
+            # Let the next request through if there's room for it.
+            self.condition.notify_all()
+
+    def _next(self):
+        # Return the waiter to serve next, or None if none can be served.
+        if self.in_flight >= int(self.limit):
+            return None
+        now = time.time()
+        bulk_limit = max(1, int(self.limit * self.bulk_share))
+        bulk_full = self.lanes[BULK]['in_flight'] >= bulk_limit
+        bulk = LANES.index(BULK)
+        waiters = [(max(0, index - int((now - start) / self.aging)), ticket,
+                (start, index, ticket)) for start, index, ticket in self.queue
+                if not (bulk_full and index == bulk)]
+        if waiters:
+            return min(waiters)[2]
+
+    def release(self, latency, overloaded=False, priority=NORMAL):
+        """Record the outcome of a request and let another one through."""
+        with self.condition:
+            self.in_flight -= 1
+            self.lanes[priority]['in_flight'] -= 1
+            if overloaded:
+                self.limit = max(1.0, self.limit / 2)
+            elif latency <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority=NORMAL):
+        """Context manager that runs a request within the limit."""
+        self.acquire(priority)
+        start = time.time()
+        overloaded = False
+        try:
+            yield
+        except Exception as exc:
+            overloaded = is_overload(exc)
+            raise
+        finally:
+            self.release(time.time() - start, overloaded, priority)
+
+    def stats(self):
+        """Return the current limit and statistics on queueing delay.
+
+        'lanes' maps each priority to the same statistics for its requests.
+        """
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'acquired': self.acquired,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+                'lanes': dict((lane, dict(stats))
+                        for lane, stats in self.lanes.items()),
+            }
+
+
+# Limiters are shared by all storages of a process, because they protect the
+# media servers rather than the storages.
+
+_limiters = {}
+
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host, max_limit):
+    """Return the limiter for a host, creating it if necessary."""
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(max_limit)
+        return _limiters[host]
+
+
+def get_stats():
+    """Return the statistics of the limiters of all hosts."""
+    with _limiters_lock:
+        limiters = list(_limiters.items())
+    return dict((host, limiter.stats()) for host, limiter in limiters)
+
+
+class ByteBudget(object):
+
+    """Limit the number of bytes of request bodies held in memory.
+
+    When the limit is reached, callers wait until enough memory is released,
+    or until a timeout expires. Then they must avoid buffering the body, for
+    instance by spilling it to a temporary file. A body larger than the limit
+    is never admitted. A limit of None admits all bodies.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.refused = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, size, timeout=None):
+        """Reserve memory for a body of the given size.
+
+        Return True if the memory is reserved, False if the timeout expired.
+        """
+        start = time.time()
+        with self.condition:
+            self.waiting += 1
+            try:
+                while not self._fits(size):
+                    remaining = None
+                    if timeout is not None:
+                        remaining = start + timeout - time.time()
+                    if (self.limit is not None and size > self.limit or
+                            remaining is not None and remaining <= 0):
+                        self.refused += 1
+                        return False
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+                wait = time.time() - start
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            self.in_use += size
+            self.acquired += 1
+            return True
+
+    def _fits(self, size):
+        return self.limit is None or self.in_use + size <= self.limit
+
+    def release(self, size):
+        """Release memory reserved with acquire()."""
+        with self.condition:
+            self.in_use -= size
+            self.condition.notify_all()
+
+    def stats(self):
+        """Return the memory in use and statistics on waiting."""
+        with self.condition:
+            return {
+                'limit': self.limit,
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'acquired': self.acquired,
+                'refused': self.refused,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+            }
+
+
+# The budget is shared by all storages of a process, because it protects the
+# memory of the process.
+
+_budget = None
+
+_budget_lock = threading.Lock()
+
+
+def get_budget():
+    """Return the byte budget of the process, see RESTO_MAX_INFLIGHT_BYTES."""
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = ByteBudget(get_setting('MAX_INFLIGHT_BYTES'))
+        return _budget
+
+
+def map_in_threads(func, items, max_threads):
+    """Call func on each item, in up to max_threads threads.
+
+    Return a (results, errors) tuple of dicts mapping each item to the return
+    value of func or to the exception it raised.
+    """
+    items = list(items)
+    results, errors = {}, {}
+    lock = threading.Lock()
+    iterator = iter(items)
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            try:
+                results[item] = func(item)
+            except Exception as exc:
+                errors[item] = exc
+
+    threads = [threading.Thread(target=worker)
+            for _ in range(min(max_threads, len(items)) - 1)]
+    for thread in threads:
+        thread.start()
+    worker()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class SingleFlight(object):
+
+    """Share the result of identical calls that run concurrently.
+
+    Calls are identified by an operation and a name. While a call is in
+    progress, identical calls wait for it and get its return value, or raise
+    its exception, instead of running.
+    """
+
+    def __init__(self):
+        # calls maps names to dicts mapping operations to calls in progress.
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, operation, name, func, *args, **kwargs):
+        """Call func, unless an identical call is in progress."""
+        with self.lock:
+            calls = self.calls.setdefault(name, {})
+            call = calls.get(operation)
+            leader = call is None
+            if leader:
+                call = calls[operation] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self.lock:
+                calls = self.calls.get(name, {})
+                if calls.get(operation) is call:
+                    del calls[operation]
+                    if not calls:
+                        del self.calls[name]
+            call.done.set()
+        return call.result
+
+    def forget(self, name):
+        """Don't share the calls in progress for a name with later calls."""
+        with self.lock:
+            self.calls.pop(name, None)
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
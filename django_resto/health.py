@@ -0,0 +1,192 @@
+"""Background probes of the health of media servers, for host selection and
+the host_status view.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import logging
+import os
+import threading
+import time
+
+from .concurrency import map_in_threads
+
+
+logger = logging.getLogger(__name__)
+
+
+class HostStatus(object):
+
+    """Results of the recent probes of a host."""
+
+    # Number of recent probes used to compute the error rate.
+    window = 10
+
+    # Number of consecutive probes that must fail before a host is unhealthy,
+    # so a single lost request doesn't take it out of rotation.
+    failures_to_unhealthy = 2
+
+    def __init__(self):
+        self.latency = None
+        self.last_success = None
+        self.last_failure = None
+        self.error = None
+        self.failures = 0
+        self.results = collections.deque(maxlen=self.window)
+
+    @property
+    def healthy(self):
+        # A host is healthy until several probes fail in a row, and again
+        # once a probe succeeds.
+        return self.failures < self.failures_to_unhealthy
+
+    @property
+    def error_rate(self):
+        if self.results:
+            return 1 - sum(self.results) / float(len(self.results))
+
+    def record(self, latency, exc=None):
+        if exc is None:
+            self.latency = latency
+            self.last_success = time.time()
+            self.error = None
+            self.failures = 0
+        else:
+            self.last_failure = time.time()
+            self.error = '%s' % exc
+            self.failures += 1
+        self.results.append(exc is None)
+
+    def to_dict(self):
+        return {
+            'healthy': self.healthy,
+            'failures': self.failures,
+            'latency': self.latency,
+            'last_success': self.last_success,
+            'last_failure': self.last_failure,
+            'error_rate': self.error_rate,
+            'error': self.error,
+        }
+
+
+class Prober(object):
+
+    """Probe media servers with HEAD requests on a canary path.
+
+    A host is healthy when it answers, whether the canary file exists or
+    not. Once started, probes run every `interval` seconds in a background
+    thread. Probes of all hosts run concurrently.
+    """
+
+    def __init__(self, hosts, transport, path, interval=None):
+        self.hosts = list(hosts)
+        self.transport = transport
+        self.path = path
+        self.interval = interval
+        self.statuses = dict((host, HostStatus()) for host in self.hosts)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def probe(self):
+        """Probe all hosts once and update their status."""
+        map_in_threads(self.probe_host, self.hosts, len(self.hosts))
+
+    def probe_host(self, host):
+        start = time.time()
+        try:
+            self.transport.exists(host, self.path)
+        except Exception as exc:
+            with self.lock:
+                was_healthy = self.statuses[host].healthy
+                self.statuses[host].record(None, exc)
+                healthy = self.statuses[host].healthy
+            if was_healthy and not healthy:
+                logger.warning("Media server %s is unhealthy: %s.", host, exc)
+        else:
+            with self.lock:
+                was_healthy = self.statuses[host].healthy
+                self.statuses[host].record(time.time() - start)
+            if not was_healthy:
+                logger.warning("Media server %s is healthy again.", host)
+
+    def start(self):
+        """Start probing in the background."""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.probe()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop probing, after the current probe."""
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def is_healthy(self, host):
+        """Tell if a host is healthy. Unknown hosts are healthy."""
+        with self.lock:
+            status = self.statuses.get(host)
+            return status is None or status.healthy
+
+    def status(self):
+        """Return a dict mapping each host to a dict describing its status.
+
+        The status of a host contains 'healthy', the number of consecutive
+        'failures', 'latency' of the last successful probe in seconds,
+        timestamps of the 'last_success' and the 'last_failure', 'error_rate'
+        over recent probes and the last 'error'. Values are None until they're
+        known.
+        """
+        with self.lock:
+            return dict((host, status.to_dict())
+                    for host, status in self.statuses.items())
+
+
+### Probers of the process
+
+_probers = {}
+
+_probers_lock = threading.Lock()
+
+_probers_pid = os.getpid()
+
+
+def get_prober(hosts, transport, path, interval):
+    """Return the prober for a list of hosts, creating it if necessary.
+
+    If interval isn't None, the prober runs in the background.
+    """
+    global _probers_pid
+    key = tuple(hosts), path
+    with _probers_lock:
+        # Threads of probers don't survive in child processes.
+        if _probers_pid != os.getpid():
+            _probers.clear()
+            _probers_pid = os.getpid()
+        if key not in _probers:
+            _probers[key] = Prober(hosts, transport, path, interval)
+            if interval is not None:
+                _probers[key].start()
+        return _probers[key]
+
+
+def clear_probers():
+    """Stop and forget all probers."""
+    with _probers_lock:
+        for prober in _probers.values():
+            if prober.running:
+                prober.stop()
+        _probers.clear()
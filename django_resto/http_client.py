@@ -0,0 +1,517 @@
+"""HTTP client for DefaultTransport.
+
+Unlike urlopen, it has separate budgets for connecting, sending the request
+and waiting for the response, and it honours the deadline of the operation in
+progress in the current thread. It also records the latency of each host,
+keeps idle connections open for reuse, when servers allow it, caches the
+addresses of hosts, and times the phases of requests in spans.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import contextlib
+import errno
+import os
+import select
+import socket
+import threading
+import time
+try:                                                        # cover: disable
+    import http.client as httplib
+    from urllib.parse import urlsplit
+    from urllib.request import HTTPError, URLError
+except ImportError:
+    import httplib
+    from urlparse import urlsplit
+    from urllib2 import HTTPError, URLError
+
+from . import tracing
+from .concurrency import LANES, NORMAL
+from .settings import get_setting
+
+
+# Size of the blocks of the request body passed to the socket.
+BLOCK_SIZE = 64 * 1024
+
+
+class HTTPResponse(httplib.HTTPResponse):
+
+    # Keep a reference to the socket, in order to adjust its timeout once the
+    # length of the body is known, even though the connection is closed.
+
+    def __init__(self, sock, *args, **kwargs):
+        httplib.HTTPResponse.__init__(self, sock, *args, **kwargs)
+        self.sock = getattr(sock, '_sock', sock)            # Python 2
+
+
+class FileBody(object):
+
+    """Request body read from a file block by block, rather than from memory.
+
+    Like bytes, it supports len() and slicing with a step of 1. Slices may be
+    read by several threads at once.
+    """
+
+    def __init__(self, fileobj, length):
+        self.file = fileobj
+        self.length = length
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        start, stop, step = index.indices(self.length)
+        with self.lock:
+            self.file.seek(start)
+            return self.file.read(max(0, stop - start))
+
+
+class Response(object):
+
+    """Response to an HTTP request, with the interface of urlopen's."""
+
+    def __init__(self, url, response, release=None):
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.response = response
+        self.release = release
+        # Span of the time spent reading the body, see urlopen.
+        self.span = None
+        if hasattr(socket, '_fileobject'):                  # Python 2
+            response.recv = response.read
+            self.fp = socket._fileobject(response, close=True)
+        else:                                               # cover: disable
+            self.fp = response
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def read(self, *args):
+        data = self.fp.read(*args)
+        if self.response.isclosed():
+            self._release(True)
+        return data
+
+    def close(self):
+        done = self.response.isclosed()
+        self.fp.close()
+        self._release(done)
+
+    def _release(self, reusable):
+        if self.span is not None:
+            self.span.finish()
+        # The connection can be reused once the body was read entirely.
+        if self.release is not None:
+            release, self.release = self.release, None
+            release(reusable)
+
+
+def parse_hosts(value):
+    """Parse a comma-separated list of hosts, as found in X-Resto headers."""
+    return [host.strip() for host in (value or '').split(',') if host.strip()]
+
+
+### Operation context
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def operation(deadline=None, sequence=None, progress=None, priority=None):
+    """Context manager that sets up the operation running in this thread.
+
+    deadline is a timestamp, as returned by time.time(), or None. Nested
+    deadlines can only make the current deadline earlier.
+
+    sequence is the sequence number of a write operation, or None. It orders
+    the writes on a file, see DefaultTransport.
+
+    progress is a function called with the number of bytes sent and the
+    length of the body while request bodies are sent, or None.
+
+    priority is 'interactive', 'normal' or 'bulk', or None. It decides which
+    requests go first when they wait for a host, see HostLimiter.
+    """
+    if priority is not None and priority not in LANES:
+        raise ValueError("Invalid priority: %r." % priority)
+    previous = (getattr(_local, 'deadline', None), get_sequence(),
+            get_progress(), getattr(_local, 'priority', None))
+    if deadline is None:
+        deadline = previous[0]
+    elif previous[0] is not None:
+        deadline = min(previous[0], deadline)
+    if sequence is None:
+        sequence = previous[1]
+    if progress is None:
+        progress = previous[2]
+    if priority is None:
+        priority = previous[3]
+    (_local.deadline, _local.sequence, _local.progress,
+            _local.priority) = (deadline, sequence, progress, priority)
+    try:
+        yield
+    finally:
+        (_local.deadline, _local.sequence, _local.progress,
+                _local.priority) = previous
+
+
+def get_sequence():
+    """Return the sequence number of the operation running in this thread."""
+    return getattr(_local, 'sequence', None)
+
+
+def get_progress():
+    """Return the progress callback of the operation running in this thread."""
+    return getattr(_local, 'progress', None)
+
+
+def get_priority():
+    """Return the priority of the operation running in this thread."""
+    return getattr(_local, 'priority', None) or NORMAL
+
+
+def time_left():
+    """Return the time left before the current deadline, or None."""
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is not None:
+        return deadline - time.time()
+
+
+def remaining(timeout):
+    """Cap a timeout to the time left before the current deadline."""
+    left = time_left()
+    if left is not None:
+        timeout = min(timeout, left)
+        if timeout <= 0:
+            raise socket.timeout("operation deadline exceeded")
+    return timeout
+
+
+### Latency statistics
+
+# Number of latency samples kept for each host.
+LATENCY_SAMPLES = 100
+
+_latencies = collections.defaultdict(
+        lambda: collections.deque(maxlen=LATENCY_SAMPLES))
+
+_latencies_lock = threading.Lock()
+
+
+def record_latency(host, latency):
+    """Record the time a host took to respond to a request."""
+    with _latencies_lock:
+        _latencies[host].append(latency)
+
+
+def get_latency(host, percentile, min_samples=20):
+    """Return a percentile of the latency of a host.
+
+    Return None if fewer than min_samples requests were recorded.
+    """
+    with _latencies_lock:
+        samples = sorted(_latencies[host])
+    if len(samples) < min_samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+
+### Address cache
+
+# Number of seconds during which the addresses of a host are reused, or None
+# to resolve host names for every connection. The system resolver doesn't
+# report the TTL of DNS records, so it must be set explicitly.
+DNS_TTL = get_setting('DNS_TTL')
+
+_addresses = {}
+
+_addresses_lock = threading.Lock()
+
+
+def resolve(host, port):
+    """Return the addresses of a host, from the cache if possible.
+
+    Addresses are socket addresses, as returned by socket.getaddrinfo.
+    """
+    now = time.time()
+    with _addresses_lock:
+        expires, addresses = _addresses.get((host, port), (0, None))
+    if expires > now:
+        return addresses
+    addresses = [info[4] for info in
+            socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+    if DNS_TTL:
+        with _addresses_lock:
+            _addresses[host, port] = now + DNS_TTL, addresses
+    return addresses
+
+
+def clear_addresses():
+    """Forget the addresses of all hosts."""
+    with _addresses_lock:
+        _addresses.clear()
+
+
+def _create_connection(address, *args):
+    # Like socket.create_connection, with the addresses from the cache. If
+    # no address works, they may be outdated.
+    error = None
+    for sockaddr in resolve(*address):
+        try:
+            return socket.create_connection(sockaddr[:2], *args)
+        except socket.error as exc:
+            error = exc
+    with _addresses_lock:
+        _addresses.pop(address, None)
+    raise error
+
+
+### Connection pool
+
+# Maximum number of idle connections kept for each host.
+POOL_SIZE = 10
+
+_pool = collections.defaultdict(list)
+
+_pool_lock = threading.Lock()
+
+_pool_pid = os.getpid()
+
+
+def _get_connection(scheme, netloc):
+    # Return a (connection, reused) tuple, preferably an idle connection.
+    global _pool_pid
+    with _pool_lock:
+        # Connections inherited from a parent process belong to it.
+        if _pool_pid != os.getpid():
+            _pool.clear()
+            _pool_pid = os.getpid()
+        idle = _pool[scheme, netloc]
+        while idle:
+            conn = idle.pop()
+            # An idle connection becomes readable when the server closes it.
+            if not select.select([conn.sock], [], [], 0)[0]:
+                return conn, True
+            _close(conn)
+    if scheme == 'https':
+        conn = httplib.HTTPSConnection(netloc)
+    else:
+        conn = httplib.HTTPConnection(netloc)
+    conn.response_class = HTTPResponse
+    conn._create_connection = _create_connection
+    return conn, False
+
+
+def _put_connection(scheme, netloc, conn):
+    with _pool_lock:
+        idle = _pool[scheme, netloc]
+        if len(idle) < POOL_SIZE:
+            idle.append(conn)
+            return
+    _close(conn)
+
+
+def prewarm(scheme, netloc, timeout):
+    """Open a connection to a host and keep it in the pool for later use.
+
+    This resolves the name of the host too. Connections are only useful if
+    the server supports keep-alive.
+    """
+    conn, reused = _get_connection(scheme, netloc)
+    if not reused:
+        conn.timeout = timeout
+        try:
+            conn.connect()
+        except Exception:
+            _close(conn)
+            raise
+    _put_connection(scheme, netloc, conn)
+
+
+def clear_pool():
+    """Close all idle connections."""
+    with _pool_lock:
+        conns = [conn for idle in _pool.values() for conn in idle]
+        _pool.clear()
+    for conn in conns:
+        _close(conn)
+
+
+def _close(conn):
+    # On Python 2, closing a connection doesn't close the socket as long as
+    # responses hold a reference to it.
+    sock = getattr(conn.sock, '_sock', conn.sock)
+    conn.close()
+    if sock is not None:
+        sock.close()
+
+
+def _is_stale(exc):
+    # Servers may close idle connections at any time. Then, reusing one fails
+    # before any response is received, and the request can be sent again.
+    exc = getattr(exc, 'reason', exc)                       # URLError
+    if isinstance(exc, httplib.BadStatusLine):
+        return True
+    return (isinstance(exc, socket.error) and
+            exc.errno in (errno.EPIPE, errno.ECONNRESET))
+
+
+### Requests
+
+def urlopen(request, connect_timeout, send_timeout, read_timeout,
+        bandwidth=None, continue_timeout=1):
+    """Send a urllib2 Request and return a Response.
+
+    connect_timeout limits the time to open the connection, send_timeout the
+    time to send the request, including its body, and read_timeout the time
+    to wait for the response. If bandwidth, in bytes per second, is given,
+    read operations on the body of the response get an allowance for its
+    length. All timeouts are capped by the operation deadline.
+
+    Like urlopen, raise HTTPError for status codes other than 2xx and URLError
+    if the request can't be sent. Errors while reading the response aren't
+    wrapped.
+
+    Connections are reused when the server supports keep-alive. They return
+    to the pool once the body of the response is read entirely. A request
+    that fails on a connection the server closed in the meantime is sent
+    again on a new connection.
+
+    If the request has an "Expect: 100-continue" header, the body is only
+    sent once the server answers "100 Continue", or after continue_timeout
+    seconds without an answer. If the server sends a final response instead,
+    the body isn't sent at all.
+    """
+    url = request.get_full_url()
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    while True:
+        conn, reused = _get_connection(scheme, netloc)
+        try:
+            response = _send(conn, request, connect_timeout, send_timeout,
+                    read_timeout, continue_timeout)
+        except Exception as exc:
+            _close(conn)
+            if reused and _is_stale(exc):
+                continue
+            raise
+        break
+    length = response.getheader('Content-Length')
+    if bandwidth and length:
+        response.sock.settimeout(
+                remaining(read_timeout + int(length) / float(bandwidth)))
+    if response.will_close:
+        # The connection is already closed; the response owns the socket.
+        release = None
+    else:
+        def release(reusable):
+            if reusable:
+                _put_connection(scheme, netloc, conn)
+            else:
+                _close(conn)
+        if length == '0' or request.get_method() == 'HEAD':
+            response.read()
+    resp = Response(url, response, release)
+    if response.isclosed():
+        resp._release(True)
+    if not 200 <= resp.code < 300:
+        raise HTTPError(url, resp.code, resp.msg, resp.headers, resp.fp)
+    if not response.isclosed():
+        resp.span = tracing.start_span('body')
+    return resp
+
+
+def _send(conn, request, connect_timeout, send_timeout, read_timeout,
+        continue_timeout=1):
+    """Send a request over a connection and return the httplib response."""
+    scheme, netloc, path, query, fragment = urlsplit(request.get_full_url())
+    selector = path + ('?' + query if query else '')
+    body = request.data
+    progress = get_progress()
+    expect = (request.get_header('Expect', '').lower() == '100-continue' and
+            body is not None)
+    try:
+        if conn.sock is None:
+            with tracing.span('connect'):
+                conn.timeout = remaining(connect_timeout)
+                conn.connect()
+        with tracing.span('send', size=len(body or b'')):
+            send_deadline = time.time() + send_timeout
+            conn.sock.settimeout(remaining(send_timeout))
+            conn.putrequest(request.get_method(), selector,
+                    skip_accept_encoding=True)
+            for header, value in request.header_items():
+                conn.putheader(header, value)
+            if body is not None:
+                conn.putheader('Content-Length', str(len(body)))
+            conn.endheaders()
+            if expect and not _wait_for_continue(conn,
+                    min(continue_timeout, send_deadline - time.time())):
+                # The server answered without reading the body: the
+                # connection can't be reused.
+                conn.sock.settimeout(remaining(read_timeout))
+                response = conn.getresponse()
+                response.will_close = True
+                conn.close()
+                return response
+            for start in range(0, len(body or b''), BLOCK_SIZE):
+                timeout = remaining(send_deadline - time.time())
+                if timeout <= 0:
+                    raise socket.timeout("send timeout exceeded")
+                conn.sock.settimeout(timeout)
+                conn.send(body[start:start + BLOCK_SIZE])
+                if progress is not None:
+                    progress(min(start + BLOCK_SIZE, len(body)), len(body))
+    except (socket.error, httplib.HTTPException) as exc:
+        raise URLError(exc)
+    conn.sock.settimeout(remaining(read_timeout))
+    start = time.time()
+    with tracing.span('first_byte'):
+        response = conn.getresponse()
+    record_latency(netloc, time.time() - start)
+    return response
+
+
+def _wait_for_continue(conn, timeout):
+    """Wait for the answer to a request with "Expect: 100-continue".
+
+    Return True if the body must be sent, False if the server sent a final
+    response. The interim "100 Continue" response is consumed.
+    """
+    if isinstance(conn, httplib.HTTPSConnection):
+        # Peeking at encrypted data isn't possible. Sending the body without
+        # waiting is allowed.
+        return True
+    sock = conn.sock
+    deadline = time.time() + remaining(timeout)
+    if not select.select([sock], [], [], remaining(timeout))[0]:
+        return True
+    # The status line may arrive in several segments. Wait for "HTTP/1.x NNN"
+    # before looking at the status code. An empty result means that the
+    # server closed the connection.
+    status = sock.recv(12, socket.MSG_PEEK)
+    while 0 < len(status) < 12:
+        wait = deadline - time.time()
+        if wait <= 0:
+            # Send the body. getresponse() skips an interim response.
+            return True
+        # select() returns at once while there's unread data. Poll instead.
+        time.sleep(min(wait, 0.001))
+        status = sock.recv(12, socket.MSG_PEEK)
+    if status[9:12] != b'100':
+        return False
+    # Read the interim response one byte at a time, in order not to consume
+    # the beginning of the final response.
+    fp = sock.makefile('rb', 0)
+    try:
+        while fp.readline() not in (b'\r\n', b'\n', b''):
+            pass
+    finally:
+        fp.close()
+    return True
@@ -1,15 +1,30 @@
 from __future__ import unicode_literals
 
+import email.utils
+import hashlib
+import json
+import re
 import socket
+import sys
+import time
 try:                                                        # cover: disable
+    import http.client as httplib
     from http.server import BaseHTTPRequestHandler, HTTPServer
-    from urllib.parse import unquote
+    from urllib.parse import quote, unquote
     from urllib.request import URLError, urlopen
 except ImportError:
+    import httplib
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-    from urllib import unquote
+    from urllib import quote, unquote
     from urllib2 import URLError, urlopen
 
+from .http_client import parse_hosts
+from .merkle import build_listings
+
+
+# Size of the blocks of request bodies forwarded by RelayHttpServer.
+BLOCK_SIZE = 64 * 1024
+
 
 class TestHttpServerRequestHandler(BaseHTTPRequestHandler):
 
@@ -18,6 +33,10 @@ class TestHttpServerRequestHandler(BaseHTTPRequestHandler):
     Console logging is disabled to avoid spurious output during the tests.
     """
 
+    @property
+    def protocol_version(self):
+        return 'HTTP/1.1' if self.server.keep_alive else 'HTTP/1.0'
+
     @property
     def filename(self):
         if isinstance(self.path, bytes):                # Python 2
@@ -25,45 +44,157 @@ class TestHttpServerRequestHandler(BaseHTTPRequestHandler):
         else:                                           # cover: disable
             return unquote(self.path.lstrip('/'))
 
+    @property
+    def expects_continue(self):
+        return (self.server.expect_continue and
+                self.headers.get('Expect', '').lower() == '100-continue')
+
     @property
     def content(self):
+        # The client waits for "100 Continue" before sending the body.
+        if self.expects_continue:
+            self.send_continue()
         return self.rfile.read(int(self.headers['Content-Length']))
 
+    def send_continue(self):
+        self.wfile.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+    def handle_expect_100(self):
+        # Python 3 answers "100 Continue" before dispatching the request.
+        # Answer only once the request is accepted, see content.
+        return True
+
     def safe(self, include_content=True):
         try:
             content = self.server.get_file(self.filename)
         except KeyError:
             self.send_error(404)
         else:
-            self.send_response(200)
+            match = re.match(r'^bytes=(\d+)-(\d*)$',
+                    self.headers.get('Range', ''))
+            if match is None or not self.server.ranges:
+                self.send_response(200)
+            else:
+                start = int(match.group(1))
+                end = min(int(match.group(2) or len(content)) + 1,
+                        len(content))
+                if start >= end:
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                        start, end - 1, len(content)))
+                content = content[start:end]
             self.send_header('Content-Length', len(content))
             self.end_headers()
             if include_content:
                 self.wfile.write(content)
 
-    def no_content(self, code=204):
+    def no_content(self, code=204, received=None):
         self.send_response(code)
+        if received:
+            self.send_header('Range', 'bytes=0-%d' % (received - 1))
         self.send_header('Content-Length', 0)
         self.end_headers()
 
+    def is_unavailable(self):
+        if self.server.unavailable <= 0:
+            return False
+        self.server.unavailable -= 1
+        if (self.headers.get('Content-Length') is not None and
+                not self.expects_continue):
+            self.content
+        self.send_error(503)
+        return True
+
+    def check_sequence(self):
+        sequence = self.headers.get('X-Resto-Sequence')
+        if sequence is None:
+            return True
+        latest = self.server.sequences.get(self.filename, 0)
+        if int(sequence) < latest:
+            self.send_response(409)
+            self.send_header('X-Resto-Sequence', latest)
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return False
+        self.server.sequences[self.filename] = int(sequence)
+        return True
+
     def do_GET(self):
+        if self.is_unavailable():
+            return
+        if self.filename.endswith('?digest'):
+            return self.digest(self.filename[:-len('?digest')].strip('/'))
         return self.safe()
 
+    def digest(self, directory):
+        listing = self.server.get_listing(directory)
+        if listing is None:
+            self.send_error(404)
+            return
+        body = json.dumps(listing, sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_HEAD(self):
+        if self.is_unavailable():
+            return
         return self.safe(include_content=False)
 
     def do_PUT(self):
+        if self.is_unavailable():
+            return
         if self.server.readonly:
             self.send_error(403)
             return
+        if self.headers.get('Content-Range') is not None:
+            return self.put_part(self.headers.get('Content-Range'))
+        content = self.content
+        if not self.check_sequence():
+            return
         created = not self.server.has_file(self.filename)
-        self.server.create_file(self.filename, self.content)
+        self.server.create_file(self.filename, content)
+        self.no_content(201 if created else 204)
+
+    def put_part(self, content_range):
+        match = re.match(r'^bytes (?:\*|(\d+)-(\d+))/(\d+)$', content_range)
+        content = self.content
+        if match is None:
+            self.send_error(400)
+            return
+        if not self.check_sequence():
+            return
+        start, end, total = match.groups()
+        received = self.server.get_partial_file(self.filename, int(total))
+        if start is None:                               # status query
+            self.no_content(202, len(received))
+            return
+        if (int(start) != len(received) or
+                int(end) + 1 - int(start) != len(content)):
+            self.send_error(416)
+            return
+        received += content
+        if len(received) < int(total):
+            self.server.partial_files[self.filename] = (int(total), received)
+            self.no_content(202, len(received))
+            return
+        self.server.partial_files.pop(self.filename, None)
+        created = not self.server.has_file(self.filename)
+        self.server.create_file(self.filename, received)
         self.no_content(201 if created else 204)
 
     def do_DELETE(self):
+        if self.is_unavailable():
+            return
         if self.server.readonly:
             self.send_error(403)
             return
+        if not self.check_sequence():
+            return
         try:
             self.server.delete_file(self.filename)
         except KeyError:
@@ -71,6 +202,50 @@ class TestHttpServerRequestHandler(BaseHTTPRequestHandler):
         else:
             self.no_content()
 
+    def do_PROPFIND(self):
+        if self.is_unavailable():
+            return
+        if self.headers.get('Content-Length') is not None:
+            self.content
+        depth = self.headers.get('Depth')
+        if depth not in ('0', '1'):
+            self.send_error(403)
+            return
+        entries = self.server.list_entries(self.filename.strip('/'))
+        if entries is None:
+            self.send_error(404)
+            return
+        if depth == '0':
+            entries = entries[:1]
+        body = ['<?xml version="1.0" encoding="utf-8"?>',
+                '<D:multistatus xmlns:D="DAV:">']
+        for name, is_dir in entries:
+            body.append(self.propstat(name, is_dir))
+        body.append('</D:multistatus>')
+        body = ''.join(body).encode('utf-8')
+        self.send_response(207)
+        self.send_header('Content-Type', 'application/xml; charset=utf-8')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def propstat(self, name, is_dir):
+        href = quote(('/' + name + ('/' if is_dir and name else ''))
+                .encode('utf-8'))
+        if is_dir:
+            props = '<D:resourcetype><D:collection/></D:resourcetype>'
+        else:
+            props = ('<D:resourcetype/>'
+                    '<D:getcontentlength>%d</D:getcontentlength>' %
+                    len(self.server.files[name]))
+            mtime = self.server.mtimes.get(name, 0)
+            if mtime is not None:
+                props += ('<D:getlastmodified>%s</D:getlastmodified>' %
+                        email.utils.formatdate(mtime, usegmt=True))
+        return ('<D:response><D:href>%s</D:href><D:propstat><D:prop>%s'
+                '</D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat>'
+                '</D:response>' % (href, props))
+
     def log_request(self, code=None, size=None):
         code = self.server.override_code or code
         self.server.log.append((self.command, self.path, code))
@@ -97,16 +272,58 @@ class TestHttpServer(HTTPServer):
 
     When self.readonly is True, PUT and DELETE requests are forbidden.
 
-    self.override_code and self.readonly are used to test invalid behaviors.
+    PUT requests with a Content-Range header upload a file in several parts.
+    Parts are kept in self.partial_files until the file is complete. GET
+    requests with a Range header download a part of a file, unless
+    self.ranges is False.
+
+    When self.unavailable is a positive number, that many requests are
+    answered with "503 Service Unavailable" before being processed.
+
+    self.override_code, self.readonly and self.unavailable are used to test
+    invalid behaviors.
+
+    Writes that carry a X-Resto-Sequence header lower than the one of the
+    last write on the same file are rejected with "409 Conflict".
+
+    PROPFIND requests with a depth of 0 or 1 list files and directories, as
+    inferred from the names of the files, like WebDAV does. Files whose entry
+    in self.mtimes is None have no last modification time.
+
+    GET requests for "<directory>/?digest" return the listing of a directory
+    with Merkle digests as JSON, see merkle.build_listings. This is the
+    reference implementation for media servers verified by resto_verify.
+
+    When self.keep_alive is True, the server speaks HTTP/1.1 and keeps
+    connections open. Since it handles one connection at a time, clients must
+    close their idle connections before opening another one.
+
+    Requests with an "Expect: 100-continue" header get a "100 Continue"
+    interim response only if they aren't rejected before their body is read.
+    When self.expect_continue is False, the header is ignored.
     """
 
+    handler_class = TestHttpServerRequestHandler
+
     def __init__(self, host='localhost', port=4080):
         self.files = {}
+        self.mtimes = {}
+        self.partial_files = {}
         self.log = []
+        self.sequences = {}
         self.override_code = None
         self.readonly = False
+        self.unavailable = 0
+        self.keep_alive = False
+        self.expect_continue = True
+        self.ranges = True
         self.running = True
-        HTTPServer.__init__(self, (host, port), TestHttpServerRequestHandler)
+        HTTPServer.__init__(self, (host, port), self.handler_class)
+
+    def handle_error(self, request, client_address):
+        # Clients may close keep-alive connections at any time.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
 
     def has_file(self, name):
         """Test if a file exists on the server."""
@@ -119,10 +336,45 @@ class TestHttpServer(HTTPServer):
     def create_file(self, name, content):
         """Create a file on the server."""
         self.files[name] = content
+        self.mtimes[name] = time.time()
 
     def delete_file(self, name):
         """Delete a file on the server."""
         del self.files[name]
+        self.mtimes.pop(name, None)
+
+    def list_entries(self, name):
+        """List a file or a directory and its contents on the server.
+
+        Return a list of (name, is_dir) tuples, starting with the file or the
+        directory itself, or None if it doesn't exist.
+        """
+        if name in self.files:
+            return [(name, False)]
+        prefix = name + '/' if name else ''
+        children = set()
+        for key in self.files:
+            if key.startswith(prefix):
+                child, sep, rest = key[len(prefix):].partition('/')
+                children.add((prefix + child, bool(sep)))
+        if name and not children:
+            return None
+        return [(name, True)] + sorted(children)
+
+    def get_listing(self, directory):
+        """Return the listing of a directory on the server, or None."""
+        return build_listings(dict((name, (len(content),
+                hashlib.sha256(content).hexdigest()))
+                for name, content in self.files.items())).get(directory)
+
+    def get_partial_file(self, name, total):
+        """Obtain the part of a file received by a chunked upload.
+
+        Parts received for an upload of a different length are discarded.
+        """
+        if self.partial_files.get(name, (total,))[0] != total:
+            del self.partial_files[name]
+        return self.partial_files.get(name, (total, b''))[1]
 
     def run(self):
         """Start the server.
@@ -143,3 +395,101 @@ class TestHttpServer(HTTPServer):
                 pass
         else:                                               # cover: disable
             print("Warning: stop() called with server wasn't running!")
+
+
+class RelayHttpServerRequestHandler(TestHttpServerRequestHandler):
+
+    """Request handler for the relay HTTP server."""
+
+    # Body of the request being relayed, and hosts where relaying it failed.
+    forwarded = None
+    failed = ()
+
+    @property
+    def content(self):
+        if self.forwarded is not None:
+            return self.forwarded
+        return TestHttpServerRequestHandler.content.fget(self)
+
+    def do_PUT(self):
+        downstream = parse_hosts(self.headers.get('X-Resto-Forward'))
+        if not downstream or self.headers.get('Content-Range') is not None:
+            return TestHttpServerRequestHandler.do_PUT(self)
+        self.forwarded, self.failed = self.forward(downstream)
+        try:
+            TestHttpServerRequestHandler.do_PUT(self)
+        finally:
+            self.forwarded, self.failed = None, ()
+
+    def forward(self, downstream):
+        # Send the body to the next host while receiving it. Return the body
+        # and the list of hosts where the write failed.
+        length = int(self.headers['Content-Length'])
+        if self.expects_continue:
+            self.send_continue()
+        conn = httplib.HTTPConnection(downstream[0],
+                timeout=self.server.relay_timeout)
+        try:
+            conn.putrequest('PUT', self.path, skip_accept_encoding=True)
+            sequence = self.headers.get('X-Resto-Sequence')
+            if sequence is not None:
+                conn.putheader('X-Resto-Sequence', sequence)
+            if len(downstream) > 1:
+                conn.putheader('X-Resto-Forward', ', '.join(downstream[1:]))
+            conn.putheader('Content-Length', str(length))
+            conn.endheaders()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            conn = None
+        parts = []
+        while length > 0:
+            part = self.rfile.read(min(length, BLOCK_SIZE))
+            if not part:
+                break
+            length -= len(part)
+            parts.append(part)
+            if conn is not None:
+                try:
+                    conn.send(part)
+                except socket.error:
+                    conn.close()
+                    conn = None
+        content = b''.join(parts)
+        if conn is None:
+            return content, downstream
+        try:
+            resp = conn.getresponse()
+            resp.read()
+        except (socket.error, httplib.HTTPException):
+            return content, downstream
+        finally:
+            conn.close()
+        failed = parse_hosts(resp.getheader('X-Resto-Failed'))
+        # "409 Conflict" means that a more recent write superseded this one.
+        if not 200 <= resp.status < 300 and resp.status != 409:
+            failed.insert(0, downstream[0])
+        return content, failed
+
+    def send_response(self, code, message=None):
+        TestHttpServerRequestHandler.send_response(self, code, message)
+        if self.failed:
+            self.send_header('X-Resto-Failed', ', '.join(self.failed))
+
+
+class RelayHttpServer(TestHttpServer):
+
+    """Test HTTP server that relays uploads to other servers.
+
+    This is a reference implementation of chain replication. A PUT request
+    with a X-Resto-Forward header listing hosts is forwarded to the first of
+    these hosts, with the rest of the list, while its body is received. The
+    response is sent once the rest of the chain has answered. It carries the
+    status code of the write on this server and a X-Resto-Failed header that
+    lists the hosts where the write failed, if any.
+
+    self.relay_timeout is the timeout for requests to the next host.
+    """
+
+    handler_class = RelayHttpServerRequestHandler
+
+    relay_timeout = 10
@@ -0,0 +1,59 @@
+from __future__ import unicode_literals
+
+import hashlib
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...manifest import Manifest
+from ...settings import get_setting
+from ...storage import WebDavTransport
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild RESTO_MANIFEST from the contents of the media servers."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--hash', action='store_true', default=False,
+            help="Download the files to compute their hashes."),
+    )
+
+    def handle(self, *args, **options):
+        path = get_setting('MANIFEST')
+        if path is None:
+            raise CommandError("Set RESTO_MANIFEST to rebuild a manifest.")
+        if get_setting('DEDUPLICATE'):
+            raise CommandError("The names of files can't be recovered from "
+                    "the media servers with RESTO_DEDUPLICATE.")
+        hosts = get_setting('MEDIA_HOSTS')
+        transport = WebDavTransport(base_url=settings.MEDIA_URL)
+        # The first host that has a file determines its size and mtime. Hosts
+        # that have a file of a different size have a stale copy. Files
+        # without a modification time get the current time. The .resto
+        # directory holds internal files, like the health canary.
+        files = {}
+        for host in hosts:
+            for name, size, modified in transport.walk(host,
+                    exclude=['.resto']):
+                if name not in files:
+                    if modified is None:
+                        mtime = time.time()
+                    else:
+                        mtime = time.mktime(modified.timetuple())
+                    files[name] = [size, None, mtime, {}, host]
+                same = files[name][0] == size
+                files[name][3][host] = 'present' if same else 'missing'
+        for name, entry in files.items():
+            for host in hosts:
+                entry[3].setdefault(host, 'missing')
+            if options['hash']:
+                content = transport.content(entry[4], name)
+                entry[1] = hashlib.sha256(content).hexdigest()
+        Manifest(path).rebuild((name, size, hash, mtime, statuses)
+                for name, (size, hash, mtime, statuses, host)
+                in sorted(files.items()))
+        self.stdout.write("Indexed %d files from %d media servers.\n"
+                % (len(files), len(hosts)))
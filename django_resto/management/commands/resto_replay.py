@@ -0,0 +1,48 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...replay import Replayer
+from ...trace import read_trace
+
+
+class Command(BaseCommand):
+
+    args = '<trace>'
+
+    help = ("Replay a trace recorded with RESTO_TRACE against local stand-ins "
+            "for the media servers, and report throughput and latency.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--speed', type='float', default=1.0,
+            help="Replay the trace this many times faster (default: 1)."),
+        make_option('--threads', type='int', default=8,
+            help="Maximum number of concurrent requests (default: 8)."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the path of a trace file.")
+        try:
+            records = list(read_trace(args[0]))
+        except (IOError, ValueError) as exc:
+            raise CommandError("Failed to read the trace: %s." % exc)
+        if not records:
+            raise CommandError("The trace is empty.")
+        report = Replayer(records, speed=options['speed'],
+                threads=options['threads']).run()
+        self.stdout.write("Replayed %d requests in %.2fs: %.1f requests/s, "
+                "%d errors, %d skipped, up to %.3fs behind schedule.\n" % (
+                report['requests'], report['duration'],
+                report['throughput'] or 0, report['errors'],
+                report['skipped'], report['max_lag']))
+        self.stdout.write("%-14s %6s %6s %8s %8s %8s %8s %8s %8s\n" % (
+                'operation', 'count', 'errors', 'p50', 'p90', 'p99', 'max',
+                'trace50', 'trace99'))
+        for operation, stats in sorted(report['operations'].items()):
+            self.stdout.write("%-14s %6d %6d %8.3f %8.3f %8.3f %8.3f %8.3f "
+                    "%8.3f\n" % (operation, stats['count'], stats['errors'],
+                    stats['p50'], stats['p90'], stats['p99'], stats['max'],
+                    stats['recorded_p50'], stats['recorded_p99']))
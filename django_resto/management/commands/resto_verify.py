@@ -0,0 +1,43 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.files.storage import get_storage_class
+from django.core.management.base import BaseCommand, CommandError
+
+from ...storage import HybridStorage
+
+
+class Command(BaseCommand):
+
+    help = ("Find the files that differ between MEDIA_ROOT and the media "
+            "servers by comparing Merkle digests.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repair', action='store_true', default=False,
+            help="Upload or delete the files that differ."),
+    )
+
+    def handle(self, *args, **options):
+        storage = get_storage_class()()
+        if not isinstance(storage, HybridStorage):
+            raise CommandError("Set DEFAULT_FILE_STORAGE to HybridStorage or "
+                    "AsyncStorage to verify the media servers.")
+        results, errors = storage.verify()
+        failed = set(errors)
+        for host, differences in sorted(results.items()):
+            for name, difference in differences:
+                self.stdout.write("%s: %s %s\n" % (host, difference, name))
+                if options['repair']:
+                    try:
+                        storage.repair(host, name)
+                    except Exception as exc:
+                        self.stderr.write("Failed to repair %s on %s: %s.\n"
+                                % (name, host, exc))
+                        failed.add(host)
+            self.stdout.write("%s: %d differences.\n" % (host,
+                    len(differences)))
+        for host, exc in sorted(errors.items()):
+            self.stderr.write("Failed to verify %s: %s.\n" % (host, exc))
+        if failed:
+            raise CommandError("Failed on %s." % ', '.join(sorted(failed)))
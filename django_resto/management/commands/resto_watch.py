@@ -0,0 +1,35 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.files.storage import get_storage_class
+from django.core.management.base import BaseCommand, CommandError
+
+from ...storage import HybridStorage
+from ...watcher import Watcher
+
+
+class Command(BaseCommand):
+
+    help = ("Replicate the changes made in MEDIA_ROOT outside the storage "
+            "API to the media servers.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=4,
+            help="Number of concurrent replications (default: 4)."),
+        make_option('--debounce', type='float', default=1.0,
+            help="Seconds without changes before a file is replicated "
+                 "(default: 1)."),
+    )
+
+    def handle(self, *args, **options):
+        storage = get_storage_class()()
+        if not isinstance(storage, HybridStorage):
+            raise CommandError("Set DEFAULT_FILE_STORAGE to HybridStorage or "
+                    "AsyncStorage to watch MEDIA_ROOT.")
+        watcher = Watcher(storage, threads=options['threads'],
+                debounce=options['debounce'])
+        try:
+            watcher.run()
+        except OSError as exc:
+            raise CommandError("Failed to watch MEDIA_ROOT: %s." % exc)
@@ -0,0 +1,49 @@
+from __future__ import unicode_literals
+
+import multiprocessing
+import signal
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...settings import get_setting
+from ...spool import Spool, Worker
+
+
+class Command(BaseCommand):
+
+    help = "Run the replication jobs enqueued in RESTO_SPOOL by AsyncStorage."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=1,
+            help="Number of worker processes (default: 1)."),
+        make_option('--threads', type='int', default=4,
+            help="Number of threads per worker process (default: 4)."),
+    )
+
+    def handle(self, *args, **options):
+        path = get_setting('SPOOL')
+        if path is None:
+            raise CommandError("Set RESTO_SPOOL to run a replication worker.")
+        spool = Spool(path)
+        # Jobs claimed by a previous worker that died never completed.
+        spool.release()
+        worker = Worker(spool, threads=options['threads'])
+        if options['processes'] == 1:
+            worker.run()
+            return
+        processes = [multiprocessing.Process(target=worker.run)
+                for _ in range(options['processes'])]
+        for process in processes:
+            process.start()
+
+        def terminate(*args):
+            for process in processes:
+                process.terminate()
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
@@ -0,0 +1,244 @@
+"""Local index of the files stored by DistributedStorage.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import errno
+import sqlite3
+
+
+class Manifest(object):
+
+    """Index of files stored in a SQLite database.
+
+    For each file, the manifest records its size, its SHA-256 hash and the
+    time it was written, as well as the status of each media server:
+
+    - 'present': the file was written successfully;
+    - 'missing': the file couldn't be written;
+    - 'orphan': the file was deleted, but the deletion failed.
+
+    Like Spool, each operation opens its own connection, so a manifest can be
+    shared between threads and processes, and pickled along with a storage.
+    """
+
+    timeout = 10
+
+    def __init__(self, path):
+        self.path = path
+        self.initialized = False
+
+    def __getstate__(self):
+        return {'path': self.path, 'initialized': False}
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                isolation_level=None)
+        if not self.initialized:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                    'name TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                    'hash TEXT, mtime REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS replicas ('
+                    'name TEXT NOT NULL, host TEXT NOT NULL, '
+                    'status TEXT NOT NULL, PRIMARY KEY (name, host))')
+            conn.execute('CREATE INDEX IF NOT EXISTS files_hash '
+                    'ON files (hash)')
+            self.initialized = True
+        return conn
+
+    def add(self, name, size, hash, mtime, statuses):
+        """Record a file that was written.
+
+        statuses maps each host to 'present' or 'missing'.
+        """
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO files (name, size, hash, '
+                    'mtime) VALUES (?, ?, ?, ?)', (name, size, hash, mtime))
+            self._set_statuses(conn, name, statuses)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def remove(self, name, statuses):
+        """Record a file that was deleted.
+
+        statuses maps each host where the deletion failed to 'orphan'.
+        """
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM files WHERE name = ?', (name,))
+            self._set_statuses(conn, name, statuses)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def update(self, name, statuses):
+        """Change the status of some hosts for a file already recorded.
+
+        statuses maps hosts to 'present' or 'missing'.
+        """
+        self._update('name = ?', name, statuses)
+
+    def update_content(self, hash, statuses):
+        """Change the status of some hosts for the files that have a hash."""
+        self._update('name IN (SELECT name FROM files WHERE hash = ?)',
+                hash, statuses)
+
+    def _update(self, where, value, statuses):
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('UPDATE replicas SET status = ? '
+                    'WHERE host = ? AND ' + where, [(status, host, value)
+                    for host, status in sorted(statuses.items())])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def link(self, name, size, hash, mtime):
+        """Record a file that has the same content as a file already recorded.
+
+        The file gets the statuses of the other file. Return False, without
+        recording anything, if no file has the given hash, or if no host has
+        this content.
+        """
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT name FROM files f WHERE hash = ? '
+                    'AND EXISTS (SELECT 1 FROM replicas r '
+                    'WHERE r.name = f.name AND r.status = ?) LIMIT 1',
+                    (hash, 'present')).fetchone()
+            if row is not None:
+                statuses = dict(conn.execute('SELECT host, status '
+                        'FROM replicas WHERE name = ?', row).fetchall())
+                conn.execute('INSERT OR REPLACE INTO files (name, size, '
+                        'hash, mtime) VALUES (?, ?, ?, ?)',
+                        (name, size, hash, mtime))
+                self._set_statuses(conn, name, statuses)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return row is not None
+
+    def unlink(self, name):
+        """Forget a file.
+
+        Return its hash if no other file has the same content, None otherwise.
+        """
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT hash FROM files WHERE name = ?',
+                    (name,)).fetchone()
+            conn.execute('DELETE FROM files WHERE name = ?', (name,))
+            conn.execute('DELETE FROM replicas WHERE name = ?', (name,))
+            hash = None if row is None else row[0]
+            if hash is not None and conn.execute('SELECT 1 FROM files '
+                    'WHERE hash = ? LIMIT 1', (hash,)).fetchone():
+                hash = None
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return hash
+
+    def references(self, hash):
+        """Return the number of files that have the given hash."""
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM files WHERE hash = ?',
+                    (hash,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def _set_statuses(self, conn, name, statuses):
+        conn.execute('DELETE FROM replicas WHERE name = ?', (name,))
+        conn.executemany('INSERT INTO replicas (name, host, status) '
+                'VALUES (?, ?, ?)', [(name, host, status)
+                for host, status in sorted(statuses.items())])
+
+    def get(self, name):
+        """Return a (size, hash, mtime) tuple for a file, or None."""
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT size, hash, mtime FROM files '
+                    'WHERE name = ?', (name,)).fetchone()
+        finally:
+            conn.close()
+
+    def statuses(self, name):
+        """Return a dict mapping each host to the status of a file."""
+        conn = self.connect()
+        try:
+            return dict(conn.execute('SELECT host, status FROM replicas '
+                    'WHERE name = ?', (name,)).fetchall())
+        finally:
+            conn.close()
+
+    def inconsistencies(self):
+        """Return a list of (name, host, status) for files to repair."""
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT name, host, status FROM replicas '
+                    'WHERE status != ? ORDER BY name, host',
+                    ('present',)).fetchall()
+        finally:
+            conn.close()
+
+    def listdir(self, path):
+        """List the contents of a directory, like Storage.listdir."""
+        path = path.strip('/')
+        prefix = path + '/' if path else ''
+        conn = self.connect()
+        try:
+            if prefix:
+                # The names that start with "dir/" sort between "dir/" and
+                # "dir0", because "0" follows "/".
+                rows = conn.execute('SELECT name FROM files '
+                        'WHERE name >= ? AND name < ?',
+                        (prefix, prefix[:-1] + '0'))
+            else:
+                rows = conn.execute('SELECT name FROM files')
+            directories, files = set(), []
+            for (name,) in rows:
+                child, sep, rest = name[len(prefix):].partition('/')
+                if sep:
+                    directories.add(child)
+                else:
+                    files.append(child)
+        finally:
+            conn.close()
+        if path and not directories and not files:
+            raise OSError(errno.ENOENT, "No such directory: %r." % path)
+        return sorted(directories), sorted(files)
+
+    def rebuild(self, files):
+        """Replace the contents of the manifest.
+
+        files is an iterable of (name, size, hash, mtime, statuses) tuples.
+        """
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM files')
+            conn.execute('DELETE FROM replicas')
+            for name, size, hash, mtime, statuses in files:
+                conn.execute('INSERT INTO files (name, size, hash, mtime) '
+                        'VALUES (?, ?, ?, ?)', (name, size, hash, mtime))
+                self._set_statuses(conn, name, statuses)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def __len__(self):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        finally:
+            conn.close()
@@ -0,0 +1,197 @@
+"""Merkle digests of trees of files, to find the differences between the
+master copy and the media servers without comparing every file, used by
+resto_verify.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import hashlib
+import os
+import os.path
+import sqlite3
+import sys
+
+
+# Size of the blocks read to hash files.
+BLOCK_SIZE = 64 * 1024
+
+EMPTY = {'digest': None, 'entries': {}}
+
+
+def hash_file(path):
+    """Return the SHA-256 hash of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_digest(entries):
+    """Return the digest of the entries of a directory, see build_listings."""
+    digest = hashlib.sha256()
+    for name, entry in sorted(entries.items()):
+        if 'digest' in entry:
+            line = '%s/\0%s\n' % (name, entry['digest'])
+        else:
+            line = '%s\0%d\0%s\n' % (name, entry['size'], entry['hash'])
+        digest.update(line.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_listings(files):
+    """Return a dict mapping each directory of a tree to its listing.
+
+    files maps the names of files to (size, hash) tuples. Directories are
+    inferred from the names; the root is ''. A listing is a dict with the
+    'digest' of the directory and its 'entries', a dict mapping the name of
+    each file to {'size': size, 'hash': hash} and the name of each
+    subdirectory to {'digest': digest}.
+    """
+    children = collections.defaultdict(dict)
+    children.setdefault('', {})
+    for name, (size, hash) in files.items():
+        directory, _, base = name.rpartition('/')
+        children[directory][base] = {'size': size, 'hash': hash}
+        while directory:
+            parent, _, base = directory.rpartition('/')
+            children[parent].setdefault(base, None)
+            directory = parent
+    listings = {}
+    # Subdirectories must be digested before their parent.
+    for directory in sorted(children, key=lambda name: -len(name)):
+        entries = children[directory]
+        for base, entry in entries.items():
+            if entry is None:
+                path = directory + '/' + base if directory else base
+                entries[base] = {'digest': listings[path]['digest']}
+        listings[directory] = {'digest': get_digest(entries),
+                'entries': entries}
+    return listings
+
+
+class MasterTree(object):
+
+    """Merkle digests of the files of a directory, such as MEDIA_ROOT.
+
+    refresh() walks the directory and only hashes the files whose size or
+    modification time changed since the last refresh. With a cache, the
+    hashes are kept in a SQLite database, so they survive the process.
+    """
+
+    timeout = 10
+
+    def __init__(self, location, cache=None):
+        if isinstance(location, bytes):                     # Python 2
+            location = location.decode(sys.getfilesystemencoding())
+        self.location = location
+        self.cache = cache
+        # hashes maps the names of files to (size, mtime, hash) tuples.
+        self.hashes = None
+        self.listings = {}
+
+    def connect(self):
+        conn = sqlite3.connect(self.cache, timeout=self.timeout,
+                isolation_level=None)
+        conn.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                'name TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                'mtime REAL NOT NULL, hash TEXT NOT NULL)')
+        return conn
+
+    def refresh(self):
+        """Compute the digests of the files as they are now."""
+        if self.hashes is None:
+            self.hashes = self._load()
+        hashes, changed = {}, {}
+        for dirpath, dirnames, filenames in os.walk(self.location):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.location)
+                name = name.replace(os.sep, '/')
+                try:
+                    stat = os.stat(path)
+                    known = self.hashes.get(name)
+                    if known is not None and known[:2] == (stat.st_size,
+                            stat.st_mtime):
+                        hashes[name] = known
+                    else:
+                        hashes[name] = changed[name] = (stat.st_size,
+                                stat.st_mtime, hash_file(path))
+                except (IOError, OSError):
+                    pass    # the file was deleted in the meantime
+        removed = set(self.hashes) - set(hashes)
+        self.hashes = hashes
+        self._save(changed, removed)
+        self.listings = build_listings(dict((name, (size, hash))
+                for name, (size, mtime, hash) in hashes.items()))
+
+    def listing(self, directory=''):
+        """Return the listing of a directory, see build_listings, or None."""
+        return self.listings.get(directory)
+
+    def _load(self):
+        if self.cache is None:
+            return {}
+        conn = self.connect()
+        try:
+            return dict((row[0], tuple(row[1:])) for row in conn.execute(
+                    'SELECT name, size, mtime, hash FROM hashes'))
+        finally:
+            conn.close()
+
+    def _save(self, changed, removed):
+        if self.cache is None or not (changed or removed):
+            return
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('DELETE FROM hashes WHERE name = ?',
+                    [(name,) for name in removed])
+            conn.executemany('INSERT OR REPLACE INTO hashes (name, size, '
+                    'mtime, hash) VALUES (?, ?, ?, ?)', [(name,) + entry
+                    for name, entry in changed.items()])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+
+def compare(local, remote):
+    """Find the files that differ between two trees.
+
+    local and remote are functions returning the listing of a directory, see
+    build_listings, or None if it doesn't exist. Only the directories whose
+    digests differ are listed.
+
+    Yield (name, difference) tuples, difference being 'missing' if the file
+    is only in the local tree, 'extra' if it's only in the remote tree, and
+    'different' if they have different sizes or hashes.
+    """
+    def walk(directory, mine, theirs):
+        if mine['digest'] == theirs['digest']:
+            return
+        mine, theirs = mine['entries'], theirs['entries']
+        for base in sorted(set(mine) | set(theirs)):
+            name = directory + '/' + base if directory else base
+            a, b = mine.get(base), theirs.get(base)
+            if a == b:
+                continue
+            a_dir = a is not None and 'digest' in a
+            b_dir = b is not None and 'digest' in b
+            if a is not None and not a_dir:
+                if b is not None and not b_dir:
+                    yield name, 'different'
+                    continue
+                yield name, 'missing'
+            elif b is not None and not b_dir:
+                yield name, 'extra'
+            if a_dir or b_dir:
+                for item in walk(name,
+                        local(name) or EMPTY if a_dir else EMPTY,
+                        remote(name) or EMPTY if b_dir else EMPTY):
+                    yield item
+
+    for item in walk('', local('') or EMPTY, remote('') or EMPTY):
+        yield item
@@ -0,0 +1,177 @@
+"""Replay of traces recorded with RESTO_TRACE against local stand-ins for the
+media servers, run by resto_replay.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import math
+import threading
+import time
+try:                                                        # cover: disable
+    import queue
+    from socketserver import ThreadingMixIn
+except ImportError:
+    import Queue as queue
+    from SocketServer import ThreadingMixIn
+
+from .http_server import TestHttpServer
+from .storage import DefaultTransport
+from .trace import get_outcome
+
+
+# Operations that upload a body, and operations that require the file.
+WRITES = ('create', 'create_chain', 'upload')
+READS = ('content', 'size', 'delete')
+
+OPERATIONS = WRITES + READS + ('exists',)
+
+
+class ReplayHttpServer(ThreadingMixIn, TestHttpServer):
+
+    """TestHttpServer that handles requests concurrently."""
+
+    daemon_threads = True
+
+
+def percentile(values, fraction):
+    """Return a percentile of a list of numbers, or None if it's empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+class Replayer(object):
+
+    """Replay a trace against a ReplayHttpServer for each media server.
+
+    Requests are sent at the pace of the trace, `speed` times faster, with up
+    to `threads` concurrent requests. Bodies are synthetic, with the recorded
+    size. Files that the trace reads before writing them are created on the
+    servers beforehand. Operations that can't be replayed are skipped.
+    """
+
+    def __init__(self, records, speed=1.0, threads=8):
+        self.records = sorted(records, key=lambda record: record[0])
+        self.speed = speed
+        self.threads = threads
+        self.transport = DefaultTransport(base_url='http://replay/')
+        # results holds a (operation, latency, outcome, lag) tuple for each
+        # request, lag being how late the request was sent.
+        self.results = []
+        self.skipped = 0
+        self.duration = 0.0
+        self.lock = threading.Lock()
+
+    def run(self):
+        """Replay the trace and return a report, see report()."""
+        servers = self.start_servers()
+        try:
+            self.replay(dict((host, '%s:%d' % server.server_address)
+                    for host, server in servers.items()))
+        finally:
+            for server in servers.values():
+                server.stop()
+                server.server_close()
+        return self.report()
+
+    def start_servers(self):
+        servers, written = {}, set()
+        for record in self.records:
+            timestamp, operation, name, size, host = record[:5]
+            if host not in servers:
+                servers[host] = ReplayHttpServer('localhost', 0)
+                thread = threading.Thread(target=servers[host].run)
+                thread.daemon = True
+                thread.start()
+            # Create the files that the trace reads before writing them.
+            if operation in WRITES:
+                written.add((host, name))
+            elif (operation in READS and (host, name) not in written and
+                    not servers[host].has_file(name)):
+                servers[host].create_file(name, b'\0' * (size or 0))
+        return servers
+
+    def replay(self, addresses):
+        jobs = queue.Queue()
+
+        def worker():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                self.send(*job)
+
+        workers = [threading.Thread(target=worker)
+                for _ in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        start = time.time()
+        for record in self.records:
+            if record[1] not in OPERATIONS:
+                self.skipped += 1
+                continue
+            scheduled = start + (record[0] - self.records[0][0]) / self.speed
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            jobs.put((record, addresses[record[4]], scheduled))
+        for thread in workers:
+            jobs.put(None)
+        for thread in workers:
+            thread.join()
+        self.duration = time.time() - start
+
+    def send(self, record, address, scheduled):
+        timestamp, operation, name, size = record[:4]
+        start = time.time()
+        try:
+            if operation in WRITES:
+                self.transport.create(address, name, b'\0' * (size or 0))
+            else:
+                getattr(self.transport, operation)(address, name)
+            outcome = 'ok'
+        except Exception as exc:
+            outcome = get_outcome(exc)
+        with self.lock:
+            self.results.append((operation, time.time() - start, outcome,
+                    start - scheduled))
+
+    def report(self):
+        """Return statistics on the replay.
+
+        The report is a dict with the number of requests, skipped operations
+        and errors, the duration, the throughput in requests per second, the
+        maximum lag of requests behind schedule, and, in 'operations', the
+        count, errors and latency percentiles of each operation, along with
+        the percentiles recorded in the trace.
+        """
+        operations = {}
+        for operation in set(result[0] for result in self.results):
+            latencies = [result[1] for result in self.results
+                    if result[0] == operation]
+            recorded = [record[5] for record in self.records
+                    if record[1] == operation]
+            operations[operation] = {
+                'count': len(latencies),
+                'errors': len([result for result in self.results
+                        if result[0] == operation and result[2] != 'ok']),
+                'p50': percentile(latencies, 0.5),
+                'p90': percentile(latencies, 0.9),
+                'p99': percentile(latencies, 0.99),
+                'max': max(latencies),
+                'recorded_p50': percentile(recorded, 0.5),
+                'recorded_p99': percentile(recorded, 0.99),
+            }
+        return {
+            'requests': len(self.results),
+            'skipped': self.skipped,
+            'errors': sum(stats['errors'] for stats in operations.values()),
+            'duration': self.duration,
+            'throughput': len(self.results) / self.duration
+                    if self.duration else None,
+            'max_lag': max([result[3] for result in self.results] or [0]),
+            'operations': operations,
+        }
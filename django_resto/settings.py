@@ -17,8 +17,72 @@ def get_setting(name):
 
 RESTO_TIMEOUT = 2
 
+RESTO_CONNECT_TIMEOUT = None
+
+RESTO_ADAPTIVE_TIMEOUT = False
+
+RESTO_BANDWIDTH = None
+
+RESTO_OPERATION_TIMEOUT = None
+
+RESTO_RETRIES = 0
+
+RESTO_CHUNK_SIZE = None
+
+RESTO_EXPECT_CONTINUE = None
+
 RESTO_MEDIA_HOSTS = ()
 
+RESTO_ZONES = None
+
+RESTO_LOCAL_ZONE = None
+
 RESTO_FATAL_EXCEPTIONS = True
 
 RESTO_SHOW_TRACEBACK = False
+
+RESTO_SPOOL = None
+
+RESTO_MANIFEST = None
+
+RESTO_DEDUPLICATE = False
+
+RESTO_FALLBACK_URL = None
+
+RESTO_DIGEST_CACHE = None
+
+RESTO_ASYNC_THRESHOLD = None
+
+RESTO_HOST_CONCURRENCY = None
+
+RESTO_LATENCY_TARGET = 1
+
+RESTO_BULK_SHARE = 0.5
+
+RESTO_BATCH_CONCURRENCY = 20
+
+RESTO_WEBDAV = False
+
+RESTO_DEFERRED_DELETES = False
+
+RESTO_CHAIN_REPLICATION = False
+
+RESTO_DNS_TTL = None
+
+RESTO_PREWARM = False
+
+RESTO_HEALTH_INTERVAL = None
+
+RESTO_HEALTH_PATH = '.resto/health'
+
+RESTO_HEALTH_MAX_UNHEALTHY = None
+
+RESTO_COALESCE_READS = False
+
+RESTO_STRIPE_SIZE = None
+
+RESTO_MAX_INFLIGHT_BYTES = None
+
+RESTO_TRACE = None
+
+RESTO_SPANS = None
@@ -0,0 +1,237 @@
+"""Local spool of replication jobs, run out of process by resto_worker.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+import pickle
+import signal
+import sqlite3
+import threading
+import time
+
+from .concurrency import LANES, NORMAL
+from .http_client import operation
+from .settings import get_setting
+
+
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+
+    """Queue of replication jobs stored in a SQLite database.
+
+    Jobs for a given name on a given host are handed out one at a time, in the
+    order they were enqueued, because the order of PUT and DELETE matters.
+    Jobs for different names or hosts may run concurrently. Jobs with a
+    higher priority are handed out first, but a job moves up one priority
+    every `aging` seconds it waits, so bulk jobs aren't starved. Jobs are
+    promoted by claim(), at most once every `aging` seconds per instance.
+
+    Each operation opens its own connection, so a spool can be shared between
+    threads and processes, and pickled along with a storage.
+    """
+
+    timeout = 10
+
+    aging = 10
+
+    # Time of the last promotion of waiting jobs by this instance.
+    promoted = 0
+
+    def __init__(self, path):
+        self.path = path
+        self.initialized = False
+
+    def __getstate__(self):
+        return {'path': self.path, 'initialized': False}
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                isolation_level=None)
+        if not self.initialized:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                    'host TEXT NOT NULL, name TEXT NOT NULL, '
+                    'payload BLOB NOT NULL, '
+                    'priority INTEGER NOT NULL DEFAULT 1, '
+                    'enqueued REAL NOT NULL DEFAULT 0, '
+                    'claimed INTEGER NOT NULL DEFAULT 0)')
+            # Spools created by earlier versions lack some columns.
+            columns = set(row[1] for row in
+                    conn.execute('PRAGMA table_info(jobs)'))
+            if 'priority' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN '
+                        'priority INTEGER NOT NULL DEFAULT 1')
+            if 'enqueued' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN '
+                        'enqueued REAL NOT NULL DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_host_name '
+                    'ON jobs (host, name, id)')
+            # claim() reads unclaimed jobs by priority and id, and stops at
+            # the first one that can run.
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_claim '
+                    'ON jobs (claimed, priority, id)')
+            # pending() runs in requests, through url() and pending_hosts().
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_name '
+                    'ON jobs (name)')
+            self.initialized = True
+        return conn
+
+    def put(self, host, name, payload, priority=NORMAL):
+        """Enqueue a job for a file on a given host."""
+        conn = self.connect()
+        try:
+            conn.execute('INSERT INTO jobs (host, name, payload, priority, '
+                    'enqueued) VALUES (?, ?, ?, ?, ?)', (host, name,
+                    sqlite3.Binary(payload), LANES.index(priority),
+                    time.time()))
+        finally:
+            conn.close()
+
+    def claim(self):
+        """Claim the next job that can run.
+
+        Return a (job_id, host, name, payload) tuple, or None if there's no
+        such job. The job must be marked as done with done().
+        """
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            if now - self.promoted >= self.aging:
+                self._promote(conn, now)
+                self.promoted = now
+            row = conn.execute('SELECT id, host, name, payload FROM jobs j '
+                    'WHERE claimed = 0 AND NOT EXISTS (SELECT 1 FROM jobs k '
+                    'WHERE k.host = j.host AND k.name = j.name '
+                    'AND k.id < j.id) ORDER BY priority, id LIMIT 1'
+                    ).fetchone()
+            if row is not None:
+                conn.execute('UPDATE jobs SET claimed = 1 WHERE id = ?',
+                        (row[0],))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        if row is not None:
+            return row[0], row[1], row[2], bytes(row[3])
+
+    def _promote(self, conn, now):
+        # Move up one priority the jobs that waited for `aging` seconds since
+        # they were enqueued or last promoted, as many times as they waited.
+        while conn.execute('UPDATE jobs SET priority = priority - 1, '
+                'enqueued = enqueued + ? WHERE claimed = 0 AND priority > 0 '
+                'AND enqueued <= ?', (self.aging, now - self.aging)
+                ).rowcount:
+            pass
+
+    def done(self, job_id):
+        """Remove a job from the spool once it has run."""
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+        finally:
+            conn.close()
+
+    def pending(self, name):
+        """Return the set of hosts that have jobs for a given name."""
+        conn = self.connect()
+        try:
+            rows = conn.execute('SELECT DISTINCT host FROM jobs '
+                    'WHERE name = ?', (name,)).fetchall()
+        finally:
+            conn.close()
+        return set(row[0] for row in rows)
+
+    def release(self):
+        """Release the jobs claimed by workers that didn't finish them."""
+        conn = self.connect()
+        try:
+            conn.execute('UPDATE jobs SET claimed = 0')
+        finally:
+            conn.close()
+
+    def __len__(self):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+        finally:
+            conn.close()
+
+
+def dump_job(func, args, kwargs, sequence=None, priority=None):
+    """Serialize a call to a method of a storage or a transport."""
+    return pickle.dumps((func.__self__, func.__name__, args, kwargs, sequence,
+            priority), pickle.HIGHEST_PROTOCOL)
+
+
+class Worker(object):
+
+    """Run the jobs of a spool with a pool of threads."""
+
+    poll_interval = 0.1
+
+    show_traceback = get_setting('SHOW_TRACEBACK')
+
+    def __init__(self, spool, threads=1):
+        self.spool = spool
+        self.threads = threads
+        self.running = False
+
+    def run_once(self):
+        """Run the next job of the spool.
+
+        Return True if a job was run, False if there wasn't any job to run.
+        """
+        job = self.spool.claim()
+        if job is None:
+            return False
+        job_id, host, name, payload = job
+        action = 'run job'
+        try:
+            job = pickle.loads(payload)
+            obj, action, args, kwargs, sequence = job[:5]
+            # Jobs enqueued by earlier versions don't have a priority.
+            priority = job[5] if len(job) > 5 else None
+            with operation(sequence=sequence, priority=priority):
+                getattr(obj, action)(host, name, *args, **kwargs)
+        except Exception:
+            logger.error("Failed to %s %s on %s.", action, name, host,
+                    exc_info=self.show_traceback)
+        finally:
+            self.spool.done(job_id)
+        return True
+
+    def work(self):
+        while self.running:
+            if not self.run_once():
+                time.sleep(self.poll_interval)
+
+    def run(self):
+        """Run jobs until stop() is called or the process is terminated.
+
+        This must be called from the main thread.
+        """
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        threads = [threading.Thread(target=self.work)
+                for _ in range(self.threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+    def stop(self, *args):
+        """Stop the worker after the jobs in progress."""
+        self.running = False
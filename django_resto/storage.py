@@ -1,21 +1,44 @@
+import contextlib
+import datetime
+import email.utils
+import errno
+import hashlib
+import itertools
+import json
 import logging
 import random
+import re
+import socket
 import sys
+import tempfile
 import threading
+import time
 try:                                                        # cover: disable
-    from urllib.parse import quote, urljoin, urlsplit, urlunsplit
-    from urllib.request import HTTPError, Request, URLError, urlopen
+    from urllib.parse import quote, unquote, urljoin, urlsplit, urlunsplit
+    from urllib.request import HTTPError, Request, URLError
 except ImportError:
-    from urllib import quote
-    from urllib2 import HTTPError, Request, URLError, urlopen
+    from urllib import quote, unquote
+    from urllib2 import HTTPError, Request, URLError
     from urlparse import urljoin, urlsplit, urlunsplit
+try:                                                        # cover: disable
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 from django.core.files.storage import Storage, FileSystemStorage
 from django.utils.encoding import filepath_to_uri
 
+from . import health, http_client, tracing
+from .concurrency import (SingleFlight, get_budget, get_limiter, is_overload,
+        map_in_threads)
+from .manifest import Manifest
+from .merkle import MasterTree, compare
 from .settings import get_setting
+from .spool import Spool, dump_job
+from .stripes import StripedReader
+from .trace import Recorder, get_outcome
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +62,21 @@ class UnexpectedStatusCode(HTTPError):
             resp.url, resp.code, resp.msg, resp.headers, resp.fp)
 
 
+class BatchError(Exception):
+
+    """Exception raised when some lookups of a batch fail.
+
+    results maps the names that were looked up successfully to the result,
+    errors maps the other names to the exception raised by the last host.
+    """
+
+    def __init__(self, results, errors):
+        super(BatchError, self).__init__("Failed to look up %d file(s) out "
+                "of %d." % (len(errors), len(results) + len(errors)))
+        self.results = results
+        self.errors = errors
+
+
 class GetRequest(Request):
     """HTTP GET request."""
     # This adds nothing to urllib, but it's there for consistency.
@@ -64,6 +102,12 @@ class PutRequest(Request):
         return 'PUT'
 
 
+class PropfindRequest(Request):
+    """WebDAV PROPFIND request."""
+    def get_method(self):
+        return 'PROPFIND'
+
+
 class DefaultTransport(object):
     """Transport to read and write files over HTTP.
 
@@ -72,6 +116,32 @@ class DefaultTransport(object):
     """
 
     timeout = get_setting('TIMEOUT')
+    connect_timeout = get_setting('CONNECT_TIMEOUT')
+    adaptive_timeout = get_setting('ADAPTIVE_TIMEOUT')
+    bandwidth = get_setting('BANDWIDTH')
+
+    # With adaptive timeouts, the time to wait for a response is this factor
+    # times the 99th percentile of the latency of the host, within bounds.
+    latency_factor = 4
+    min_timeout = 0.25
+
+    chunk_size = get_setting('CHUNK_SIZE')
+
+    # Number of times a chunked upload is resumed before giving up.
+    chunk_attempts = 3
+
+    # Requests with a body of at least expect_continue bytes ask the server
+    # whether it accepts it before sending it, and wait continue_timeout
+    # seconds for the answer.
+    expect_continue = get_setting('EXPECT_CONTINUE')
+    continue_timeout = 1
+
+    retries = get_setting('RETRIES')
+
+    # Delays between retries grow exponentially from retry_delay up to
+    # retry_max_delay seconds, with random jitter.
+    retry_delay = 0.1
+    retry_max_delay = 5
 
     def __init__(self, base_url):
         scheme, netloc, path, query, fragment = urlsplit(base_url)
@@ -89,7 +159,49 @@ class DefaultTransport(object):
 
     def _http_request(self, request):
         """Return a response object for a given request."""
-        return urlopen(request, timeout=self.timeout)
+        host = urlsplit(request.get_full_url()).netloc
+        size = len(request.data or b'')
+        if self.expect_continue is not None and size >= self.expect_continue:
+            request.add_header('Expect', '100-continue')
+        connect, send, read = self._get_timeouts(host, size)
+        return http_client.urlopen(request, connect, send, read,
+                self.bandwidth, self.continue_timeout)
+
+    def _get_timeouts(self, host, size):
+        """Return timeouts for connecting, sending and receiving a response.
+
+        size is the length of the body of the request. The timeouts are:
+
+        - connect: RESTO_CONNECT_TIMEOUT, or the read timeout if it's None;
+        - read: RESTO_TIMEOUT, or with RESTO_ADAPTIVE_TIMEOUT, a multiple of
+          the latency of the host observed recently, if it's lower;
+        - send: the read timeout plus the time to send the body at
+          RESTO_BANDWIDTH bytes per second, if it isn't None.
+        """
+        read = self.timeout
+        if self.adaptive_timeout:
+            latency = http_client.get_latency(host, 0.99)
+            if latency is not None:
+                read = min(read,
+                        max(self.min_timeout, latency * self.latency_factor))
+        connect = self.connect_timeout
+        if connect is None:
+            connect = read
+        send = read
+        if self.bandwidth:
+            send += size / float(self.bandwidth)
+        return connect, send, read
+
+    def connect(self, host):
+        """Open a connection to a host for later requests.
+
+        URLError will be raised if something goes wrong.
+        """
+        connect, send, read = self._get_timeouts(host, 0)
+        try:
+            http_client.prewarm(self.scheme, host, connect)
+        except socket.error as e:
+            raise URLError(e)
 
     ### Wrappers around HTTP methods
 
@@ -108,6 +220,27 @@ class DefaultTransport(object):
         else:
             return resp.read(int(length))
 
+    def content_range(self, host, name, start, end):
+        """Get the bytes of a file from start to end, excluded, as a string.
+
+        If the server doesn't support ranges, return the response instead, as
+        a file-like object with the whole file, which the caller must close.
+
+        URLError will be raised if something goes wrong.
+        """
+        url = self._get_url(host, name)
+        resp = self._http_request(GetRequest(url, None,
+                {'Range': 'bytes=%d-%d' % (start, end - 1)}))
+        if resp.code == 200:
+            return resp
+        if resp.code != 206:
+            raise UnexpectedStatusCode(resp)
+        content = resp.read(end - start)
+        if len(content) != end - start:
+            raise URLError("Got %d bytes instead of %d from %s." % (
+                    len(content), end - start, url))
+        return content
+
     def exists(self, host, name):
         """Check if a file exists.
 
@@ -126,6 +259,24 @@ class DefaultTransport(object):
                 raise
             return False
 
+    def digest(self, host, directory):
+        """Get the listing of a directory, with Merkle digests.
+
+        See merkle.build_listings. Return None if the directory doesn't exist.
+        This requires media servers that answer GET requests for
+        "<directory>/?digest", like TestHttpServer.
+
+        URLError will be raised if something goes wrong.
+        """
+        url = self._get_url(host, directory + '/' if directory else '')
+        try:
+            resp = self._http_request(GetRequest(url + '?digest'))
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+            return None
+        return json.loads(resp.read().decode('utf-8'))
+
     def size(self, host, name):
         """Check the size of a file.
 
@@ -146,30 +297,120 @@ class DefaultTransport(object):
     def create(self, host, name, content):
         """Create or update a file.
 
-        Return True if the file existed, False if it did not.
+        Return True if the file existed, False if it did not, and None if a
+        more recent write on the file superseded this one.
 
         URLError will be raised if something goes wrong.
         """
+        return self._retry(self._create, host, name, content)
+
+    def create_chain(self, host, name, content, downstream):
+        """Create or update a file on a host and the hosts downstream.
+
+        The host must forward the request to the hosts listed in downstream,
+        like RelayHttpServer does. Return the set of hosts where the write
+        failed, including host itself. Writes superseded by a more recent one
+        don't count as failures.
+
+        URLError will be raised if the request can't be sent.
+        """
         url = self._get_url(host, name)
-        resp = self._http_request(PutRequest(url, content))
-        if resp.code == 201:
-            return False
-        elif resp.code == 204:
-            logger.warning("PUT on existing file %s on %s.", name, host)
-            return True
-        else:
+        headers = {'X-Resto-Forward': ', '.join(downstream)}
+        sequence = http_client.get_sequence()
+        if sequence is None:
+            sequence = next_sequence(name)
+        headers['X-Resto-Sequence'] = str(sequence)
+        try:
+            resp = self._http_request(PutRequest(url, content, headers))
+        except HTTPError as e:
+            failed = set(http_client.parse_hosts(
+                    e.headers.get('X-Resto-Failed')))
+            if not _is_superseded(e, sequence):
+                failed.add(host)
+            return failed
+        if resp.code not in (201, 204):
             raise UnexpectedStatusCode(resp)
+        return set(http_client.parse_hosts(
+                resp.info().get('X-Resto-Failed')))
+
+    def received(self, host, name, total):
+        """Check how much of a chunked upload a host already has.
+
+        Return the number of bytes received so far for an upload of a file of
+        length total. The server answers a PUT with an empty body and a
+        "Content-Range: bytes */total" header with "202 Accepted" and, if it
+        holds a part of the file, a "Range: bytes=0-N" header.
+
+        URLError will be raised if something goes wrong.
+        """
+        url = self._get_url(host, name)
+        return self._query_chunked(url, total)
 
     def delete(self, host, name):
         """Delete a file.
 
-        Return True if the file existed, False if it did not.
+        Return True if the file existed, False if it did not, and None if a
+        more recent write on the file superseded this one.
 
         URLError will be raised if something goes wrong.
         """
+        return self._retry(self._delete, host, name)
+
+    ### Writes
+
+    def _retry(self, func, host, name, *args):
+        # Each write carries a sequence number in a X-Resto-Sequence header.
+        # Retrying is safe as long as no more recent write on the same file
+        # started, because the order of writes is preserved. Servers that
+        # track sequence numbers answer "409 Conflict" with the sequence
+        # number of the last write to stale writes.
+        sequence = http_client.get_sequence()
+        if sequence is None:
+            sequence = next_sequence(name)
+        headers = {'X-Resto-Sequence': str(sequence)}
+        attempt = 0
+        while True:
+            try:
+                return func(host, name, *args, headers=headers)
+            except Exception as exc:
+                if _is_superseded(exc, sequence):
+                    logger.warning("Skipped stale write on %s on %s.",
+                            name, host)
+                    return None
+                delay = min(self.retry_max_delay,
+                        self.retry_delay * 2 ** attempt) * random.random()
+                left = http_client.time_left()
+                if (attempt >= self.retries or not is_overload(exc) or
+                        (left is not None and left <= delay)):
+                    raise
+                if latest_sequence(name) > sequence:
+                    logger.warning("Abandoned retry on %s on %s after error: "
+                            "%s. A more recent write started.",
+                            name, host, exc)
+                    return None
+                logger.warning("Retrying write on %s on %s in %.2f seconds "
+                        "after error: %s.", name, host, delay, exc)
+            time.sleep(delay)
+            attempt += 1
+
+    def _create(self, host, name, content, headers):
+        url = self._get_url(host, name)
+        if self.chunk_size and len(content) > self.chunk_size:
+            resp = self._create_chunked(url, content, headers)
+        else:
+            resp = self._http_request(PutRequest(url, content, headers))
+        if resp.code == 201:
+            return False
+        elif resp.code == 204:
+            logger.warning("PUT on existing file %s on %s.", name, host)
+            return True
+        else:
+            raise UnexpectedStatusCode(resp)
+
+    def _delete(self, host, name, headers):
         url = self._get_url(host, name)
         try:
-            resp = self._http_request(DeleteRequest(url))
+            resp = self._http_request(DeleteRequest(url, None, headers))
             if resp.code not in (200, 204):
                 raise UnexpectedStatusCode(resp)
             return True
@@ -179,6 +420,247 @@ class DefaultTransport(object):
             logger.warning("DELETE on missing file %s on %s.", name, host)
             return False
 
+    ### Chunked uploads
+
+    def _query_chunked(self, url, total, headers=None):
+        headers = dict(headers or {})
+        headers['Content-Range'] = 'bytes */%d' % total
+        resp = self._http_request(PutRequest(url, b'', headers))
+        if resp.code != 202:
+            raise UnexpectedStatusCode(resp)
+        return _parse_range(resp.info().get('Range'))
+
+    def _create_chunked(self, url, content, headers):
+        # Each part is a PUT with a Content-Range header. The server answers
+        # "202 Accepted" until it has the whole file. If a part fails, ask the
+        # server how much it has and resume from there.
+        total = len(content)
+        failures = 0
+        progress = http_client.get_progress()
+        offset = self._query_chunked(url, total, headers)
+        while True:
+            end = min(offset + self.chunk_size, total)
+            part_headers = dict(headers)
+            part_headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                    offset, end - 1, total)
+            # Report the progress of the whole file rather than the part.
+            part_progress = None
+            if progress is not None:
+                part_progress = (lambda sent, length, offset=offset:
+                        progress(offset + sent, total))
+            try:
+                with http_client.operation(progress=part_progress):
+                    resp = self._http_request(
+                            PutRequest(url, content[offset:end], part_headers))
+            except (URLError, socket.error) as e:
+                failures += 1
+                if failures >= self.chunk_attempts or (
+                        isinstance(e, HTTPError) and e.code != 416):
+                    raise
+                logger.warning("Resuming upload of %s at %d bytes after "
+                        "error: %s.", url, offset, e)
+                offset = self._query_chunked(url, total, headers)
+                continue
+            if resp.code != 202:
+                return resp
+            received = _parse_range(resp.info().get('Range'))
+            if received <= offset:
+                # The server didn't store the part. Don't loop forever.
+                raise UnexpectedStatusCode(resp)
+            offset = received
+
+
+class WebDavTransport(DefaultTransport):
+    """Transport that can also list directories.
+
+    In addition to the requirements of DefaultTransport, this transport
+    expects that the target HTTP hosts implement PROPFIND according to
+    RFC4918, at least with a depth of 0 and 1.
+    """
+
+    PROPFIND_BODY = (b'<?xml version="1.0" encoding="utf-8"?>'
+        b'<D:propfind xmlns:D="DAV:"><D:prop>'
+        b'<D:resourcetype/><D:getcontentlength/><D:getlastmodified/>'
+        b'</D:prop></D:propfind>')
+
+    def listdir(self, host, path):
+        """List the contents of a directory.
+
+        Return a tuple of two lists, the subdirectories and the files.
+
+        URLError will be raised if something goes wrong.
+        """
+        directories, files = [], []
+        for name, is_dir, size, modified in self._propfind(host, path, 1):
+            (directories if is_dir else files).append(name)
+        return directories, files
+
+    def stats(self, host, path):
+        """Get the size and modification time of the files in a directory.
+
+        Return a dict mapping each file name to a (size, modified_time) tuple.
+        modified_time is a naive datetime in local time, like os.stat's.
+
+        URLError will be raised if something goes wrong.
+        """
+        return dict((name, (size, modified)) for name, is_dir, size, modified
+                in self._propfind(host, path, 1) if not is_dir)
+
+    def walk(self, host, path='', exclude=()):
+        """List the files in a directory and its subdirectories.
+
+        Generate a (name, size, modified_time) tuple for each file, with one
+        request per directory. Subdirectories whose names are in exclude
+        aren't listed.
+
+        URLError will be raised if something goes wrong.
+        """
+        path = path.strip('/')
+        directories = []
+        for name, is_dir, size, modified in self._propfind(host, path, 1):
+            name = path + '/' + name if path else name
+            if is_dir:
+                if name not in exclude:
+                    directories.append(name)
+            else:
+                yield name, size, modified
+        for directory in directories:
+            for entry in self.walk(host, directory, exclude):
+                yield entry
+
+    def modified_time(self, host, name):
+        """Get the last modification time of a file.
+
+        URLError will be raised if something goes wrong.
+        """
+        for entry_name, is_dir, size, modified in self._propfind(
+                host, name, 0):
+            return modified
+
+    def _propfind(self, host, path, depth):
+        # Generate a (name, is_dir, size, modified_time) tuple for each entry
+        # of a multistatus response. The XML is parsed as it's received and
+        # discarded as it's processed, so large directories don't use a lot of
+        # memory. With a depth of 1, the directory itself is skipped.
+        path = path.strip('/')
+        if depth:
+            path = path + '/' if path else ''
+        url = self._get_url(host, path)
+        prefix = _unquote(urlsplit(url).path)
+        resp = self._http_request(PropfindRequest(url, self.PROPFIND_BODY,
+                {'Depth': str(depth), 'Content-Type': 'application/xml'}))
+        try:
+            if resp.code != 207:
+                raise UnexpectedStatusCode(resp)
+            root = None
+            for event, elem in ElementTree.iterparse(resp, ('start', 'end')):
+                if root is None:
+                    root = elem
+                if event != 'end' or elem.tag != '{DAV:}response':
+                    continue
+                href = _unquote(urlsplit(elem.findtext('{DAV:}href')).path)
+                if depth:
+                    name = href[len(prefix):].strip('/')
+                else:
+                    name = path
+                if name or not depth:
+                    yield _parse_propstat(name, elem)
+                root.clear()
+        finally:
+            resp.close()
+
+
+def _unquote(path):
+    if isinstance(path, bytes):                             # Python 2
+        return unquote(path).decode('utf-8')
+    return unquote(path)
+
+
+def _parse_propstat(name, elem):
+    is_dir = elem.find('.//{DAV:}resourcetype/{DAV:}collection') is not None
+    size = elem.findtext('.//{DAV:}getcontentlength')
+    modified = elem.findtext('.//{DAV:}getlastmodified')
+    if size is not None:
+        size = int(size)
+    if modified is not None:
+        timestamp = email.utils.mktime_tz(email.utils.parsedate_tz(modified))
+        modified = datetime.datetime.fromtimestamp(timestamp)
+    return name, is_dir, size, modified
+
+
+def _is_superseded(exc, sequence):
+    if not isinstance(exc, HTTPError) or exc.code != 409:
+        return False
+    latest = exc.headers.get('X-Resto-Sequence')
+    return latest is not None and int(latest) > sequence
+
+
+# Sequence numbers order the writes on each file, across hosts and retries.
+# They're timestamps in microseconds, strictly increasing for each file within
+# a process, so they're consistent across processes with synchronized clocks.
+
+_sequences = {}
+
+_sequences_lock = threading.Lock()
+
+
+def next_sequence(name):
+    """Return a sequence number for a new write on a file."""
+    with _sequences_lock:
+        sequence = max(int(time.time() * 1e6), _sequences.get(name, 0) + 1)
+        if len(_sequences) >= 10000:
+            # Forget files that haven't been written to for an hour.
+            threshold = sequence - 3600 * 10 ** 6
+            for key, value in list(_sequences.items()):
+                if value < threshold:
+                    del _sequences[key]
+        _sequences[name] = sequence
+        return sequence
+
+
+def latest_sequence(name):
+    """Return the sequence number of the latest write on a file."""
+    with _sequences_lock:
+        return _sequences.get(name, 0)
+
+
+def _sha256(content):
+    """Return the SHA-256 hash of bytes or of a FileBody, in hex."""
+    digest = hashlib.sha256()
+    for start in range(0, len(content), http_client.BLOCK_SIZE):
+        digest.update(content[start:start + http_client.BLOCK_SIZE])
+    return digest.hexdigest()
+
+
+def _spill_body(content):
+    """Copy bytes or a FileBody to a new temporary file, as a FileBody."""
+    copy = tempfile.TemporaryFile()
+    for start in range(0, len(content), http_client.BLOCK_SIZE):
+        copy.write(content[start:start + http_client.BLOCK_SIZE])
+    return http_client.FileBody(copy, len(content))
+
+
+def _rotate(items, offset):
+    """Rotate a list to the left by offset items."""
+    if not items:
+        return []
+    offset %= len(items)
+    return items[offset:] + items[:offset]
+
+
+def _parse_range(value):
+    """Return the number of bytes covered by a "Range: bytes=0-N" header."""
+    if value is None:
+        return 0
+    match = re.match(r'^bytes=0-(\d+)$', value.strip())
+    if match is None:
+        raise ValueError("Invalid Range header: %r." % value)
+    return int(match.group(1)) + 1
+
+
+# Tells if get_available_name is running in the current thread.
+_reserving = threading.local()
+
 
 class DistributedStorageMixin(object):
 
@@ -186,31 +668,260 @@ class DistributedStorageMixin(object):
 
     fatal_exceptions = get_setting('FATAL_EXCEPTIONS')
     show_traceback = get_setting('SHOW_TRACEBACK')
-
-    def __init__(self, hosts=None, base_url=None, transport=DefaultTransport):
+    host_concurrency = get_setting('HOST_CONCURRENCY')
+    operation_timeout = get_setting('OPERATION_TIMEOUT')
+    webdav = get_setting('WEBDAV')
+    batch_concurrency = get_setting('BATCH_CONCURRENCY')
+    deferred_deletes = get_setting('DEFERRED_DELETES')
+    chain_replication = get_setting('CHAIN_REPLICATION')
+    prewarm = get_setting('PREWARM')
+    coalesce_reads = get_setting('COALESCE_READS')
+    zones = get_setting('ZONES')
+    local_zone = get_setting('LOCAL_ZONE')
+    health_interval = get_setting('HEALTH_INTERVAL')
+    health_path = get_setting('HEALTH_PATH')
+
+    # Maximum number of files in each batch of deferred deletes.
+    delete_batch_size = 100
+
+    # Maximum number of actions running in the background on remote zones.
+    # Beyond that, new actions wait.
+    remote_concurrency = 100
+
+    # Time to wait for memory within RESTO_MAX_INFLIGHT_BYTES before reading
+    # a body from a file rather than from memory.
+    spill_timeout = 0.1
+
+    def __init__(self, hosts=None, base_url=None, transport=None):
         if hosts is None:                                   # cover: disable
             hosts = get_setting('MEDIA_HOSTS')
         self.hosts = hosts
         if base_url is None:                                # cover: disable
             base_url = settings.MEDIA_URL
         self.base_url = base_url
+        if transport is None:
+            transport = WebDavTransport if self.webdav else DefaultTransport
         self.transport = transport(base_url=base_url)
+        trace = get_setting('TRACE')
+        self.recorder = None if trace is None else Recorder(trace)
+        self._init_deletes()
+        if self.prewarm:
+            self.warm_up()
+        if self.health_interval is not None:
+            self._get_prober()
+
+    # Deferred deletes and actions on remote zones in progress are only
+    # meaningful in the current process.
+
+    def _init_deletes(self):
+        # tombstones maps the names of files to delete to the sequence number
+        # of the delete. deleting holds the names of files being deleted.
+        self.tombstones = {}
+        self.deleting = set()
+        self.deletes_changed = threading.Condition()
+        self.drainer = None
+        self.remote_slots = threading.Semaphore(self.remote_concurrency)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('tombstones', 'deleting', 'deletes_changed', 'drainer',
+                'remote_slots'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_deletes()
+
+    def warm_up(self):
+        """Open connections to all hosts in parallel, for later requests.
+
+        Return the set of hosts that couldn't be reached. Failures are logged.
+        """
+        results, errors = map_in_threads(self.transport.connect, self.hosts,
+                len(self.hosts))
+        for host, exc in sorted(errors.items()):
+            logger.warning("Failed to connect to %s: %s.", host, exc)
+        return set(errors)
+
+    def split_hosts(self):
+        """Return the list of hosts of the local zone and of remote zones.
 
+        Without RESTO_ZONES and RESTO_LOCAL_ZONE, all hosts are local. Hosts
+        that don't belong to any zone are local too.
+        """
+        remote = set()
+        if self.zones and self.local_zone is not None:
+            for zone, hosts in self.zones.items():
+                if zone != self.local_zone:
+                    remote.update(hosts)
+        local = [host for host in self.hosts if host not in remote]
+        if not local:
+            return list(self.hosts), []
+        return local, [host for host in self.hosts if host in remote]
+
+    def choose_host(self):
+        """Return a host to read from, preferably in the local zone.
+
+        With RESTO_HEALTH_INTERVAL, prefer healthy hosts, even in remote
+        zones.
+        """
+        local, remote = self.split_hosts()
+        for hosts in local, remote:
+            healthy = self._split_healthy(hosts)[0]
+            if healthy:
+                return random.choice(healthy)
+        return random.choice(local)
+
+    def host_status(self):
+        """Return a dict mapping each host to a dict describing its health.
+
+        See Prober.status(). Without RESTO_HEALTH_INTERVAL, the hosts are
+        probed now.
+        """
+        prober = self._get_prober()
+        if self.health_interval is None:
+            prober.probe()
+        return prober.status()
+
+    def _get_prober(self):
+        return health.get_prober(self.hosts, self.transport, self.health_path,
+                self.health_interval)
+
+    def _split_healthy(self, hosts):
+        # With RESTO_HEALTH_INTERVAL, split hosts between healthy hosts and
+        # the others, see HostStatus.healthy.
+        if self.health_interval is None:
+            return list(hosts), []
+        prober = self._get_prober()
+        healthy = [host for host in hosts if prober.is_healthy(host)]
+        return healthy, [host for host in hosts if host not in healthy]
+
+    @tracing.traced(index=1)
     def execute(self, func, url, *args, **kwargs):
-        """Run an action over several hosts in parallel."""
+        """Run an action over several hosts in parallel.
+
+        The action runs in the background on the hosts of remote zones.
+
+        With RESTO_OPERATION_TIMEOUT, all the requests must complete before
+        this deadline.
+
+        Return the set of hosts where the action failed. With
+        RESTO_FATAL_EXCEPTIONS, raise an exception instead.
+        """
+        exceptions = self._execute(func, url, *args, **kwargs)
+        self._raise_fatal(exceptions)
+        return set(exceptions)
+
+    def _execute(self, func, url, *args, **kwargs):
+        # Return a dict mapping the local hosts where the action failed to
+        # the exception info. Failures are logged.
+        local, remote = self.split_hosts()
+        sequence = next_sequence(url)
+        if remote:
+            self._execute_remote(remote, sequence, func, url, *args, **kwargs)
+        return self._execute_with(local, sequence, func, url, *args, **kwargs)
+
+    def _execute_remote(self, hosts, sequence, func, url, *args, **kwargs):
+        # Run an action on the hosts of remote zones in the background, in
+        # up to remote_concurrency threads. Failures are logged. The caller
+        # releases bodies when it returns, so they're kept in memory within
+        # RESTO_MAX_INFLIGHT_BYTES until the action completes, and copied to
+        # a temporary file otherwise.
+        budget = get_budget()
+        reserved, spilled = 0, []
+        copies = []
+        priority = http_client.get_priority()
+        span = tracing.get_current_span()
+
+        def release():
+            for body in spilled:
+                body.file.close()
+            budget.release(reserved)
+            self.remote_slots.release()
+
+        def execute_remote():
+            try:
+                with http_client.operation(priority=priority), \
+                        tracing.activate(span):
+                    exceptions = self._execute_with(hosts, sequence, func,
+                            url, *copies, **kwargs)
+            finally:
+                release()
+            self._remote_done(func, url, hosts, exceptions)
+
+        self.remote_slots.acquire()
+        try:
+            for arg in args:
+                if isinstance(arg, bytes) and budget.acquire(len(arg), 0):
+                    reserved += len(arg)
+                elif isinstance(arg, (bytes, http_client.FileBody)):
+                    arg = _spill_body(arg)
+                    spilled.append(arg)
+                copies.append(arg)
+            threading.Thread(target=execute_remote).start()
+        except Exception:
+            release()
+            raise
+
+    def _remote_done(self, func, url, hosts, exceptions):
+        # Hook called once an action ran on the hosts of remote zones.
+        pass
+
+    def _execute_create(self, func, url, content, *args, **kwargs):
+        # Like _execute, for func that writes content. With chain
+        # replication, upload content once, to the first local host, which
+        # forwards it to the other local hosts. Then run func on the hosts
+        # that the chain didn't reach.
+        if not self._chains():
+            return self._execute(func, url, *args, **kwargs)
+        local, remote = self.split_hosts()
+        if remote:
+            self._execute_remote(remote, next_sequence(url), func, url,
+                    *args, **kwargs)
+        host, downstream = local[0], local[1:]
+        with http_client.operation(self._get_deadline(), next_sequence(url)):
+            try:
+                failed = self._run(self.transport.create_chain, host, url,
+                        content, downstream)
+            except Exception as exc:
+                failed = set(local)
+                logger.warning("Failed to replicate %s through %s: %s.",
+                        url, host, exc)
+        hosts = [host for host in local if host in failed]
+        if hosts:
+            logger.warning("Chain replication of %s failed on %s, uploading "
+                    "directly.", url, ', '.join(hosts))
+        return self._execute_on(hosts, func, url, *args, **kwargs)
+
+    def _chains(self):
+        # Tell if writes go through chain replication, which requires two
+        # local hosts at least.
+        return self.chain_replication and len(self.split_hosts()[0]) > 1
+
+    def _execute_on(self, hosts, func, url, *args, **kwargs):
+        return self._execute_with(hosts, next_sequence(url), func, url,
+                *args, **kwargs)
+
+    def _execute_with(self, hosts, sequence, func, url, *args, **kwargs):
         exceptions = {}
+        deadline = self._get_deadline()
+        priority = http_client.get_priority()
+        span = tracing.get_current_span()
 
         def execute_inner(host):
             try:
-                func(host, url, *args, **kwargs)
+                with http_client.operation(deadline, sequence,
+                        priority=priority), tracing.activate(span):
+                    self._run(func, host, url, *args, **kwargs)
             except Exception:
                 exceptions[host] = sys.exc_info()
 
-        if len(self.hosts) == 1:
-            execute_inner(self.hosts[0])
+        if len(hosts) == 1:
+            execute_inner(hosts[0])
         else:
             threads = [threading.Thread(target=execute_inner, args=(host,))
-                    for host in self.hosts]
+                    for host in hosts]
             for thread in threads:
                 thread.start()
             for thread in threads:
@@ -220,18 +931,180 @@ class DistributedStorageMixin(object):
             action = func.__name__
             logger.error("Failed to %s %s on %s.", action, url, host,
                     exc_info=exc_info if self.show_traceback else None)
+        return exceptions
 
+    def _raise_fatal(self, exceptions):
         if exceptions and self.fatal_exceptions:
             # Let's raise a random exception, we've logged them all anyway
             raise exceptions.popitem()[1][1]
 
+    def _get_deadline(self):
+        if self.operation_timeout is not None:
+            return time.time() + self.operation_timeout
+
+    def defer_delete(self, name):
+        """Delete a file from the media servers in the background.
+
+        Deletes are run in batches. Until a file is deleted, its name isn't
+        available for new files. Saving a file with this name cancels the
+        delete.
+        """
+        with self.deletes_changed:
+            self.tombstones[name] = next_sequence(name)
+            if self.drainer is None:
+                self.drainer = threading.Thread(target=self._drain_deletes)
+                self.drainer.daemon = True
+                self.drainer.start()
+
+    def cancel_delete(self, name):
+        """Cancel the deferred delete of a file.
+
+        If the delete is in progress, wait until it's complete.
+        """
+        with self.deletes_changed:
+            self.tombstones.pop(name, None)
+            while name in self.deleting:
+                self.deletes_changed.wait()
+
+    def flush_deletes(self, timeout=None):
+        """Wait until all deferred deletes are complete.
+
+        Return True if they're complete, False if the timeout expired first.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.deletes_changed:
+            while self.tombstones or self.deleting:
+                delay = None
+                if timeout is not None:
+                    delay = deadline - time.time()
+                    if delay <= 0:
+                        return False
+                self.deletes_changed.wait(delay)
+        return True
+
+    def _drain_deletes(self):
+        # Run deferred deletes in batches, in up to RESTO_BATCH_CONCURRENCY
+        # threads, until there are none left.
+        while True:
+            with self.deletes_changed:
+                if not self.tombstones:
+                    self.drainer = None
+                    return
+                names = list(itertools.islice(self.tombstones,
+                        self.delete_batch_size))
+                batch = [(name, self.tombstones.pop(name)) for name in names]
+                self.deleting.update(names)
+
+            def delete(job):
+                name, sequence, host = job
+                with http_client.operation(self._get_deadline(), sequence):
+                    self._run(self.transport.delete, host, name)
+
+            jobs = [(name, sequence, host)
+                    for name, sequence in batch for host in self.hosts]
+            results, errors = map_in_threads(delete, jobs,
+                    self.batch_concurrency)
+            for (name, sequence, host), exc in sorted(errors.items()):
+                logger.error("Failed to delete %s on %s: %s", name, host, exc)
+            with self.deletes_changed:
+                for name, sequence in batch:
+                    self.deleting.discard(name)
+                self.deletes_changed.notify_all()
+
+    def _is_deleted(self, name):
+        return name in self.tombstones or name in self.deleting
+
+    def get_available_name(self, name, *args, **kwargs):
+        # Files being deleted still exist for the purpose of this method.
+        _reserving.active = True
+        try:
+            return super(DistributedStorageMixin, self).get_available_name(
+                    name, *args, **kwargs)
+        finally:
+            _reserving.active = False
+
+    @contextlib.contextmanager
+    def _read_body(self, handle, size, spill=True):
+        # Yield the content of a file as a request body. It's read in memory
+        # within RESTO_MAX_INFLIGHT_BYTES. Otherwise, it's read from the file
+        # block by block, after copying it to a temporary file if spill is
+        # True, because the file may not support seeking.
+        budget = get_budget()
+        if budget.acquire(size, self.spill_timeout):
+            try:
+                with tracing.span('read_content', size=size):
+                    body = handle.read()
+                yield body
+            finally:
+                budget.release(size)
+        elif not spill:
+            yield http_client.FileBody(handle, size)
+        else:
+            with tempfile.TemporaryFile() as spilled:
+                with tracing.span('read_content', size=size):
+                    for chunk in handle.chunks():
+                        spilled.write(chunk)
+                yield http_client.FileBody(spilled, size)
+
+    def _run(self, func, host, url, *args, **kwargs):
+        # All actions on a host go through this method.
+        if self.host_concurrency is None:
+            return self._call(func, host, url, *args, **kwargs)
+        limiter = get_limiter(host, self.host_concurrency)
+        with limiter.slot(http_client.get_priority()):
+            return self._call(func, host, url, *args, **kwargs)
+
+    def _call(self, func, host, url, *args, **kwargs):
+        # All requests go through this method. They run in a span, and with
+        # RESTO_TRACE, they're recorded in the trace.
+        with tracing.span('host', host=host, action=func.__name__):
+            if self.recorder is None:
+                return func(host, url, *args, **kwargs)
+            return self._record(func, host, url, *args, **kwargs)
+
+    def _record(self, func, host, url, *args, **kwargs):
+        size = self._body_size(func, url, args)
+        start = time.time()
+        try:
+            result = func(host, url, *args, **kwargs)
+        except Exception as exc:
+            self.recorder.record(start, func.__name__, url, size, host,
+                    time.time() - start, get_outcome(exc))
+            raise
+        if size is None and isinstance(result, bytes):
+            size = len(result)
+        self.recorder.record(start, func.__name__, url, size, host,
+                time.time() - start)
+        return result
+
+    def _body_size(self, func, url, args):
+        # Return the size of the body sent by an action, or None.
+        if args and isinstance(args[0], (bytes, http_client.FileBody)):
+            return len(args[0])
+
 
 class DistributedStorage(DistributedStorageMixin, Storage):
 
     """Backend that stores files remotely over HTTP."""
 
-    def __init__(self, hosts=None, base_url=None):
-        DistributedStorageMixin.__init__(self, hosts, base_url)
+    deduplicate = get_setting('DEDUPLICATE')
+    stripe_size = get_setting('STRIPE_SIZE')
+
+    # With RESTO_DEDUPLICATE, the media servers store the contents of files
+    # under their hash in this directory.
+    blob_directory = '.resto/sha256'
+
+    def __init__(self, hosts=None, base_url=None, transport=None,
+            manifest=None):
+        DistributedStorageMixin.__init__(self, hosts, base_url, transport)
+        if manifest is None:
+            manifest = get_setting('MANIFEST')
+        self.manifest = None if manifest is None else Manifest(manifest)
+        if self.deduplicate and self.manifest is None:
+            raise ValueError("RESTO_DEDUPLICATE requires RESTO_MANIFEST.")
+        self.flights = SingleFlight()
+        self._init_locks()
         if not self.fatal_exceptions:
             logger.warning("You're using the DistributedStorage backend with "
                     "RESTO_FATAL_EXCEPTIONS = %r.", self.fatal_exceptions)
@@ -240,72 +1113,600 @@ class DistributedStorage(DistributedStorageMixin, Storage):
             logger.warning("You have been warned.")
         Storage.__init__(self)
 
+    # Reads and writes in progress are only meaningful in the current process.
+
+    def _init_locks(self):
+        # locks maps the names of files being written to a lock and the
+        # number of threads using it.
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = DistributedStorageMixin.__getstate__(self)
+        for key in ('flights', 'locks', 'locks_lock'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        DistributedStorageMixin.__setstate__(self, state)
+        self.flights = SingleFlight()
+        self._init_locks()
+
+    def _coalesce(self, operation, name, func):
+        # With RESTO_COALESCE_READS, identical reads running concurrently
+        # share a single request.
+        if not self.coalesce_reads:
+            return func()
+        return self.flights.do(operation, name, func)
+
+    @contextlib.contextmanager
+    def _writing(self, name):
+        # Reads that started before the end of a write may not see it, so
+        # later reads mustn't share their result.
+        self.flights.forget(name)
+        try:
+            yield
+        finally:
+            self.flights.forget(name)
+
+    @contextlib.contextmanager
+    def _locking(self, name):
+        # Serialize the writes on a file and their records in the manifest.
+        # With RESTO_DEDUPLICATE, linking a file to a blob and uploading it
+        # mustn't interleave with deleting the blob once nothing refers to
+        # it. This only covers the threads of the current process.
+        with self.locks_lock:
+            lock, users = self.locks.get(name, (threading.Lock(), 0))
+            self.locks[name] = lock, users + 1
+        try:
+            with lock:
+                yield
+        finally:
+            with self.locks_lock:
+                lock, users = self.locks.pop(name)
+                if users > 1:
+                    self.locks[name] = lock, users - 1
+
+    def _blob_name(self, hash):
+        return '%s/%s/%s' % (self.blob_directory, hash[:2], hash)
+
+    def _resolve(self, name):
+        # Return the name under which the media servers store a file.
+        if self.deduplicate:
+            entry = self.manifest.get(name)
+            if entry is not None and entry[1] is not None:
+                return self._blob_name(entry[1])
+        return name
+
     ### Hooks for custom storage objects
 
+    @tracing.traced
     def _open(self, name, mode='rb'):
         # Allowing writes would be doable, if we distribute the file to the
         # media servers when it's closed. Let's forbid it for now.
         if mode != 'rb':                                    # cover: disable
             raise IOError('Unsupported mode %r, use %r.' % (mode, 'rb'))
-        host = random.choice(self.hosts)
-        try:
-            return ContentFile(self.transport.content(host, name))
-        except URLError:
-            logger.error("Failed to download %s from %s.", name, host,
-                    exc_info=self.show_traceback)
-            raise
-
+        if self.stripe_size and len(self.hosts) > 1:
+            size = self.size(name)
+            if size > self.stripe_size:
+                return File(self._open_stripes(self._resolve(name), size),
+                        name)
+        name = self._resolve(name)
+
+        def content():
+            host = self.choose_host()
+            try:
+                return self._run(self.transport.content, host, name)
+            except URLError:
+                logger.error("Failed to download %s from %s.", name, host,
+                        exc_info=self.show_traceback)
+                raise
+        return ContentFile(self._coalesce('content', name, content))
+
+    def _open_stripes(self, name, size):
+        # With RESTO_STRIPE_SIZE, large files are downloaded in stripes from
+        # all the healthy hosts of the local zone, falling back to the others.
+        local, remote = self.split_hosts()
+        healthy, unhealthy = self._split_healthy(local)
+        if not healthy:
+            healthy, unhealthy = unhealthy, []
+        random.shuffle(healthy)
+        deadline = self._get_deadline()
+        priority = http_client.get_priority()
+        span = tracing.get_current_span()
+
+        def fetch(host, start, end):
+            with http_client.operation(deadline, priority=priority), \
+                    tracing.activate(span):
+                try:
+                    return self._run(self.transport.content_range, host,
+                            name, start, end)
+                except URLError:
+                    logger.error("Failed to download %s from %s.", name,
+                            host, exc_info=self.show_traceback)
+                    raise
+        return StripedReader(fetch, size, self.stripe_size, healthy,
+                unhealthy + remote)
+
+    @tracing.traced
     def _save(self, name, content):
         # It's hard to avoid buffering the whole file in memory,
         # because different threads will read it simultaneously.
-        self.execute(self.transport.create, name, content.read())
+        # Beyond RESTO_MAX_INFLIGHT_BYTES, it's buffered on disk.
+        self.cancel_delete(name)
+        with self._read_body(content, content.size) as content:
+            if self.deduplicate:
+                return self._save_blob(name, content)
+            with self._locking(name):
+                with self._writing(name):
+                    exceptions = self._execute_create(self.transport.create,
+                            name, content, content)
+                if self.manifest is not None:
+                    self._add_to_manifest(name, len(content),
+                            _sha256(content), exceptions)
+        self._raise_fatal(exceptions)
         return name
 
+    def _save_blob(self, name, content):
+        # With RESTO_DEDUPLICATE, upload the content under its hash, unless
+        # another file has the same content already.
+        hash = _sha256(content)
+        entry = self.manifest.get(name)
+        if entry is not None and entry[1] != hash:
+            self.delete(name)
+        blob = self._blob_name(hash)
+        with self._locking(blob):
+            self.cancel_delete(blob)
+            if self.manifest.link(name, len(content), hash, time.time()):
+                return name
+            with self._writing(blob):
+                exceptions = self._execute_create(self.transport.create, blob,
+                        content, content)
+            if self._add_to_manifest(name, len(content), hash, exceptions):
+                # Other files with this content, if any, weren't present on
+                # any host. They are now.
+                self.manifest.update_content(hash,
+                        self._get_statuses(exceptions))
+        self._raise_fatal(exceptions)
+        return name
+
+    def _add_to_manifest(self, name, size, hash, exceptions):
+        # Record a file after a write. Return False, without recording it,
+        # if no host stored the file.
+        statuses = self._get_statuses(exceptions)
+        if 'present' not in statuses.values():
+            return False
+        self.manifest.add(name, size, hash, time.time(), statuses)
+        return True
+
+    def _get_statuses(self, exceptions):
+        # Return the statuses of hosts after a write, for the manifest. Hosts
+        # of remote zones are 'missing' until the write completes there, see
+        # _remote_done.
+        local, remote = self.split_hosts()
+        return dict((host, 'missing' if host in exceptions or host in remote
+                else 'present') for host in self.hosts)
+
+    def _remote_done(self, func, url, hosts, exceptions):
+        # Record the writes on remote zones in the manifest, once the file
+        # was recorded.
+        if self.manifest is None or func != self.transport.create:
+            return
+        statuses = dict((host, 'missing' if host in exceptions
+                else 'present') for host in hosts)
+        with self._locking(url):
+            if self.deduplicate:
+                self.manifest.update_content(url.rpartition('/')[2],
+                        statuses)
+            else:
+                self.manifest.update(url, statuses)
+
+    def _delete_blob(self, hash):
+        # With RESTO_DEDUPLICATE, delete content once no file refers to it.
+        # Files saved since the last reference went away keep it.
+        blob = self._blob_name(hash)
+        with self._locking(blob):
+            if self.manifest.references(hash):
+                return
+            self._delete(blob)
+
+    def _no_such_file(self, name):
+        return OSError(errno.ENOENT, "No such file: %r." % name)
+
+    def _get_manifest_entry(self, name):
+        entry = self.manifest.get(name)
+        if entry is None:
+            raise self._no_such_file(name)
+        return entry
+
     ### Mandatory methods
 
     # The implementations of get_valid_name, get_available_name, and path
     # in Storage are OK for DistributedStorage.
 
+    @tracing.traced
     def delete(self, name):
-        self.execute(self.transport.delete, name)
-
+        if self.deduplicate:
+            # Failures are recorded under the name of the blob.
+            hash = self.manifest.unlink(name)
+            if hash is not None:
+                self._delete_blob(hash)
+            return
+        self._delete(name)
+
+    def _delete(self, name):
+        if self.deferred_deletes:
+            if self.manifest is not None:
+                self.manifest.remove(name, {})
+            self.defer_delete(name)
+            self.flights.forget(name)
+            return
+        with self._writing(name):
+            exceptions = self._execute(self.transport.delete, name)
+        if self.manifest is None:
+            self._raise_fatal(exceptions)
+            return
+        self.manifest.remove(name,
+                dict((host, 'orphan') for host in exceptions))
+        self._raise_fatal(exceptions)
+
+    @tracing.traced
     def exists(self, name):
-        host = random.choice(self.hosts)
+        if self._is_deleted(name):
+            return getattr(_reserving, 'active', False)
+        if self.manifest is not None:
+            return self.manifest.get(name) is not None
+
+        def exists():
+            host = self.choose_host()
+            try:
+                return self._run(self.transport.exists, host, name)
+            except URLError:
+                logger.error("Failed to check if %s exists on %s.", name,
+                        host, exc_info=self.show_traceback)
+                raise
+        return self._coalesce('exists', name, exists)
+
+    # It is not possible to implement listdir and modified_time in pure HTTP.
+    # They're available with RESTO_WEBDAV.
+
+    @tracing.traced
+    def listdir(self, path):
+        if self.manifest is not None:
+            return self.manifest.listdir(path)
+        if not hasattr(self.transport, 'listdir'):
+            return Storage.listdir(self, path)
+        host = self.choose_host()
         try:
-            return self.transport.exists(host, name)
+            return self._run(self.transport.listdir, host, path)
         except URLError:
-            logger.error("Failed to check if %s exists on %s.", name, host,
+            logger.error("Failed to list %s on %s.", path, host,
                     exc_info=self.show_traceback)
             raise
 
-    # It is not possible to implement listdir in pure HTTP. It could
-    # be done with WebDAV.
+    @tracing.traced
+    def listdir_stats(self, path):
+        """Get the size and modification time of the files in a directory.
 
-    def size(self, name):
-        host = random.choice(self.hosts)
+        Return a dict mapping each file name to a (size, modified_time) tuple,
+        with a single request. This requires RESTO_WEBDAV.
+        """
+        if not hasattr(self.transport, 'stats'):
+            raise NotImplementedError()
+        host = self.choose_host()
         try:
-            return self.transport.size(host, name)
+            return self._run(self.transport.stats, host, path)
         except URLError:
-            logger.error("Failed to get the size of %s from %s.", name, host,
+            logger.error("Failed to list %s on %s.", path, host,
                     exc_info=self.show_traceback)
             raise
 
+    @tracing.traced
+    def modified_time(self, name):
+        if self.manifest is not None:
+            mtime = self._get_manifest_entry(name)[2]
+            return datetime.datetime.fromtimestamp(mtime)
+        if not hasattr(self.transport, 'modified_time'):
+            return Storage.modified_time(self, name)
+        host = self.choose_host()
+        try:
+            return self._run(self.transport.modified_time, host, name)
+        except URLError:
+            logger.error("Failed to get the modification time of %s from %s.",
+                    name, host, exc_info=self.show_traceback)
+            raise
+
+    @tracing.traced
+    def size(self, name):
+        if self._is_deleted(name):
+            raise self._no_such_file(name)
+        if self.manifest is not None:
+            return self._get_manifest_entry(name)[0]
+
+        def size():
+            host = self.choose_host()
+            try:
+                return self._run(self.transport.size, host, name)
+            except URLError:
+                logger.error("Failed to get the size of %s from %s.", name,
+                        host, exc_info=self.show_traceback)
+                raise
+        return self._coalesce('size', name, size)
+
     def url(self, name):
-        return urljoin(self.base_url, filepath_to_uri(name))
+        return urljoin(self.base_url, filepath_to_uri(self._resolve(name)))
+
+    ### Batch lookups
+
+    @tracing.traced
+    def exists_many(self, names):
+        """Check if several files exist.
+
+        Return a dict mapping each name to True or False. Raise BatchError if
+        some files can't be checked.
+        """
+        # names may be an iterator, and it's read twice.
+        names = list(names)
+        if self.manifest is not None:
+            return dict((name, self.exists(name)) for name in names)
+        deleted = set(name for name in names if self._is_deleted(name))
+        results = dict((name, False) for name in deleted)
+        try:
+            results.update(self._lookup_many(self.transport.exists,
+                    set(names) - deleted,
+                    "Failed to check if %s exists on %s."))
+        except BatchError as exc:
+            exc.results.update(results)
+            raise
+        return results
+
+    @tracing.traced
+    def size_many(self, names):
+        """Check the size of several files.
+
+        Return a dict mapping each name to its size. Raise BatchError if the
+        size of some files can't be obtained.
+        """
+        # names may be an iterator, and it's read twice.
+        names = list(names)
+        if self.manifest is not None:
+            return self._lookup_manifest(self.size, names)
+        deleted = set(name for name in names if self._is_deleted(name))
+        errors = dict((name, self._no_such_file(name)) for name in deleted)
+        try:
+            results = self._lookup_many(self.transport.size,
+                    set(names) - deleted,
+                    "Failed to get the size of %s from %s.")
+        except BatchError as exc:
+            exc.errors.update(errors)
+            raise
+        if errors:
+            raise BatchError(results, errors)
+        return results
+
+    def _lookup_many(self, func, names, message):
+        # Lookups run in up to RESTO_BATCH_CONCURRENCY threads and are spread
+        # over the local hosts in a round robin. When a host fails to answer,
+        # the lookup moves on to the next one, and then to remote hosts.
+        # Unhealthy hosts come last.
+        names = sorted(set(names))
+        offset = random.randrange(len(self.hosts))
+        first = dict((name, offset + index)
+                for index, name in enumerate(names))
+        deadline = self._get_deadline()
+        priority = http_client.get_priority()
+        span = tracing.get_current_span()
+        local, remote = self.split_hosts()
+
+        def lookup(name):
+            hosts = _rotate(local, first[name]) + _rotate(remote, first[name])
+            healthy, unhealthy = self._split_healthy(hosts)
+            hosts = healthy + unhealthy
+            for attempt, host in enumerate(hosts):
+                try:
+                    with http_client.operation(deadline, priority=priority), \
+                            tracing.activate(span):
+                        return self._run(func, host, name)
+                except (URLError, socket.error) as exc:
+                    logger.error(message, name, host,
+                            exc_info=self.show_traceback)
+                    if attempt == len(hosts) - 1 or not is_overload(exc):
+                        raise
+
+        results, errors = map_in_threads(lookup, names, self.batch_concurrency)
+        if errors:
+            raise BatchError(results, errors)
+        return results
+
+    def _lookup_manifest(self, func, names):
+        results, errors = {}, {}
+        for name in names:
+            try:
+                results[name] = func(name)
+            except OSError as exc:
+                errors[name] = exc
+        if errors:
+            raise BatchError(results, errors)
+        return results
 
 
 class HybridStorage(DistributedStorageMixin, FileSystemStorage):
 
     """Backend that stores files both locally and remotely over HTTP."""
 
-    def __init__(self, hosts=None, base_url=None, location=None):
-        DistributedStorageMixin.__init__(self, hosts, base_url)
+    async_threshold = get_setting('ASYNC_THRESHOLD')
+    fallback_url = get_setting('FALLBACK_URL')
+    digest_cache = get_setting('DIGEST_CACHE')
+
+    # Interval between checks of the spool in wait_for_replication.
+    poll_interval = 0.05
+
+    # Only AsyncStorage can enqueue actions in a spool.
+    spool = None
+
+    def __init__(self, hosts=None, base_url=None, location=None,
+            transport=None):
+        DistributedStorageMixin.__init__(self, hosts, base_url, transport)
         FileSystemStorage.__init__(self, location, base_url)
+        self._init_pending()
+
+    # Replications in progress are only meaningful in the current process.
+
+    def _init_pending(self):
+        # pending maps names to the number of actions in progress on each
+        # host, progress maps names to the bytes sent to each host.
+        self.pending = {}
+        self.progress = {}
+        self.pending_changed = threading.Condition()
+
+    def __getstate__(self):
+        state = DistributedStorageMixin.__getstate__(self)
+        for key in ('pending', 'progress', 'pending_changed'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        DistributedStorageMixin.__setstate__(self, state)
+        self._init_pending()
 
     # Read operations can be done with FileSystemStorage. Write operations
     # must be done with FileSystemStorage and DistributedStorageMixin, in
     # this order.
 
+    def verify(self, hosts=None, tree=None):
+        """Find the files that differ between the master copy and the hosts.
+
+        Only the directories whose Merkle digests differ are listed, see
+        DefaultTransport.digest. tree is the MasterTree of the master copy,
+        which is refreshed; pass the same tree again to only hash the files
+        that changed in the meantime.
+
+        Return a (results, errors) tuple of dicts mapping each host to a list
+        of (name, difference) tuples, see merkle.compare, or to the exception
+        that prevented the verification.
+        """
+        if hosts is None:
+            hosts = self.hosts
+        if tree is None:
+            tree = MasterTree(self.location, self.digest_cache)
+        tree.refresh()
+
+        def verify_host(host):
+            def remote(directory):
+                return self._run(self.transport.digest, host, directory)
+            return list(compare(tree.listing, remote))
+        return map_in_threads(verify_host, hosts, len(hosts))
+
+    def repair(self, host, name):
+        """Make a file on a host match the master copy.
+
+        Upload the file, or delete it if it doesn't exist in the master copy.
+        URLError will be raised if something goes wrong.
+        """
+        if FileSystemStorage.exists(self, name):
+            func = self.upload
+        else:
+            func = self.transport.delete
+        with http_client.operation(self._get_deadline(), next_sequence(name)):
+            self._run(func, host, name)
+
+    def execute_async(self, func, url, *args, **kwargs):
+        """Run an action over several hosts asynchronously."""
+        with http_client.operation(sequence=next_sequence(url)):
+            for host in self.hosts:
+                self.execute_one(func, host, url, *args, **kwargs)
+
+    def _execute_remote(self, hosts, sequence, func, url, *args, **kwargs):
+        # Replicate to remote zones like AsyncStorage, so pending_hosts and
+        # RESTO_FALLBACK_URL cover them.
+        with http_client.operation(sequence=sequence):
+            for host in hosts:
+                self.execute_one(func, host, url, *args, **kwargs)
+
+    def execute_one(self, func, host, url, *args, **kwargs):
+        """Run a single action asynchronously.
+
+        If a spool is configured, the action is only enqueued, and the
+        resto_worker management command runs it in another process.
+        """
+        priority = http_client.get_priority()
+        if self.spool is not None:
+            return self.spool.put(host, url, dump_job(func, args, kwargs,
+                    http_client.get_sequence(), priority), priority)
+        deadline = self._get_deadline()
+        sequence = http_client.get_sequence()
+        span = tracing.get_current_span()
+
+        def progress(sent, total):
+            with self.pending_changed:
+                self.progress.setdefault(url, {})[host] = (sent, total)
+
+        def execute_inner():
+            try:
+                with http_client.operation(deadline, sequence, progress,
+                        priority), tracing.activate(span):
+                    self._run(func, host, url, *args, **kwargs)
+            except Exception:
+                action = func.__name__
+                logger.error("Failed to %s %s on %s.", action, url, host,
+                        exc_info=self.show_traceback)
+            finally:
+                with self.pending_changed:
+                    hosts = self.pending[url]
+                    hosts[host] -= 1
+                    if not hosts[host]:
+                        del hosts[host]
+                        self.progress.get(url, {}).pop(host, None)
+                    if not hosts:
+                        del self.pending[url]
+                        self.progress.pop(url, None)
+                    self.pending_changed.notify_all()
+
+        with self.pending_changed:
+            hosts = self.pending.setdefault(url, {})
+            hosts[host] = hosts.get(host, 0) + 1
+        return threading.Thread(target=execute_inner).start()
+
+    def pending_hosts(self, name):
+        """Return the set of hosts where the replication of a file is pending.
+
+        Failed replications aren't pending; they're logged.
+        """
+        if self.spool is not None:
+            return self.spool.pending(name)
+        with self.pending_changed:
+            return set(self.pending.get(name, ()))
+
+    def replication_progress(self, name):
+        """Return the progress of the replication of a file.
+
+        Return a dict mapping each host where an upload is in progress to a
+        (bytes sent, total bytes) tuple. Uploads run by resto_worker aren't
+        tracked.
+        """
+        with self.pending_changed:
+            return dict(self.progress.get(name, {}))
+
+    def wait_for_replication(self, name, timeout=None):
+        """Wait until a file is replicated on all hosts.
+
+        Return True if the replication is complete, False if the timeout
+        expired first.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.pending_changed:
+            while self.pending_hosts(name):
+                delay = None if self.spool is None else self.poll_interval
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    if delay is None or delay > remaining:
+                        delay = remaining
+                self.pending_changed.wait(delay)
+        return True
+
     ### Hooks for custom storage objects
 
     def _open(self, name, mode='rb'):
@@ -314,45 +1715,80 @@ class HybridStorage(DistributedStorageMixin, FileSystemStorage):
             raise IOError('Unsupported mode %r, use %r.' % (mode, 'rb'))
         return FileSystemStorage._open(self, name, mode)
 
+    @tracing.traced
     def _save(self, name, content):
         name = FileSystemStorage._save(self, name, content)
+        self.cancel_delete(name)
         # After this line, we will assume that 'name' is available on the
         # media servers. This could be wrong if a delete for this file name
         # failed at some point in the past.
-        self.execute(self.upload, name)
+        if (self.async_threshold is not None and
+                FileSystemStorage.size(self, name) >= self.async_threshold):
+            self.execute_async(self.upload, name)
+        elif self._chains():
+            with self.open(name) as handle:
+                with self._read_body(handle, handle.size, False) as content:
+                    exceptions = self._execute_create(self.upload, name,
+                            content)
+            self._raise_fatal(exceptions)
+        else:
+            self.execute(self.upload, name)
         return name
 
+    def _body_size(self, func, url, args):
+        if func == self.upload:
+            try:
+                return FileSystemStorage.size(self, url)
+            except OSError:
+                return None
+        return DistributedStorageMixin._body_size(self, func, url, args)
+
     # Make this a separate method so it can be passed to a task queue.
     def upload(self, host, name):
         with self.open(name) as handle:
-            self.transport.create(host, name, handle.read())
+            with self._read_body(handle, handle.size, False) as content:
+                self.transport.create(host, name, content)
 
     ### Mandatory methods
 
-    # The implementations of get_valid_name, get_available_name, path, exists,
-    # listdir, size, and url in FileSystemStorage are OK for HybridStorage.
+    # The implementations of get_valid_name, path, listdir, and size in
+    # FileSystemStorage are OK for HybridStorage.
 
+    @tracing.traced
     def delete(self, name):
         FileSystemStorage.delete(self, name)
-        self.execute(self.transport.delete, name)
+        if self.deferred_deletes:
+            self.defer_delete(name)
+        else:
+            self.execute(self.transport.delete, name)
+
+    def exists(self, name):
+        if self._is_deleted(name) and getattr(_reserving, 'active', False):
+            return True
+        return FileSystemStorage.exists(self, name)
+
+    def url(self, name):
+        # Until the media servers have the file, let the application servers
+        # serve it from the master copy, if they're configured to.
+        if self.fallback_url is not None and self.pending_hosts(name):
+            return urljoin(self.fallback_url, filepath_to_uri(name))
+        return FileSystemStorage.url(self, name)
 
 
 class AsyncStorage(HybridStorage):
 
     """Backend that stores files both locally and remotely over HTTP."""
 
+    # Chain replication waits until the file reaches all hosts.
+    chain_replication = False
+
+    def __init__(self, hosts=None, base_url=None, location=None, spool=None,
+            transport=None):
+        HybridStorage.__init__(self, hosts, base_url, location, transport)
+        if spool is None:
+            spool = get_setting('SPOOL')
+        self.spool = None if spool is None else Spool(spool)
+
     def execute(self, func, url, *args, **kwargs):
         """Run an action over several hosts asynchronously."""
-        for host in self.hosts:
-            self.execute_one(func, host, url, *args, **kwargs)
-
-    def execute_one(self, func, host, url, *args, **kwargs):
-        """Run a single action asynchronously."""
-        def execute_inner():
-            try:
-                func(host, url, *args, **kwargs)
-            except Exception:
-                action = func.__name__
-                logger.error("Failed to %s %s on %s.", action, url, host,
-                        exc_info=self.show_traceback)
-        return threading.Thread(target=execute_inner).start()
+        return self.execute_async(func, url, *args, **kwargs)
@@ -0,0 +1,156 @@
+"""Downloads of large files in stripes fetched concurrently from several media
+servers, used by DistributedStorage.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import threading
+
+
+class StripedReader(object):
+
+    """Read-only file that downloads its content in stripes.
+
+    fetch(host, start, end) returns the bytes of the file from start to end,
+    excluded. Stripes are fetched concurrently, up to one per host ahead of
+    the reader, and returned in order. The stripes are spread over hosts in a
+    round robin; a stripe that fails is fetched again from the next host, and
+    then from fallback_hosts, before read() raises the last error. Since the
+    rest of the file can't be read past a missing stripe, later calls to
+    read() raise this error again.
+
+    If a host doesn't support ranges, fetch returns a file-like object with
+    the whole file instead. Then the reader stops fetching stripes and reads
+    the rest of the file from this object.
+    """
+
+    def __init__(self, fetch, size, stripe_size, hosts, fallback_hosts=()):
+        self.fetch = fetch
+        self.size = size
+        self.stripe_size = stripe_size
+        self.hosts = list(hosts)
+        self.fallback_hosts = list(fallback_hosts)
+        self.count = (size + stripe_size - 1) // stripe_size
+        # stripes maps the index of each stripe fetched, but not read yet, to
+        # its content, to a file with the whole content or to an exception.
+        self.stripes = {}
+        self.started = 0
+        self.index = 0
+        # chunk holds the bytes being read, from offset on.
+        self.chunk = b''
+        self.offset = 0
+        # stream is the file with the whole content, once a host sent it.
+        self.stream = None
+        self.error = None
+        self.closed = False
+        self.condition = threading.Condition()
+        with self.condition:
+            self._start_fetches()
+
+    def _start_fetches(self):
+        while (self.started < self.count and
+                self.started < self.index + len(self.hosts)):
+            thread = threading.Thread(target=self._fetch,
+                    args=(self.started,))
+            thread.daemon = True
+            thread.start()
+            self.started += 1
+
+    def _fetch(self, index):
+        start = index * self.stripe_size
+        end = min(start + self.stripe_size, self.size)
+        offset = index % len(self.hosts)
+        hosts = self.hosts[offset:] + self.hosts[:offset] + self.fallback_hosts
+        for host in hosts:
+            try:
+                result = self.fetch(host, start, end)
+                break
+            except Exception as exc:
+                result = exc
+        with self.condition:
+            if self.closed or self.stream is not None:
+                _close(result)
+                return
+            self.stripes[index] = result
+            self.condition.notify_all()
+
+    def _next_stripe(self):
+        # Return the content of the next stripe, or switch to reading the
+        # rest of the file from stream and return b''.
+        with self.condition:
+            while self.index not in self.stripes:
+                self.condition.wait()
+            result = self.stripes.pop(self.index)
+            if isinstance(result, Exception):
+                raise result
+            if isinstance(result, bytes):
+                self.index += 1
+                self._start_fetches()
+                return result
+            self.stream = result
+            self.started = self.count
+            for other in self.stripes.values():
+                _close(other)
+            self.stripes.clear()
+        # Skip the part of the file that was already read.
+        skip = self.index * self.stripe_size
+        while skip > 0:
+            data = self.stream.read(min(skip, self.stripe_size))
+            if not data:
+                raise IOError("Unexpected end of file.")
+            skip -= len(data)
+        return b''
+
+    def _next_chunk(self):
+        # Return the next bytes of the file, or b'' at the end of the file.
+        try:
+            if self.stream is None and self.index < self.count:
+                chunk = self._next_stripe()
+                if chunk:
+                    return chunk
+            if self.stream is not None:
+                return self.stream.read(self.stripe_size)
+            return b''
+        except Exception as exc:
+            self.error = exc
+            raise
+
+    def read(self, size=-1):
+        """Read up to size bytes, or until the end of the file."""
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if self.error is not None:
+            raise self.error
+        if size is None or size < 0:
+            size = self.size
+        parts = []
+        while size > 0:
+            if self.offset >= len(self.chunk):
+                self.chunk, self.offset = self._next_chunk(), 0
+                if not self.chunk:
+                    break
+            data = self.chunk[self.offset:self.offset + size]
+            self.offset += len(data)
+            size -= len(data)
+            parts.append(data)
+        return b''.join(parts)
+
+    def close(self):
+        """Stop fetching stripes. Fetches in progress complete anyway."""
+        with self.condition:
+            self.closed = True
+            self.started = self.count
+            for result in self.stripes.values():
+                _close(result)
+            self.stripes.clear()
+            self.chunk = b''
+            if self.stream is not None:
+                self.stream.close()
+
+
+def _close(result):
+    # Close a file with the whole content, returned by fetch.
+    if hasattr(result, 'close'):
+        result.close()
@@ -1,8 +1,24 @@
 from __future__ import unicode_literals
 
+from .concurrency import HostLimiterTestCase, HostConcurrencyTestCase
+from .concurrency import DistributedStorageHostConcurrencyTestCase
+from .concurrency import SingleFlightTestCase, CoalescedReadsTestCase
+from .concurrency import ByteBudgetTestCase
+from .concurrency import DistributedStorageMaxInflightBytesTestCase
+from .concurrency import AsyncStorageMaxInflightBytesTestCase
+from .health import DistributedStorageHealthWithTwoServersTestCase
+from .http_client import HttpClientTestCase, TimeoutsTestCase
+from .http_client import ConnectionPoolTestCase, OperationTimeoutTestCase
+from .http_client import ExpectContinueTestCase
+from .http_client import AddressCacheTestCase, WarmUpTestCase
 from .http_server import HttpServerTestCase
+from .manifest import ManifestTestCase, ManifestStorageTestCase
+from .manifest import DeduplicatingStorageTestCase
+from .merkle import MerkleTestCase, MasterTreeTestCase
+from .merkle import HybridStorageVerifyWithTwoServersTestCase
 from .regression import RegressionTestCase
 from .settings import SettingsTestCase
+from .spool import SpoolTestCase, SpooledAsyncStorageTestCase
 from .storage import DistributedStorageTestCase
 from .storage import HybridStorageTestCase
 from .storage import AsyncStorageTestCase
@@ -12,3 +28,23 @@ from .storage import AsyncStorageWithTwoServersTestCase
 from .storage import DistributedStorageMiscTestCase
 from .storage import HybridStorageMiscTestCase
 from .storage import AsyncStorageMiscTestCase
+from .storage import DistributedStorageChunkedUploadTestCase
+from .storage import HybridStorageChunkedUploadWithTwoServersTestCase
+from .storage import AsyncStorageReplicationLagTestCase
+from .storage import HybridStorageRetryTestCase
+from .storage import HybridStorageSizeTierTestCase
+from .storage import DistributedStorageChainReplicationTestCase
+from .storage import HybridStorageChainReplicationTestCase
+from .storage import DistributedStorageBatchLookupWithTwoServersTestCase
+from .storage import DistributedStorageWebDavTestCase
+from .storage import DistributedStorageDeferredDeleteTestCase
+from .storage import HybridStorageDeferredDeleteTestCase
+from .storage import DistributedStorageStripesWithTwoServersTestCase
+from .storage import DistributedStorageZonesTestCase
+from .storage import HybridStorageZonesTestCase
+from .trace import DistributedStorageTraceTestCase
+from .trace import HybridStorageTraceTestCase, ReplayTestCase
+from .tracing import TracingTestCase
+from .tracing import DistributedStorageTracingWithTwoServersTestCase
+from .tracing import HybridStorageTracingTestCase
+from .watcher import WatcherTestCase
@@ -0,0 +1,406 @@
+from __future__ import unicode_literals
+
+import socket
+import threading
+import time
+try:
+    from urllib.request import HTTPError
+except ImportError:
+    from urllib2 import HTTPError
+
+from django.core.files.base import ContentFile
+from django.utils import unittest
+
+from .. import concurrency
+from ..concurrency import (ByteBudget, HostLimiter, SingleFlight, get_stats,
+        is_overload)
+from ..http_client import get_priority, operation
+from .storage import (StorageUtilitiesMixin,
+        StorageUtilitiesWithTwoServersMixin, UseAsyncStorageMixin,
+        UseDistributedStorageMixin, UseHybridStorageMixin)
+
+
+class HostLimiterTestCase(unittest.TestCase):
+
+    def test_is_overload(self):
+        self.assertTrue(is_overload(socket.timeout()))
+        self.assertTrue(is_overload(HTTPError('/', 503, 'Busy', {}, None)))
+        self.assertFalse(is_overload(HTTPError('/', 403, 'Forbidden', {}, None)))
+        self.assertFalse(is_overload(ValueError()))
+
+    def test_additive_increase(self):
+        limiter = HostLimiter(4)
+        self.assertEqual(limiter.stats()['limit'], 2)
+        # 2 + 1/2 + 1/2.5 + 1/2.9 > 3
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(0.01)
+        self.assertEqual(limiter.stats()['limit'], 3)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(0.01)
+        self.assertEqual(limiter.stats()['limit'], 4)
+
+    def test_slow_requests_dont_increase(self):
+        limiter = HostLimiter(4)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(limiter.latency_target + 1)
+        self.assertEqual(limiter.stats()['limit'], 2)
+
+    def test_multiplicative_decrease(self):
+        limiter = HostLimiter(16)
+        with self.assertRaises(socket.timeout):
+            with limiter.slot():
+                raise socket.timeout()
+        self.assertEqual(limiter.stats()['limit'], 4)
+        for _ in range(5):
+            limiter.acquire()
+            limiter.release(0.01, overloaded=True)
+        self.assertEqual(limiter.stats()['limit'], 1)
+
+    def test_queueing(self):
+        limiter = HostLimiter(1)
+        limiter.acquire()
+        thread = threading.Thread(target=limiter.acquire)
+        thread.start()
+        while not limiter.stats()['waiting']:
+            time.sleep(0.001)
+        time.sleep(0.01)
+        limiter.release(0.01)
+        thread.join()
+        stats = limiter.stats()
+        self.assertEqual(stats['in_flight'], 1)
+        self.assertEqual(stats['acquired'], 2)
+        self.assertTrue(stats['max_wait'] >= 0.01)
+
+    def wait_in_threads(self, limiter, priorities, delay=0):
+        # Queue a request for each priority, in order, every delay seconds,
+        # and return a list that records the order in which they're served.
+        served = []
+
+        def target(priority):
+            with limiter.slot(priority):
+                served.append(priority)
+        threads = []
+        for index, priority in enumerate(priorities):
+            thread = threading.Thread(target=target, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            while limiter.stats()['waiting'] <= index:
+                time.sleep(0.001)
+            time.sleep(delay)
+        return served, threads
+
+    def test_priority_lanes(self):
+        limiter = HostLimiter(1)
+        limiter.acquire()
+        served, threads = self.wait_in_threads(limiter,
+                ['bulk', 'normal', 'interactive', 'normal'])
+        limiter.release(0.01)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(served, ['interactive', 'normal', 'normal', 'bulk'])
+        lanes = limiter.stats()['lanes']
+        self.assertEqual(lanes['normal']['acquired'], 3)
+        self.assertEqual(lanes['bulk']['acquired'], 1)
+        self.assertEqual(lanes['bulk']['in_flight'], 0)
+
+    def test_bulk_share(self):
+        limiter = HostLimiter(8)
+        limiter.acquire('bulk')
+        limiter.acquire('bulk')
+        # Bulk requests can't take more than half of the limit of 4.
+        served, threads = self.wait_in_threads(limiter, ['bulk'])
+        limiter.acquire('interactive')
+        self.assertEqual(served, [])
+        self.assertEqual(limiter.stats()['lanes']['bulk']['waiting'], 1)
+        limiter.release(0.01, priority='bulk')
+        threads[0].join()
+        self.assertEqual(served, ['bulk'])
+
+    def test_aging(self):
+        limiter = HostLimiter(1)
+        limiter.aging = 0.01
+        limiter.acquire()
+        served, threads = self.wait_in_threads(limiter,
+                ['bulk', 'interactive'], delay=0.03)
+        limiter.release(0.01)
+        for thread in threads:
+            thread.join()
+        # The bulk request waited long enough to go first.
+        self.assertEqual(served, ['bulk', 'interactive'])
+
+    def test_operation_priority(self):
+        self.assertEqual(get_priority(), 'normal')
+        with operation(priority='bulk'):
+            self.assertEqual(get_priority(), 'bulk')
+            with operation(deadline=time.time() + 1):
+                self.assertEqual(get_priority(), 'bulk')
+        self.assertEqual(get_priority(), 'normal')
+        with self.assertRaises(ValueError):
+            with operation(priority='urgent'):
+                pass
+
+
+class HostConcurrencyTestCase(
+        UseHybridStorageMixin, StorageUtilitiesWithTwoServersMixin,
+        unittest.TestCase):
+
+    def setUp(self):
+        super(HostConcurrencyTestCase, self).setUp()
+        self.storage.host_concurrency = 2
+        concurrency._limiters.clear()
+
+    def test_save(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEachServerLogIs([('PUT', '/test.txt', 201)])
+        stats = get_stats()
+        self.assertEqual(set(stats), set(self.storage.hosts))
+        for host_stats in stats.values():
+            self.assertEqual(host_stats['acquired'], 1)
+            self.assertEqual(host_stats['in_flight'], 0)
+
+    def test_save_overloaded(self):
+        self.storage.host_concurrency = 4
+        self.http_server.override_code = 503
+        self.assertRaises(HTTPError, self.storage.save, 'test.txt',
+                ContentFile(b'test'))
+        stats = get_stats()
+        self.assertEqual(stats['%s:%d' % (self.host, self.port)]['limit'], 1)
+        self.assertEqual(stats['%s:%d' % (self.host, self.port + 1)]['limit'], 2)
+
+    def test_save_with_priority(self):
+        with operation(priority='bulk'):
+            self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEachServerLogIs([('PUT', '/test.txt', 201)])
+        for host_stats in get_stats().values():
+            self.assertEqual(host_stats['lanes']['bulk']['acquired'], 1)
+            self.assertEqual(host_stats['lanes']['normal']['acquired'], 0)
+
+
+class DistributedStorageHostConcurrencyTestCase(
+        UseDistributedStorageMixin, StorageUtilitiesWithTwoServersMixin,
+        unittest.TestCase):
+
+    def setUp(self):
+        super(DistributedStorageHostConcurrencyTestCase, self).setUp()
+        self.storage.host_concurrency = 2
+        concurrency._limiters.clear()
+
+    def test_reads(self):
+        self.create_file('test.txt', b'test')
+        self.assertTrue(self.storage.exists('test.txt'))
+        self.assertEqual(self.storage.size('test.txt'), 4)
+        self.assertEqual(self.storage.open('test.txt').read(), b'test')
+        stats = get_stats()
+        self.assertEqual(sum(host_stats['acquired']
+                for host_stats in stats.values()), 3)
+        for host_stats in stats.values():
+            self.assertEqual(host_stats['in_flight'], 0)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def slow_call(self, result):
+        self.calls.append(result)
+        self.started.set()
+        self.release.wait()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def run_in_thread(self, operation, name, result):
+        results = []
+
+        def target():
+            try:
+                results.append(self.flights.do(
+                        operation, name, self.slow_call, result))
+            except Exception as exc:
+                results.append(exc)
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread, results
+
+    def test_share_result(self):
+        thread, results = self.run_in_thread('size', 'a.txt', 4)
+        self.started.wait()
+        other, other_results = self.run_in_thread('size', 'a.txt', 5)
+        time.sleep(0.01)
+        self.release.set()
+        thread.join()
+        other.join()
+        self.assertEqual(self.calls, [4])
+        self.assertEqual(results + other_results, [4, 4])
+        self.assertEqual(self.flights.calls, {})
+
+    def test_share_exception(self):
+        error = ValueError()
+        thread, results = self.run_in_thread('size', 'a.txt', error)
+        self.started.wait()
+        other, other_results = self.run_in_thread('size', 'a.txt', 5)
+        time.sleep(0.01)
+        self.release.set()
+        thread.join()
+        other.join()
+        self.assertEqual(results + other_results, [error, error])
+
+    def test_different_calls(self):
+        self.release.set()
+        self.assertEqual(self.flights.do('size', 'a.txt', self.slow_call, 1), 1)
+        self.assertEqual(self.flights.do('size', 'a.txt', self.slow_call, 2), 2)
+        self.assertEqual(self.flights.do('exists', 'a.txt', len, 'abc'), 3)
+
+    def test_forget(self):
+        thread, results = self.run_in_thread('size', 'a.txt', 4)
+        self.started.wait()
+        self.flights.forget('a.txt')
+        self.release.set()
+        self.assertEqual(self.flights.do('size', 'a.txt', self.slow_call, 5), 5)
+        thread.join()
+        self.assertEqual(self.calls, [4, 5])
+        self.assertEqual(self.flights.calls, {})
+
+
+class CoalescedReadsTestCase(
+        UseDistributedStorageMixin, StorageUtilitiesMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(CoalescedReadsTestCase, self).setUp()
+        self.storage.coalesce_reads = True
+        self.release = threading.Event()
+        get_file = self.http_server.get_file
+
+        def slow_get_file(name):
+            self.release.wait()
+            return get_file(name)
+        self.http_server.get_file = slow_get_file
+
+    def tearDown(self):
+        self.release.set()
+        super(CoalescedReadsTestCase, self).tearDown()
+
+    def run_concurrently(self, func, *args):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func(*args)))
+                for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # Let the threads wait for the first request.
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_exists(self):
+        self.create_file('test.txt', b'test')
+        self.assertEqual(self.run_concurrently(self.storage.exists, 'test.txt'),
+                [True] * 5)
+        self.assertServerLogIs([('HEAD', '/test.txt', 200)])
+
+    def test_concurrent_open(self):
+        self.create_file('test.txt', b'test')
+        files = self.run_concurrently(self.storage.open, 'test.txt')
+        self.assertEqual([f.read() for f in files], [b'test'] * 5)
+        self.assertServerLogIs([('GET', '/test.txt', 200)])
+
+    def test_sequential_reads(self):
+        # Results aren't cached once the request is complete.
+        self.release.set()
+        self.create_file('test.txt', b'test')
+        self.storage.size('test.txt')
+        self.storage.size('test.txt')
+        self.assertServerLogIs([('HEAD', '/test.txt', 200),
+                                ('HEAD', '/test.txt', 200)])
+
+
+class ByteBudgetTestCase(unittest.TestCase):
+
+    def test_acquire_and_release(self):
+        budget = ByteBudget(10)
+        self.assertTrue(budget.acquire(6))
+        self.assertTrue(budget.acquire(4))
+        self.assertEqual(budget.stats()['in_use'], 10)
+        budget.release(6)
+        budget.release(4)
+        self.assertEqual(budget.stats()['in_use'], 0)
+        self.assertEqual(budget.stats()['acquired'], 2)
+
+    def test_no_limit(self):
+        budget = ByteBudget(None)
+        self.assertTrue(budget.acquire(10 ** 12, 0))
+
+    def test_too_large(self):
+        budget = ByteBudget(10)
+        self.assertFalse(budget.acquire(11))
+        self.assertEqual(budget.stats()['refused'], 1)
+
+    def test_timeout(self):
+        budget = ByteBudget(10)
+        budget.acquire(6)
+        self.assertFalse(budget.acquire(6, 0.01))
+        self.assertTrue(budget.stats()['max_wait'] >= 0.01)
+
+    def test_wait(self):
+        budget = ByteBudget(10)
+        budget.acquire(6)
+        thread = threading.Thread(target=budget.acquire, args=(6,))
+        thread.start()
+        while not budget.stats()['waiting']:
+            time.sleep(0.001)
+        budget.release(6)
+        thread.join()
+        self.assertEqual(budget.stats()['in_use'], 6)
+
+
+class MaxInflightBytesTestCaseMixin(object):
+
+    def setUp(self):
+        super(MaxInflightBytesTestCaseMixin, self).setUp()
+        concurrency._budget = ByteBudget(8)
+        self.storage.spill_timeout = 0.01
+
+    def tearDown(self):
+        concurrency._budget = None
+        super(MaxInflightBytesTestCaseMixin, self).tearDown()
+
+    def test_save_within_budget(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.get_file('test.txt'), b'test')
+        stats = concurrency.get_budget().stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['refused'], 0)
+
+    def test_save_beyond_budget(self):
+        self.storage.save('test.txt', ContentFile(b'large file'))
+        self.assertEqual(self.get_file('test.txt'), b'large file')
+        stats = concurrency.get_budget().stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['acquired'], 0)
+
+    def test_save_chunked_beyond_budget(self):
+        self.storage.transport.chunk_size = 4
+        self.storage.save('test.txt', ContentFile(b'large file'))
+        self.assertEqual(self.get_file('test.txt'), b'large file')
+
+
+class DistributedStorageMaxInflightBytesTestCase(
+        UseDistributedStorageMixin, MaxInflightBytesTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    pass
+
+
+class AsyncStorageMaxInflightBytesTestCase(
+        UseAsyncStorageMixin, MaxInflightBytesTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    pass
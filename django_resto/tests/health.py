@@ -0,0 +1,168 @@
+from __future__ import unicode_literals
+
+import json
+import logging
+import time
+
+from django.core.files.storage import FileSystemStorage
+from django.http import Http404
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import unittest
+
+from .. import health
+from ..views import host_status
+from .storage import StorageUtilitiesWithTwoServersMixin
+from .storage import UseDistributedStorageMixin
+
+
+class HealthTestCaseMixin(object):
+
+    def setUp(self):
+        super(HealthTestCaseMixin, self).setUp()
+        self.storage.health_interval = 3600
+        # Register a prober that doesn't run in the background, in order to
+        # probe at will.
+        self.prober = health.get_prober(self.storage.hosts,
+                self.storage.transport, self.storage.health_path, None)
+        logging.getLogger('django_resto.health').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('django_resto.health').removeHandler(self.handler)
+        health.clear_probers()
+        super(HealthTestCaseMixin, self).tearDown()
+
+    def fail_probes(self, *servers):
+        # Make enough probes fail in a row for the servers to be unhealthy.
+        failures = health.HostStatus.failures_to_unhealthy
+        for server in servers:
+            server.unavailable = failures
+        for _ in range(failures):
+            self.prober.probe()
+
+
+class DistributedStorageHealthWithTwoServersTestCase(
+        UseDistributedStorageMixin, HealthTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    def test_probe(self):
+        self.prober.probe()
+        status = self.storage.host_status()
+        self.assertEqual(sorted(status), ['localhost:4080', 'localhost:4081'])
+        for host in status.values():
+            self.assertTrue(host['healthy'])
+            self.assertEqual(host['failures'], 0)
+            self.assertTrue(host['latency'] >= 0)
+            self.assertIsNotNone(host['last_success'])
+            self.assertIsNone(host['last_failure'])
+            self.assertEqual(host['error_rate'], 0)
+        self.assertEachServerLogIs([('HEAD', '/.resto/health', 404)])
+
+    def test_unhealthy_host(self):
+        self.alt_http_server.unavailable = 1
+        self.prober.probe()
+        status = self.storage.host_status()['localhost:4081']
+        # A single failure doesn't make a host unhealthy.
+        self.assertTrue(status['healthy'])
+        self.assertEqual(status['failures'], 1)
+        self.assertIn('503', status['error'])
+        self.assertEqual(self.get_log(), "")
+        self.fail_probes(self.alt_http_server)
+        status = self.storage.host_status()['localhost:4081']
+        self.assertFalse(status['healthy'])
+        self.assertEqual(status['failures'], 3)
+        self.assertEqual(status['error_rate'], 1)
+        self.assertIn("localhost:4081 is unhealthy", self.get_log())
+        self.prober.probe()
+        status = self.storage.host_status()['localhost:4081']
+        self.assertTrue(status['healthy'])
+        self.assertEqual(status['failures'], 0)
+        self.assertEqual(status['error_rate'], 0.75)
+        self.assertIn("localhost:4081 is healthy again", self.get_log())
+
+    def test_intermittent_failures(self):
+        for _ in range(3):
+            self.alt_http_server.unavailable = 1
+            self.prober.probe()
+            self.prober.probe()
+        status = self.storage.host_status()['localhost:4081']
+        self.assertTrue(status['healthy'])
+        self.assertEqual(status['error_rate'], 0.5)
+        self.assertEqual(self.get_log(), "")
+
+    def test_reads_avoid_unhealthy_hosts(self):
+        self.create_file('test.txt', b'test')
+        self.fail_probes(self.alt_http_server)
+        for _ in range(5):
+            self.assertEqual(self.storage.size('test.txt'), 4)
+        self.assertEqual(self.storage.exists_many(['test.txt', 'a.txt']),
+                {'test.txt': True, 'a.txt': False})
+        self.assertAltServerLogIs([('HEAD', '/.resto/health', 503)] * 2)
+
+    def test_all_hosts_unhealthy(self):
+        self.create_file('test.txt', b'test')
+        self.fail_probes(self.http_server, self.alt_http_server)
+        self.assertEqual(self.storage.size('test.txt'), 4)
+
+    def test_host_status_without_interval(self):
+        self.storage.health_interval = None
+        self.assertTrue(self.storage.host_status()['localhost:4080']['healthy'])
+        self.assertEachServerLogIs([('HEAD', '/.resto/health', 404)])
+
+    def test_background_probes(self):
+        prober = health.Prober(self.storage.hosts, self.storage.transport,
+                self.storage.health_path, 0.01)
+        prober.start()
+        try:
+            while len(self.alt_http_server.log) < 2:
+                time.sleep(0.01)
+        finally:
+            prober.stop()
+        self.assertFalse(prober.running)
+        self.assertTrue(prober.is_healthy('localhost:4081'))
+
+    def test_host_status_view(self):
+        request = RequestFactory().get('/resto/status')
+        response = host_status(request, self.storage)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        content = json.loads(response.content.decode('utf-8'))
+        self.assertTrue(content['healthy'])
+        self.assertFalse(content['degraded'])
+        self.assertEqual(sorted(content['hosts']),
+                ['localhost:4080', 'localhost:4081'])
+
+    def test_host_status_view_degraded(self):
+        self.fail_probes(self.alt_http_server)
+        request = RequestFactory().get('/resto/status')
+        response = host_status(request, self.storage)
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content.decode('utf-8'))
+        self.assertFalse(content['healthy'])
+        self.assertTrue(content['degraded'])
+        self.assertFalse(content['hosts']['localhost:4081']['healthy'])
+
+    def test_host_status_view_unavailable(self):
+        self.fail_probes(self.http_server, self.alt_http_server)
+        request = RequestFactory().get('/resto/status')
+        response = host_status(request, self.storage)
+        self.assertEqual(response.status_code, 503)
+        content = json.loads(response.content.decode('utf-8'))
+        self.assertFalse(content['healthy'])
+        self.assertFalse(content['degraded'])
+
+    def test_host_status_view_max_unhealthy(self):
+        self.fail_probes(self.alt_http_server)
+        request = RequestFactory().get('/resto/status')
+        response = host_status(request, self.storage, max_unhealthy=0)
+        self.assertEqual(response.status_code, 503)
+        with override_settings(RESTO_HEALTH_MAX_UNHEALTHY=0):
+            response = host_status(request, self.storage)
+        self.assertEqual(response.status_code, 503)
+        response = host_status(request, self.storage, max_unhealthy=1)
+        self.assertEqual(response.status_code, 200)
+
+    def test_host_status_view_other_storage(self):
+        request = RequestFactory().get('/resto/status')
+        with self.assertRaises(Http404):
+            host_status(request, FileSystemStorage())
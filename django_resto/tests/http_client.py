@@ -0,0 +1,358 @@
+from __future__ import unicode_literals
+
+import socket
+import time
+try:
+    import http.client as httplib
+    from urllib.request import URLError
+except ImportError:
+    import httplib
+    from urllib2 import URLError
+
+from django.core.files.base import ContentFile
+from django.utils import unittest
+
+from .. import http_client
+from ..http_client import get_latency, operation, record_latency
+from ..storage import DefaultTransport, GetRequest, HeadRequest, PutRequest
+from .http_server import HttpServerTestCaseMixin
+from .storage import StorageUtilitiesMixin, UseDistributedStorageMixin
+
+
+class HttpClientTestCase(HttpServerTestCaseMixin, unittest.TestCase):
+
+    def tearDown(self):
+        http_client._latencies.clear()
+        super(HttpClientTestCase, self).tearDown()
+
+    def test_urlopen(self):
+        self.http_server.create_file(self.filename, b'test')
+        resp = http_client.urlopen(GetRequest(self.url), 1, 1, 1)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.info().get('Content-Length'), '4')
+        self.assertEqual(resp.read(), b'test')
+        self.assertEqual(len(http_client._latencies['localhost:4080']), 1)
+
+    def test_urlopen_error(self):
+        with self.assertRaises(URLError) as context:
+            http_client.urlopen(GetRequest(self.url), 1, 1, 1)
+        self.assertEqual(context.exception.code, 404)
+
+    def test_urlopen_connection_refused(self):
+        url = 'http://%s:%d/' % (self.host, self.port + 9)
+        self.assertRaises(URLError, http_client.urlopen, GetRequest(url), 1, 1, 1)
+
+    def test_read_timeout(self):
+        self.http_server.create_file = lambda name, content: time.sleep(0.2)
+        body = b'x' * http_client.BLOCK_SIZE * 4
+        # The read timeout only starts once the request is sent.
+        start = time.time()
+        self.assertRaises(socket.timeout, http_client.urlopen,
+                PutRequest(self.url, body), 1, 1, 0.05)
+        self.assertTrue(time.time() - start < 0.2)
+
+    def test_operation_deadline(self):
+        with operation(deadline=time.time() - 1):
+            self.assertRaises(URLError, http_client.urlopen,
+                    GetRequest(self.url), 1, 1, 1)
+        self.assertServerLogIs([])
+
+    def test_nested_operations(self):
+        deadline = time.time() + 10
+        with operation(deadline=deadline, sequence=1):
+            with operation(deadline=deadline + 10):
+                self.assertTrue(http_client.remaining(60) <= 10)
+                self.assertEqual(http_client.get_sequence(), 1)
+            with operation(sequence=2):
+                self.assertTrue(http_client.remaining(60) <= 10)
+                self.assertEqual(http_client.get_sequence(), 2)
+            self.assertEqual(http_client.get_sequence(), 1)
+        self.assertEqual(http_client.remaining(60), 60)
+        self.assertEqual(http_client.get_sequence(), None)
+
+    def test_get_latency(self):
+        self.assertEqual(get_latency('example.com', 0.99), None)
+        for i in range(100):
+            record_latency('example.com', i / 100.0)
+        self.assertEqual(get_latency('example.com', 0.5), 0.5)
+        self.assertEqual(get_latency('example.com', 0.99), 0.99)
+        self.assertEqual(get_latency('example.com', 1), 0.99)
+
+
+class ConnectionPoolTestCase(HttpServerTestCaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(ConnectionPoolTestCase, self).setUp()
+        self.http_server.keep_alive = True
+        self.http_server.create_file(self.filename, b'test')
+        self.idle = http_client._pool['http', 'localhost:4080']
+
+    def tearDown(self):
+        # The server waits for requests on idle connections until they close.
+        http_client.clear_pool()
+        http_client._latencies.clear()
+        super(ConnectionPoolTestCase, self).tearDown()
+
+    def test_reuse_connection(self):
+        http_client.urlopen(HeadRequest(self.url), 1, 1, 1)
+        self.assertEqual(len(self.idle), 1)
+        conn = self.idle[0]
+        resp = http_client.urlopen(GetRequest(self.url), 1, 1, 1)
+        self.assertEqual(self.idle, [])
+        self.assertEqual(resp.read(), b'test')
+        self.assertEqual(self.idle, [conn])
+
+    def test_reuse_connection_after_error(self):
+        self.http_server.sequences[self.filename] = 2
+        request = PutRequest(self.url, b'test', {'X-Resto-Sequence': '1'})
+        self.assertRaises(URLError, http_client.urlopen, request, 1, 1, 1)
+        self.assertEqual(len(self.idle), 1)
+
+    def test_partial_read(self):
+        resp = http_client.urlopen(GetRequest(self.url), 1, 1, 1)
+        self.assertEqual(resp.read(2), b'te')
+        resp.close()
+        self.assertEqual(self.idle, [])
+
+    def test_no_keep_alive(self):
+        self.http_server.keep_alive = False
+        http_client.urlopen(HeadRequest(self.url), 1, 1, 1)
+        self.assertEqual(self.idle, [])
+
+    def add_closed_connection(self):
+        listener = socket.socket()
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        conn = httplib.HTTPConnection('localhost:%d' % listener.getsockname()[1])
+        conn.connect()
+        listener.accept()[0].close()
+        listener.close()
+        self.idle.append(conn)
+
+    def test_closed_connection(self):
+        self.add_closed_connection()
+        time.sleep(0.01)
+        http_client.urlopen(HeadRequest(self.url), 1, 1, 1)
+        self.assertEqual(len(self.http_server.log), 1)
+        self.assertEqual(len(self.idle), 1)
+
+    def test_stale_connection(self):
+        self.add_closed_connection()
+        # Pretend the server closed the connection after it was checked.
+        select = http_client.select
+        http_client.select = type(str('select'), (), {
+                'select': staticmethod(lambda *args: ([], [], []))})
+        try:
+            resp = http_client.urlopen(GetRequest(self.url), 1, 1, 1)
+        finally:
+            http_client.select = select
+        self.assertEqual(resp.read(), b'test')
+        self.assertEqual(len(self.http_server.log), 1)
+
+
+class ExpectContinueTestCase(HttpServerTestCaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(ExpectContinueTestCase, self).setUp()
+        self.sent = []
+
+    def tearDown(self):
+        http_client.clear_pool()
+        http_client._latencies.clear()
+        super(ExpectContinueTestCase, self).tearDown()
+
+    def put(self, continue_timeout=1):
+        request = PutRequest(self.url, b'test', {'Expect': '100-continue'})
+        with operation(progress=lambda sent, total: self.sent.append(sent)):
+            return http_client.urlopen(request, 1, 1, 1,
+                    continue_timeout=continue_timeout)
+
+    def test_expect_continue(self):
+        self.assertEqual(self.put().code, 201)
+        self.assertEqual(self.http_server.get_file(self.filename), b'test')
+        self.assertEqual(self.sent, [4])
+
+    def test_expect_continue_rejected(self):
+        self.http_server.readonly = True
+        with self.assertRaises(URLError) as context:
+            self.put()
+        self.assertEqual(context.exception.code, 403)
+        self.assertEqual(self.sent, [])
+
+    def test_expect_continue_not_supported(self):
+        self.http_server.expect_continue = False
+        start = time.time()
+        self.assertEqual(self.put(continue_timeout=0.05).code, 201)
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(self.http_server.get_file(self.filename), b'test')
+
+    def test_expect_continue_split(self):
+        handler_class = self.http_server.handler_class
+        send_continue = handler_class.send_continue
+
+        def split_continue(handler):
+            # Send the status line in two segments.
+            handler.wfile.write(b'HTTP/1.1 1')
+            handler.wfile.flush()
+            time.sleep(0.05)
+            handler.wfile.write(b'00 Continue\r\n\r\n')
+        handler_class.send_continue = split_continue
+        try:
+            self.assertEqual(self.put().code, 201)
+        finally:
+            handler_class.send_continue = send_continue
+        self.assertEqual(self.http_server.get_file(self.filename), b'test')
+        self.assertEqual(self.sent, [4])
+
+    def test_expect_continue_keep_alive(self):
+        self.http_server.keep_alive = True
+        self.put()
+        self.put()
+        self.assertEqual(self.sent, [4, 4])
+        self.assertEqual(len(http_client._pool['http', 'localhost:4080']), 1)
+
+    def test_transport(self):
+        self.http_server.readonly = True
+        transport = DefaultTransport('http://media.example.com/')
+        transport.expect_continue = 4
+        host = '%s:%d' % (self.host, self.port)
+        with operation(progress=lambda sent, total: self.sent.append(sent)):
+            self.assertRaises(URLError, transport.create, host, 'test.txt',
+                    b'test')
+        self.assertEqual(self.sent, [])
+
+
+class AddressCacheTestCase(HttpServerTestCaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(AddressCacheTestCase, self).setUp()
+        self.lookups = []
+        self.getaddrinfo = socket.getaddrinfo
+
+        def getaddrinfo(host, *args):
+            # Connecting to an address looks it up again.
+            if host == 'localhost':
+                self.lookups.append(host)
+            return self.getaddrinfo(host, *args)
+        socket.getaddrinfo = getaddrinfo
+        http_client.DNS_TTL = 60
+
+    def tearDown(self):
+        socket.getaddrinfo = self.getaddrinfo
+        http_client.DNS_TTL = None
+        http_client.clear_addresses()
+        http_client._latencies.clear()
+        super(AddressCacheTestCase, self).tearDown()
+
+    def test_cache(self):
+        for _ in range(2):
+            self.assertRaises(URLError, http_client.urlopen,
+                    HeadRequest(self.url), 1, 1, 1)
+        self.assertEqual(self.lookups, ['localhost'])
+        self.assertEqual(len(self.http_server.log), 2)
+
+    def test_expiry(self):
+        http_client.DNS_TTL = 0.01
+        http_client.resolve('localhost', 4080)
+        time.sleep(0.02)
+        http_client.resolve('localhost', 4080)
+        self.assertEqual(self.lookups, ['localhost', 'localhost'])
+
+    def test_no_cache(self):
+        http_client.DNS_TTL = None
+        http_client.resolve('localhost', 4080)
+        http_client.resolve('localhost', 4080)
+        self.assertEqual(self.lookups, ['localhost', 'localhost'])
+
+    def test_outdated_addresses(self):
+        http_client._addresses['localhost', 4080] = (
+                time.time() + 60, [('127.0.0.1', self.port + 9)])
+        self.assertRaises(URLError, http_client.urlopen,
+                HeadRequest(self.url), 1, 1, 1)
+        self.assertEqual(self.lookups, [])
+        self.http_server.create_file(self.filename, b'test')
+        http_client.urlopen(HeadRequest(self.url), 1, 1, 1)
+        self.assertEqual(self.lookups, ['localhost'])
+
+
+class WarmUpTestCase(
+        UseDistributedStorageMixin, StorageUtilitiesMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(WarmUpTestCase, self).setUp()
+        self.http_server.keep_alive = True
+        self.idle = http_client._pool['http', 'localhost:4080']
+
+    def tearDown(self):
+        http_client.clear_pool()
+        http_client._latencies.clear()
+        super(WarmUpTestCase, self).tearDown()
+
+    def test_warm_up(self):
+        self.assertEqual(self.storage.warm_up(), set())
+        self.assertEqual(len(self.idle), 1)
+        self.assertServerLogIs([])
+        conn = self.idle[0]
+        self.create_file('test.txt', b'test')
+        self.assertTrue(self.storage.exists('test.txt'))
+        self.assertEqual(self.idle, [conn])
+
+    def test_warm_up_failure(self):
+        self.storage.hosts.append('%s:%d' % (self.host, self.port + 9))
+        self.assertEqual(self.storage.warm_up(), set(['localhost:4089']))
+        self.assertIn("Failed to connect to localhost:4089", self.get_log())
+        self.assertEqual(len(self.idle), 1)
+
+
+class TimeoutsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = DefaultTransport('http://media.example.com/')
+
+    def tearDown(self):
+        http_client._latencies.clear()
+
+    def test_default_timeouts(self):
+        self.assertEqual(self.transport._get_timeouts('example.com', 10 ** 9),
+                (self.transport.timeout,) * 3)
+
+    def test_connect_timeout(self):
+        self.transport.connect_timeout = 0.5
+        self.assertEqual(self.transport._get_timeouts('example.com', 0),
+                (0.5, self.transport.timeout, self.transport.timeout))
+
+    def test_bandwidth(self):
+        self.transport.timeout = 2
+        self.transport.bandwidth = 10 ** 6
+        self.assertEqual(self.transport._get_timeouts('example.com', 10 ** 7),
+                (2, 12, 2))
+
+    def test_adaptive_timeout(self):
+        self.transport.timeout = 2
+        self.transport.adaptive_timeout = True
+        # Not enough samples yet.
+        self.assertEqual(self.transport._get_timeouts('example.com', 0),
+                (2, 2, 2))
+        for _ in range(100):
+            record_latency('example.com', 0.1)
+        self.assertEqual(self.transport._get_timeouts('example.com', 0),
+                (0.4, 0.4, 0.4))
+        for _ in range(100):
+            record_latency('example.com', 0.01)
+        self.assertEqual(self.transport._get_timeouts('example.com', 0),
+                (0.25, 0.25, 0.25))
+        for _ in range(100):
+            record_latency('example.com', 1)
+        self.assertEqual(self.transport._get_timeouts('example.com', 0),
+                (2, 2, 2))
+
+
+class OperationTimeoutTestCase(
+        UseDistributedStorageMixin, StorageUtilitiesMixin, unittest.TestCase):
+
+    def test_save_past_deadline(self):
+        self.delay_writes()
+        self.storage.operation_timeout = 0.05
+        self.assertRaises(socket.timeout,
+                self.storage._save, 'test.txt', ContentFile(b'test'))
+        self.assertIn("Failed to create", self.get_log())
@@ -12,7 +12,8 @@ from django.conf import settings
 from django.utils import unittest
 
 from ..http_server import TestHttpServer
-from ..storage import GetRequest, HeadRequest, DeleteRequest, PutRequest
+from ..storage import (GetRequest, HeadRequest, DeleteRequest, PutRequest,
+        PropfindRequest)
 
 
 class HttpServerTestCaseMixin(object):
@@ -24,10 +25,11 @@ class HttpServerTestCaseMixin(object):
     url = 'http://%s:%d%s' % (host, port, path)
     filepath = os.path.join(settings.MEDIA_ROOT, filename)
     num_threads = 1
+    http_server_class = TestHttpServer
 
     def setUp(self):
         super(HttpServerTestCaseMixin, self).setUp()
-        self.http_server = TestHttpServer(self.host, self.port)
+        self.http_server = self.http_server_class(self.host, self.port)
         self.thread = threading.Thread(target=self.http_server.run)
         self.thread.daemon = True
         self.thread.start()
@@ -65,7 +67,7 @@ class ExtraHttpServerTestCaseMixin(object):
 
     def setUp(self):
         super(ExtraHttpServerTestCaseMixin, self).setUp()
-        self.alt_http_server = TestHttpServer(self.host, self.port + 1)
+        self.alt_http_server = self.http_server_class(self.host, self.port + 1)
         self.alt_thread = threading.Thread(target=self.alt_http_server.run)
         self.alt_thread.daemon = True
         self.alt_thread.start()
@@ -117,6 +119,22 @@ class HttpServerTestCase(HttpServerTestCaseMixin, unittest.TestCase):
             ('GET', self.path, 200),
         ])
 
+    def test_get_range(self):
+        self.http_server.create_file(self.filename, b'test')
+        headers = {'Range': 'bytes=1-2'}
+        body = self.assertHttpSuccess(GetRequest(self.url, None, headers))
+        self.assertEqual(body, b'es')
+        headers = {'Range': 'bytes=2-'}
+        body = self.assertHttpSuccess(GetRequest(self.url, None, headers))
+        self.assertEqual(body, b'st')
+        headers = {'Range': 'bytes=4-7'}
+        self.assertHTTPErrorCode(416, GetRequest(self.url, None, headers))
+        self.assertServerLogIs([
+            ('GET', self.path, 206),
+            ('GET', self.path, 206),
+            ('GET', self.path, 416),
+        ])
+
     def test_head(self):
         self.assertHTTPErrorCode(404, HeadRequest(self.url))
         self.http_server.create_file(self.filename, b'test')
@@ -162,3 +180,98 @@ class HttpServerTestCase(HttpServerTestCaseMixin, unittest.TestCase):
             ('PUT', self.path, 204),
             ('PUT', self.path, 403),
         ])
+
+    def test_propfind(self):
+        self.http_server.create_file('dir/a.txt', b'a')
+        self.http_server.create_file('dir/sub/b.txt', b'bb')
+        url = 'http://%s:%d/dir' % (self.host, self.port)
+        body = self.assertHttpSuccess(PropfindRequest(url, None, {'Depth': '1'}))
+        self.assertIn(b'<D:href>/dir/</D:href>', body)
+        self.assertIn(b'<D:href>/dir/a.txt</D:href>', body)
+        self.assertIn(b'<D:getcontentlength>1</D:getcontentlength>', body)
+        self.assertIn(b'<D:href>/dir/sub/</D:href>', body)
+        self.assertNotIn(b'b.txt', body)
+        body = self.assertHttpSuccess(PropfindRequest(url, None, {'Depth': '0'}))
+        self.assertNotIn(b'a.txt', body)
+        self.assertHTTPErrorCode(403, PropfindRequest(url))
+        self.assertHTTPErrorCode(404,
+                PropfindRequest(url + '/missing', None, {'Depth': '1'}))
+        self.assertServerLogIs([
+            ('PROPFIND', '/dir', 207),
+            ('PROPFIND', '/dir', 207),
+            ('PROPFIND', '/dir', 403),
+            ('PROPFIND', '/dir/missing', 404),
+        ])
+
+    def test_put_chunked(self):
+        # query an upload that hasn't started
+        headers = {'Content-Range': 'bytes */8'}
+        resp = urlopen(PutRequest(self.url, b'', headers))
+        self.assertEqual(resp.code, 202)
+        self.assertEqual(resp.info().get('Range'), None)
+        # upload the first part
+        headers = {'Content-Range': 'bytes 0-3/8'}
+        resp = urlopen(PutRequest(self.url, b'test', headers))
+        self.assertEqual(resp.code, 202)
+        self.assertEqual(resp.info().get('Range'), 'bytes=0-3')
+        self.assertFalse(self.http_server.has_file(self.filename))
+        # attempt to upload a part that doesn't follow the first one
+        headers = {'Content-Range': 'bytes 5-7/8'}
+        self.assertHTTPErrorCode(416, PutRequest(self.url, b'st2', headers))
+        # query the upload in progress
+        headers = {'Content-Range': 'bytes */8'}
+        resp = urlopen(PutRequest(self.url, b'', headers))
+        self.assertEqual(resp.info().get('Range'), 'bytes=0-3')
+        # upload the last part
+        headers = {'Content-Range': 'bytes 4-7/8'}
+        body = self.assertHttpSuccess(PutRequest(self.url, b'test', headers))
+        self.assertEqual(body, b'')
+        self.assertEqual(self.http_server.get_file(self.filename), b'testtest')
+        self.assertEqual(self.http_server.partial_files, {})
+        self.assertServerLogIs([
+            ('PUT', self.path, 202),
+            ('PUT', self.path, 202),
+            ('PUT', self.path, 416),
+            ('PUT', self.path, 202),
+            ('PUT', self.path, 201),
+        ])
+
+    def test_put_chunked_invalid(self):
+        headers = {'Content-Range': 'bytes 0-3'}
+        self.assertHTTPErrorCode(400, PutRequest(self.url, b'test', headers))
+        # a part that doesn't match the length of the upload restarts it
+        self.http_server.partial_files[self.filename] = (8, b'test')
+        headers = {'Content-Range': 'bytes 4-7/9'}
+        self.assertHTTPErrorCode(416, PutRequest(self.url, b'test', headers))
+        self.assertEqual(self.http_server.partial_files, {})
+        self.assertServerLogIs([
+            ('PUT', self.path, 400),
+            ('PUT', self.path, 416),
+        ])
+
+    def test_sequence(self):
+        headers = {'X-Resto-Sequence': '2'}
+        self.assertHttpSuccess(PutRequest(self.url, b'test', headers))
+        headers = {'X-Resto-Sequence': '1'}
+        self.assertHTTPErrorCode(409, PutRequest(self.url, b'stale', headers))
+        self.assertHTTPErrorCode(409, DeleteRequest(self.url, None, headers))
+        self.assertEqual(self.http_server.get_file(self.filename), b'test')
+        headers = {'X-Resto-Sequence': '3'}
+        self.assertHttpSuccess(DeleteRequest(self.url, None, headers))
+        self.assertServerLogIs([
+            ('PUT', self.path, 201),
+            ('PUT', self.path, 409),
+            ('DELETE', self.path, 409),
+            ('DELETE', self.path, 204),
+        ])
+
+    def test_unavailable(self):
+        self.http_server.unavailable = 2
+        self.assertHTTPErrorCode(503, PutRequest(self.url, b'test'))
+        self.assertHTTPErrorCode(503, GetRequest(self.url))
+        self.assertHttpSuccess(PutRequest(self.url, b'test'))
+        self.assertServerLogIs([
+            ('PUT', self.path, 503),
+            ('GET', self.path, 503),
+            ('PUT', self.path, 201),
+        ])
@@ -0,0 +1,310 @@
+from __future__ import unicode_literals
+
+import datetime
+import os.path
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.utils import override_settings
+from django.utils import unittest
+
+from ..manifest import Manifest
+from ..storage import BatchError
+from .storage import StorageUtilitiesWithTwoServersMixin
+from .storage import UseDistributedStorageMixin
+
+
+class ManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest = Manifest(os.path.join(self.tmpdir, 'manifest.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_add_and_remove(self):
+        self.manifest.add('a.txt', 1, 'hash', 1000.0,
+                {'h1': 'present', 'h2': 'missing'})
+        self.assertEqual(self.manifest.get('a.txt'), (1, 'hash', 1000.0))
+        self.assertEqual(self.manifest.statuses('a.txt'),
+                {'h1': 'present', 'h2': 'missing'})
+        self.assertEqual(self.manifest.inconsistencies(),
+                [('a.txt', 'h2', 'missing')])
+        self.manifest.remove('a.txt', {'h1': 'orphan'})
+        self.assertEqual(self.manifest.get('a.txt'), None)
+        self.assertEqual(self.manifest.inconsistencies(),
+                [('a.txt', 'h1', 'orphan')])
+        self.assertEqual(len(self.manifest), 0)
+
+    def test_link_and_unlink(self):
+        self.assertFalse(self.manifest.link('b.txt', 1, 'hash', 1000.0))
+        self.assertEqual(self.manifest.get('b.txt'), None)
+        self.manifest.add('a.txt', 1, 'hash', 1000.0,
+                {'h1': 'present', 'h2': 'missing'})
+        self.assertTrue(self.manifest.link('b.txt', 1, 'hash', 1001.0))
+        self.assertEqual(self.manifest.references('hash'), 2)
+        self.assertEqual(self.manifest.get('b.txt'), (1, 'hash', 1001.0))
+        self.assertEqual(self.manifest.statuses('b.txt'),
+                {'h1': 'present', 'h2': 'missing'})
+        self.assertEqual(self.manifest.unlink('a.txt'), None)
+        self.assertEqual(self.manifest.unlink('b.txt'), 'hash')
+        # Content that no host has isn't linked.
+        self.manifest.add('c.txt', 1, 'hash', 1000.0, {'h1': 'missing'})
+        self.assertFalse(self.manifest.link('d.txt', 1, 'hash', 1001.0))
+        self.assertEqual(self.manifest.get('d.txt'), None)
+        self.manifest.remove('c.txt', {})
+        self.assertEqual(self.manifest.unlink('b.txt'), None)
+        self.assertEqual(self.manifest.references('hash'), 0)
+        self.assertEqual(self.manifest.inconsistencies(), [])
+
+    def test_update(self):
+        self.manifest.add('a.txt', 1, 'hash', 1000.0,
+                {'h1': 'present', 'h2': 'missing'})
+        self.manifest.link('b.txt', 1, 'hash', 1000.0)
+        self.manifest.update('a.txt', {'h2': 'present', 'h3': 'present'})
+        self.assertEqual(self.manifest.statuses('a.txt'),
+                {'h1': 'present', 'h2': 'present'})
+        self.manifest.update_content('hash', {'h1': 'missing'})
+        self.assertEqual(self.manifest.inconsistencies(),
+                [('a.txt', 'h1', 'missing'), ('b.txt', 'h1', 'missing'),
+                 ('b.txt', 'h2', 'missing')])
+
+    def test_listdir(self):
+        for name in ['a.txt', 'dir/b.txt', 'dir/sub/c.txt', 'dir0.txt',
+                'dirt/d.txt']:
+            self.manifest.add(name, 1, None, 1000.0, {})
+        self.assertEqual(self.manifest.listdir(''),
+                (['dir', 'dirt'], ['a.txt', 'dir0.txt']))
+        self.assertEqual(self.manifest.listdir('dir'), (['sub'], ['b.txt']))
+        self.assertRaises(OSError, self.manifest.listdir, 'missing')
+
+    def test_rebuild(self):
+        self.manifest.add('a.txt', 1, None, 1000.0, {})
+        self.manifest.rebuild([('b.txt', 2, None, 1000.0, {'h1': 'present'})])
+        self.assertEqual(self.manifest.get('a.txt'), None)
+        self.assertEqual(self.manifest.get('b.txt'), (2, None, 1000.0))
+
+    def test_pickle(self):
+        self.manifest.add('a.txt', 1, None, 1000.0, {})
+        manifest = pickle.loads(pickle.dumps(self.manifest))
+        self.assertEqual(len(manifest), 1)
+
+
+class ManifestStorageTestCase(
+        UseDistributedStorageMixin, StorageUtilitiesWithTwoServersMixin,
+        unittest.TestCase):
+
+    def setUp(self):
+        super(ManifestStorageTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'manifest.db')
+        self.storage = self.storage_class(hosts=self.storage.hosts,
+                manifest=self.path)
+        self.manifest = self.storage.manifest
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ManifestStorageTestCase, self).tearDown()
+
+    def test_save(self):
+        self.storage.save('dir/test.txt', ContentFile(b'test'))
+        size, hash, mtime = self.manifest.get('dir/test.txt')
+        self.assertEqual(size, 4)
+        self.assertEqual(hash, '9f86d081884c7d659a2feaa0c55ad015'
+                'a3bf4f1b2b0b822cd15d6c15b0f00a08')
+        # Metadata lookups don't send any request.
+        self.assertTrue(self.storage.exists('dir/test.txt'))
+        self.assertFalse(self.storage.exists('dir/missing.txt'))
+        self.assertEqual(self.storage.size('dir/test.txt'), 4)
+        self.assertEqual(self.storage.modified_time('dir/test.txt'),
+                datetime.datetime.fromtimestamp(mtime))
+        self.assertEqual(self.storage.listdir('dir'), ([], ['test.txt']))
+        self.assertEqual(self.storage.exists_many(['dir/test.txt', 'a.txt']),
+                {'dir/test.txt': True, 'a.txt': False})
+        self.assertRaises(BatchError, self.storage.size_many, ['a.txt'])
+        self.assertEachServerLogIs([('PUT', '/dir/test.txt', 201)])
+
+    def test_save_failure(self):
+        self.alt_http_server.readonly = True
+        self.storage.fatal_exceptions = False
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.manifest.statuses('test.txt'), {
+            'localhost:4080': 'present', 'localhost:4081': 'missing'})
+
+    def test_save_failure_everywhere(self):
+        self.http_server.readonly = True
+        self.alt_http_server.readonly = True
+        self.assertRaises(Exception, self.storage.save, 'test.txt',
+                ContentFile(b'test'))
+        self.assertFalse(self.storage.exists('test.txt'))
+        self.assertEqual(self.storage.listdir(''), ([], []))
+        self.assertEqual(len(self.manifest), 0)
+
+    def test_delete(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.alt_http_server.readonly = True
+        self.assertRaises(Exception, self.storage.delete, 'test.txt')
+        self.assertFalse(self.storage.exists('test.txt'))
+        self.assertEqual(self.manifest.inconsistencies(),
+                [('test.txt', 'localhost:4081', 'orphan')])
+
+    def test_size_non_existing(self):
+        self.assertRaises(EnvironmentError, self.storage.size, 'test.txt')
+
+    def test_rebuild_manifest(self):
+        self.create_file('a.txt', b'a')
+        self.create_file('dir/b.txt', b'bb')
+        # The storage lists the hosts in reverse order: localhost:4081 first.
+        self.http_server.create_file('dir/b.txt', b'stale')
+        self.alt_http_server.create_file('c.txt', b'ccc')
+        # Internal files aren't indexed.
+        self.http_server.create_file('.resto/health', b'')
+        with override_settings(RESTO_MANIFEST=self.path,
+                RESTO_MEDIA_HOSTS=self.storage.hosts):
+            call_command('resto_rebuild_manifest', hash=True,
+                    stdout=open(os.devnull, 'w'))
+        self.assertEqual(len(self.manifest), 3)
+        self.assertEqual(self.storage.listdir(''), (['dir'], ['a.txt', 'c.txt']))
+        self.assertEqual(self.manifest.get('dir/b.txt')[:2], (2,
+                '3b64db95cb55c763391c707108489ae18b4112d783300de38e033b4c98c3deaf'))
+        self.assertEqual(self.manifest.inconsistencies(), [
+            ('c.txt', 'localhost:4080', 'missing'),
+            ('dir/b.txt', 'localhost:4080', 'missing'),
+        ])
+
+    def test_rebuild_manifest_without_mtime(self):
+        self.create_file('a.txt', b'a')
+        self.http_server.mtimes['a.txt'] = None
+        self.alt_http_server.mtimes['a.txt'] = None
+        start = time.time()
+        with override_settings(RESTO_MANIFEST=self.path,
+                RESTO_MEDIA_HOSTS=self.storage.hosts):
+            call_command('resto_rebuild_manifest',
+                    stdout=open(os.devnull, 'w'))
+        size, hash, mtime = self.manifest.get('a.txt')
+        self.assertEqual(size, 1)
+        self.assertTrue(start <= mtime <= time.time())
+
+
+class DeduplicatingStorageTestCase(
+        UseDistributedStorageMixin, StorageUtilitiesWithTwoServersMixin,
+        unittest.TestCase):
+
+    hash = '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08'
+
+    blob = '/.resto/sha256/9f/' + hash
+
+    def setUp(self):
+        super(DeduplicatingStorageTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'manifest.db')
+        self.storage = self.storage_class(hosts=self.storage.hosts,
+                manifest=self.path)
+        self.storage.deduplicate = True
+        self.manifest = self.storage.manifest
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(DeduplicatingStorageTestCase, self).tearDown()
+
+    def test_requires_manifest(self):
+        class DeduplicatingStorage(self.storage_class):
+            deduplicate = True
+        self.assertRaises(ValueError, DeduplicatingStorage,
+                hosts=self.storage.hosts)
+
+    def test_save_once(self):
+        self.storage.save('a.txt', ContentFile(b'test'))
+        self.storage.save('dir/b.txt', ContentFile(b'test'))
+        self.assertEachServerLogIs([('PUT', self.blob, 201)])
+        self.assertEqual(self.storage.open('dir/b.txt').read(), b'test')
+        self.assertEqual(self.storage.url('a.txt'),
+                'http://media.example.com' + self.blob)
+        self.assertEqual(self.storage.url('missing.txt'),
+                'http://media.example.com/missing.txt')
+        self.assertEqual(self.storage.listdir(''), (['dir'], ['a.txt']))
+        self.assertEqual(self.storage.size('dir/b.txt'), 4)
+
+    def test_delete_last_reference(self):
+        self.storage.save('a.txt', ContentFile(b'test'))
+        self.storage.save('b.txt', ContentFile(b'test'))
+        self.storage.delete('a.txt')
+        self.assertFalse(self.storage.exists('a.txt'))
+        self.assertEachServerLogIs([('PUT', self.blob, 201)])
+        self.storage.delete('b.txt')
+        self.assertEachServerLogIs([('PUT', self.blob, 201),
+                                    ('DELETE', self.blob, 204)])
+        self.assertFalse(self.has_file(self.blob[1:]))
+
+    def test_delete_failure(self):
+        self.storage.save('a.txt', ContentFile(b'test'))
+        self.alt_http_server.readonly = True
+        self.assertRaises(Exception, self.storage.delete, 'a.txt')
+        self.assertEqual(self.manifest.inconsistencies(),
+                [(self.blob[1:], 'localhost:4081', 'orphan')])
+
+    def test_save_during_delete(self):
+        self.storage.save('a.txt', ContentFile(b'test'))
+        deleting, release = threading.Event(), threading.Event()
+        delete = self.storage.transport.delete
+
+        def slow_delete(host, name):
+            deleting.set()
+            release.wait()
+            return delete(host, name)
+        self.storage.transport.delete = slow_delete
+        thread = threading.Thread(target=self.storage.delete, args=('a.txt',))
+        thread.start()
+        deleting.wait()
+        # The save waits until the content is deleted, then uploads it again.
+        save = threading.Thread(target=self.storage.save,
+                args=('b.txt', ContentFile(b'test')))
+        save.start()
+        release.set()
+        thread.join()
+        save.join()
+        self.assertEachServerLogIs([('PUT', self.blob, 201),
+                                    ('DELETE', self.blob, 204),
+                                    ('PUT', self.blob, 201)])
+        self.assertEqual(self.storage.open('b.txt').read(), b'test')
+
+    def test_save_failure_everywhere(self):
+        self.http_server.readonly = True
+        self.alt_http_server.readonly = True
+        self.assertRaises(Exception, self.storage.save, 'a.txt',
+                ContentFile(b'test'))
+        self.assertFalse(self.storage.exists('a.txt'))
+        self.http_server.readonly = False
+        self.alt_http_server.readonly = False
+        self.storage.save('b.txt', ContentFile(b'test'))
+        self.assertEachServerLogIs([('PUT', self.blob, 403),
+                                    ('PUT', self.blob, 201)])
+        self.assertEqual(self.storage.open('b.txt').read(), b'test')
+
+    def test_save_after_missing_content(self):
+        # The content of a.txt was lost on both hosts.
+        self.manifest.add('a.txt', 4, self.hash, time.time(),
+                {'localhost:4080': 'missing', 'localhost:4081': 'missing'})
+        self.storage.save('b.txt', ContentFile(b'test'))
+        self.assertEachServerLogIs([('PUT', self.blob, 201)])
+        self.assertEqual(self.manifest.inconsistencies(), [])
+
+    def test_overwrite(self):
+        self.storage._save('a.txt', ContentFile(b'test'))
+        self.storage._save('a.txt', ContentFile(b'other'))
+        self.assertEqual(self.storage.open('a.txt').read(), b'other')
+        self.assertEqual(self.http_server.log[1], ('DELETE', self.blob, 204))
+        self.assertEqual(len(self.manifest), 1)
+
+    def test_rebuild_manifest(self):
+        with override_settings(RESTO_MANIFEST=self.path,
+                RESTO_DEDUPLICATE=True):
+            self.assertRaises(CommandError, call_command,
+                    'resto_rebuild_manifest')
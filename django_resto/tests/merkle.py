@@ -0,0 +1,220 @@
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import os
+import os.path
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.utils import override_settings
+from django.utils import unittest
+
+from .. import merkle
+from ..merkle import MasterTree, build_listings, compare
+from .storage import StorageUtilitiesWithTwoServersMixin
+from .storage import UseHybridStorageMixin
+
+
+class MerkleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.files = dict(('dir%d/file%d.txt' % (i, j), (1, '%d%d' % (i, j)))
+                for i in range(10) for j in range(10))
+        self.files['root.txt'] = (4, 'root')
+
+    def test_build_listings(self):
+        listings = build_listings(self.files)
+        self.assertEqual(len(listings), 11)
+        self.assertEqual(listings['dir3']['entries']['file4.txt'],
+                {'size': 1, 'hash': '34'})
+        self.assertEqual(listings['']['entries']['dir3'],
+                {'digest': listings['dir3']['digest']})
+        self.files['dir3/file4.txt'] = (1, 'changed')
+        changed = build_listings(self.files)
+        self.assertNotEqual(changed['']['digest'], listings['']['digest'])
+        self.assertNotEqual(changed['dir3']['digest'],
+                listings['dir3']['digest'])
+        self.assertEqual(changed['dir4']['digest'], listings['dir4']['digest'])
+
+    def test_nested_directories(self):
+        listings = build_listings({'a/b/c.txt': (1, 'c')})
+        self.assertEqual(sorted(listings), ['', 'a', 'a/b'])
+        self.assertEqual(listings['a']['entries'],
+                {'b': {'digest': listings['a/b']['digest']}})
+
+    def test_compare(self):
+        local = build_listings(self.files)
+        self.files['dir3/file4.txt'] = (1, 'changed')
+        del self.files['dir5/file0.txt']
+        self.files['dir5/extra.txt'] = (1, 'extra')
+        self.files['new/sub/file.txt'] = (1, 'new')
+        remote = build_listings(self.files)
+        requested = []
+
+        def get_remote(directory):
+            requested.append(directory)
+            return remote.get(directory)
+        self.assertEqual(list(compare(local.get, get_remote)), [
+            ('dir3/file4.txt', 'different'),
+            ('dir5/extra.txt', 'extra'),
+            ('dir5/file0.txt', 'missing'),
+            ('new/sub/file.txt', 'extra'),
+        ])
+        # Directories that don't differ aren't listed.
+        self.assertEqual(requested, ['', 'dir3', 'dir5', 'new', 'new/sub'])
+
+    def test_compare_identical(self):
+        listings = build_listings(self.files)
+        self.assertEqual(list(compare(listings.get, listings.get)), [])
+
+    def test_compare_file_and_directory(self):
+        local = build_listings({'a': (1, 'a')})
+        remote = build_listings({'a/b.txt': (1, 'b')})
+        self.assertEqual(list(compare(local.get, remote.get)),
+                [('a', 'missing'), ('a/b.txt', 'extra')])
+
+    def test_compare_missing_remote(self):
+        local = build_listings({'a/b.txt': (1, 'b')})
+        self.assertEqual(list(compare(local.get, lambda directory: None)),
+                [('a/b.txt', 'missing')])
+
+
+class MasterTreeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.location = os.path.join(self.tmpdir, 'media')
+        self.cache = os.path.join(self.tmpdir, 'digests.sqlite')
+        os.makedirs(os.path.join(self.location, 'dir'))
+        self.write('a.txt', b'a')
+        self.write('dir/b.txt', b'bb')
+        self.hashed = []
+        self.hash_file = merkle.hash_file
+
+        def hash_file(path):
+            self.hashed.append(os.path.basename(path))
+            return self.hash_file(path)
+        merkle.hash_file = hash_file
+
+    def tearDown(self):
+        merkle.hash_file = self.hash_file
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.location, name), 'wb') as handle:
+            handle.write(content)
+
+    def test_refresh(self):
+        tree = MasterTree(self.location)
+        tree.refresh()
+        self.assertEqual(tree.listing('dir')['entries'], {'b.txt': {
+            'size': 2, 'hash': hashlib.sha256(b'bb').hexdigest()}})
+        self.assertIsNone(tree.listing('missing'))
+        self.assertEqual(sorted(self.hashed), ['a.txt', 'b.txt'])
+
+    def test_refresh_is_incremental(self):
+        tree = MasterTree(self.location)
+        tree.refresh()
+        digest = tree.listing()['digest']
+        self.hashed = []
+        tree.refresh()
+        self.assertEqual(self.hashed, [])
+        self.assertEqual(tree.listing()['digest'], digest)
+        self.write('a.txt', b'aaa')
+        os.unlink(os.path.join(self.location, 'dir/b.txt'))
+        tree.refresh()
+        self.assertEqual(self.hashed, ['a.txt'])
+        self.assertNotEqual(tree.listing()['digest'], digest)
+        self.assertIsNone(tree.listing('dir'))
+
+    def test_cache(self):
+        MasterTree(self.location, self.cache).refresh()
+        os.unlink(os.path.join(self.location, 'a.txt'))
+        self.hashed = []
+        tree = MasterTree(self.location, self.cache)
+        tree.refresh()
+        self.assertEqual(self.hashed, [])
+        self.assertEqual(sorted(tree.listing()['entries']), ['dir'])
+        self.assertEqual(sorted(MasterTree(self.location, self.cache)._load()),
+                ['dir/b.txt'])
+
+
+class HybridStorageVerifyWithTwoServersTestCase(
+        UseHybridStorageMixin, StorageUtilitiesWithTwoServersMixin,
+        unittest.TestCase):
+
+    def setUp(self):
+        super(HybridStorageVerifyWithTwoServersTestCase, self).setUp()
+        self.storage.save('a.txt', ContentFile(b'a'))
+        self.storage.save('dir/b.txt', ContentFile(b'bb'))
+        self.storage.save('other/c.txt', ContentFile(b'ccc'))
+        self.alt_http_server.delete_file('a.txt')
+        self.alt_http_server.create_file('dir/b.txt', b'xx')
+        self.alt_http_server.create_file('dir/extra.txt', b'extra')
+        self.http_server.log = []
+        self.alt_http_server.log = []
+
+    def test_verify(self):
+        results, errors = self.storage.verify()
+        self.assertEqual(errors, {})
+        self.assertEqual(results, {
+            'localhost:4080': [],
+            'localhost:4081': [
+                ('a.txt', 'missing'),
+                ('dir/b.txt', 'different'),
+                ('dir/extra.txt', 'extra'),
+            ],
+        })
+        self.assertServerLogIs([('GET', '/?digest', 200)])
+        self.assertAltServerLogIs([
+            ('GET', '/?digest', 200),
+            ('GET', '/dir/?digest', 200),
+        ])
+
+    def test_verify_unavailable(self):
+        self.alt_http_server.unavailable = 1
+        results, errors = self.storage.verify()
+        self.assertEqual(list(results), ['localhost:4080'])
+        self.assertEqual(errors['localhost:4081'].code, 503)
+
+    def test_repair(self):
+        results, errors = self.storage.verify(['localhost:4081'])
+        for name, difference in results['localhost:4081']:
+            self.storage.repair('localhost:4081', name)
+        self.assertEqual(self.alt_http_server.get_file('a.txt'), b'a')
+        self.assertEqual(self.alt_http_server.get_file('dir/b.txt'), b'bb')
+        self.assertFalse(self.alt_http_server.has_file('dir/extra.txt'))
+        results, errors = self.storage.verify()
+        self.assertEqual(results['localhost:4081'], [])
+
+    def test_verify_command(self):
+        fd, output = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with override_settings(RESTO_MEDIA_HOSTS=self.storage.hosts):
+                with open(output, 'w') as stdout:
+                    call_command('resto_verify', repair=True, stdout=stdout)
+            with io.open(output, encoding='utf-8') as stdout:
+                lines = stdout.read().splitlines()
+        finally:
+            os.unlink(output)
+        self.assertEqual(lines, [
+            'localhost:4080: 0 differences.',
+            'localhost:4081: missing a.txt',
+            'localhost:4081: different dir/b.txt',
+            'localhost:4081: extra dir/extra.txt',
+            'localhost:4081: 3 differences.',
+        ])
+        self.assertEqual(self.alt_http_server.get_file('a.txt'), b'a')
+
+    def test_verify_command_failure(self):
+        self.alt_http_server.unavailable = 1
+        with override_settings(RESTO_MEDIA_HOSTS=self.storage.hosts):
+            with self.assertRaises(CommandError):
+                call_command('resto_verify', stdout=open(os.devnull, 'w'),
+                        stderr=open(os.devnull, 'w'))
+
@@ -0,0 +1,197 @@
+from __future__ import unicode_literals
+
+import logging
+import os.path
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from django.core.files.base import ContentFile
+from django.utils import unittest
+
+from ..http_client import operation
+from ..spool import Spool, Worker
+from .storage import StorageUtilitiesMixin, UseAsyncStorageMixin
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = Spool(os.path.join(self.tmpdir, 'spool.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_claim_in_order(self):
+        self.spool.put('h1', 'a.txt', b'1')
+        self.spool.put('h1', 'b.txt', b'2')
+        self.assertEqual(self.spool.claim()[1:], ('h1', 'a.txt', b'1'))
+        self.assertEqual(self.spool.claim()[1:], ('h1', 'b.txt', b'2'))
+        self.assertEqual(self.spool.claim(), None)
+
+    def test_claim_one_job_per_name_and_host(self):
+        self.spool.put('h1', 'a.txt', b'put')
+        self.spool.put('h1', 'a.txt', b'delete')
+        self.spool.put('h2', 'a.txt', b'put')
+        job_id = self.spool.claim()[0]
+        # The second job on h1 must wait until the first one is done.
+        self.assertEqual(self.spool.claim()[1:], ('h2', 'a.txt', b'put'))
+        self.assertEqual(self.spool.claim(), None)
+        self.spool.done(job_id)
+        self.assertEqual(self.spool.claim()[1:], ('h1', 'a.txt', b'delete'))
+
+    def test_claim_by_priority(self):
+        self.spool.put('h1', 'a.txt', b'bulk', 'bulk')
+        self.spool.put('h1', 'b.txt', b'normal')
+        self.spool.put('h1', 'c.txt', b'interactive', 'interactive')
+        self.assertEqual(self.spool.claim()[3], b'interactive')
+        self.assertEqual(self.spool.claim()[3], b'normal')
+        self.assertEqual(self.spool.claim()[3], b'bulk')
+
+    def test_claim_aged_jobs(self):
+        self.spool.aging = 0.01
+        self.spool.put('h1', 'a.txt', b'bulk', 'bulk')
+        time.sleep(0.03)
+        self.spool.put('h1', 'b.txt', b'interactive', 'interactive')
+        self.assertEqual(self.spool.claim()[3], b'bulk')
+
+    def test_promote_waiting_jobs(self):
+        self.spool.aging = 60
+        self.spool.put('h1', 'a.txt', b'bulk', 'bulk')
+        self.spool.put('h1', 'b.txt', b'interactive', 'interactive')
+        conn = self.spool.connect()
+        try:
+            # The bulk job waited for two aging periods.
+            conn.execute('UPDATE jobs SET enqueued = enqueued - 130 '
+                    'WHERE name = ?', ('a.txt',))
+            self.assertEqual(self.spool.claim()[3], b'bulk')
+            self.assertEqual(conn.execute('SELECT priority FROM jobs '
+                    'WHERE name = ?', ('a.txt',)).fetchone()[0], 0)
+            # Claims don't sort the whole spool.
+            plan = conn.execute('EXPLAIN QUERY PLAN SELECT id FROM jobs j '
+                    'WHERE claimed = 0 AND NOT EXISTS (SELECT 1 FROM jobs k '
+                    'WHERE k.host = j.host AND k.name = j.name '
+                    'AND k.id < j.id) ORDER BY priority, id LIMIT 1'
+                    ).fetchall()
+        finally:
+            conn.close()
+        plan = ' '.join(row[-1] for row in plan)
+        self.assertIn('jobs_claim', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_release(self):
+        self.spool.put('h1', 'a.txt', b'1')
+        self.spool.claim()
+        self.assertEqual(self.spool.claim(), None)
+        self.spool.release()
+        self.assertEqual(self.spool.claim()[1:], ('h1', 'a.txt', b'1'))
+        self.assertEqual(len(self.spool), 1)
+
+    def test_pending(self):
+        self.spool.put('h1', 'a.txt', b'1')
+        self.spool.put('h2', 'a.txt', b'2')
+        self.spool.put('h1', 'b.txt', b'3')
+        self.assertEqual(self.spool.pending('a.txt'), set(['h1', 'h2']))
+        self.assertEqual(self.spool.pending('c.txt'), set())
+        conn = self.spool.connect()
+        try:
+            plan = conn.execute('EXPLAIN QUERY PLAN SELECT DISTINCT host '
+                    'FROM jobs WHERE name = ?', ('a.txt',)).fetchall()
+        finally:
+            conn.close()
+        self.assertIn('jobs_name', ' '.join(row[-1] for row in plan))
+
+    def test_upgrade(self):
+        # Spools created by earlier versions have no priority.
+        conn = sqlite3.connect(self.spool.path)
+        conn.execute('CREATE TABLE jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'host TEXT NOT NULL, name TEXT NOT NULL, '
+                'payload BLOB NOT NULL, '
+                'claimed INTEGER NOT NULL DEFAULT 0)')
+        conn.execute('INSERT INTO jobs (host, name, payload) '
+                'VALUES (?, ?, ?)', ('h1', 'a.txt', sqlite3.Binary(b'old')))
+        conn.commit()
+        conn.close()
+        self.spool.put('h1', 'b.txt', b'new', 'interactive')
+        # Earlier jobs have no enqueue time, so they're aged the most.
+        self.assertEqual(self.spool.claim()[1:], ('h1', 'a.txt', b'old'))
+        self.assertEqual(self.spool.claim()[1:], ('h1', 'b.txt', b'new'))
+
+    def test_pickle(self):
+        self.spool.put('h1', 'a.txt', b'1')
+        spool = pickle.loads(pickle.dumps(self.spool))
+        self.assertEqual(len(spool), 1)
+
+
+class SpooledAsyncStorageTestCase(
+        UseAsyncStorageMixin, StorageUtilitiesMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(SpooledAsyncStorageTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = Spool(os.path.join(self.tmpdir, 'spool.db'))
+        hosts = ['%s:%d' % (self.host, self.port)]
+        self.storage = self.storage_class(hosts=hosts, spool=self.spool.path)
+        self.worker = Worker(self.spool)
+        logging.getLogger('django_resto.spool').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('django_resto.spool').removeHandler(self.handler)
+        shutil.rmtree(self.tmpdir)
+        super(SpooledAsyncStorageTestCase, self).tearDown()
+
+    def test_save_and_delete(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEqual(len(self.spool), 1)
+        self.assertServerLogIs([])
+        self.assertTrue(self.worker.run_once())
+        self.assertEqual(self.get_file('test.txt'), b'test')
+        self.storage.delete('test.txt')
+        self.assertTrue(self.worker.run_once())
+        self.assertFalse(self.worker.run_once())
+        self.assertServerLogIs([('PUT', '/test.txt', 201),
+                                ('DELETE', '/test.txt', 204)])
+
+    def test_wait_for_replication(self):
+        self.storage.fallback_url = 'http://app.example.com/media/'
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.storage.pending_hosts('test.txt'),
+                set(self.storage.hosts))
+        self.assertEqual(self.storage.url('test.txt'),
+                'http://app.example.com/media/test.txt')
+        self.assertFalse(self.storage.wait_for_replication('test.txt', 0.01))
+        self.worker.run_once()
+        self.assertTrue(self.storage.wait_for_replication('test.txt', 0.01))
+        self.assertEqual(self.storage.url('test.txt'),
+                'http://media.example.com/test.txt')
+
+    def test_priority(self):
+        with operation(priority='bulk'):
+            self.storage.save('test.txt', ContentFile(b'test'))
+        self.storage.save('other.txt', ContentFile(b'other'))
+        # The normal job goes first.
+        self.assertTrue(self.worker.run_once())
+        self.assertTrue(self.worker.run_once())
+        self.assertServerLogIs([('PUT', '/other.txt', 201),
+                                ('PUT', '/test.txt', 201)])
+
+    def test_job_without_priority(self):
+        # Jobs enqueued by earlier versions don't have a priority.
+        payload = pickle.dumps((self.storage.transport, 'create', (b'test',),
+                {}, None), pickle.HIGHEST_PROTOCOL)
+        self.spool.put(self.storage.hosts[0], 'test.txt', payload)
+        self.assertTrue(self.worker.run_once())
+        self.assertEqual(self.get_file('test.txt'), b'test')
+        self.assertEqual(self.get_log(), "")
+
+    def test_failed_job(self):
+        self.http_server.readonly = True
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertTrue(self.worker.run_once())
+        self.assertIn("Failed to upload", self.get_log())
+        self.assertEqual(len(self.spool), 0)
+        self.assertServerLogIs([('PUT', '/test.txt', 403)])
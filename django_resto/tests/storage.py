@@ -1,25 +1,31 @@
 from __future__ import unicode_literals
 
 import datetime
+import errno
 import io
 import logging
 import os
 import os.path
 import pickle
 import shutil
+import tempfile
 import threading
 import time
 try:
-    from urllib.request import HTTPError
+    from urllib.request import HTTPError, URLError
 except ImportError:
-    from urllib2 import HTTPError
+    from urllib2 import HTTPError, URLError
 
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.utils import unittest
 
+from .. import concurrency, http_client
+from .. import storage as storage_module
+from ..concurrency import ByteBudget
 from ..storage import (DistributedStorage, HybridStorage, AsyncStorage,
-        UnexpectedStatusCode)
+        BatchError, UnexpectedStatusCode, WebDavTransport, next_sequence)
+from ..http_server import RelayHttpServer, TestHttpServer
 from .http_server import HttpServerTestCaseMixin, ExtraHttpServerTestCaseMixin
 
 
@@ -33,10 +39,13 @@ class StorageUtilitiesMixin(HttpServerTestCaseMixin):
         self.logger.addHandler(self.handler)
         hosts = ['%s:%d' % (self.host, self.port)]
         self.storage = self.storage_class(hosts=hosts)
+        self.delays = []
         if self.use_fs:
             os.makedirs(settings.MEDIA_ROOT)
 
     def tearDown(self):
+        for delay in self.delays:
+            delay.set()
         super(StorageUtilitiesMixin, self).tearDown()
         if self.use_fs:
             shutil.rmtree(settings.MEDIA_ROOT)
@@ -66,6 +75,21 @@ class StorageUtilitiesMixin(HttpServerTestCaseMixin):
             with open(filename, 'wb') as f:
                 f.write(content)
 
+    def delay_writes(self, server=None):
+        # Make a server wait until the returned event is set before it stores
+        # files. The event is set on tearDown.
+        if server is None:
+            server = self.http_server
+        delay = threading.Event()
+        create_file = server.create_file
+
+        def slow_create_file(name, content):
+            delay.wait()
+            create_file(name, content)
+        server.create_file = slow_create_file
+        self.delays.append(delay)
+        return delay
+
     def delete_file(self, name):
         self.http_server.delete_file(name)
         if self.use_fs:
@@ -444,6 +468,513 @@ class DistributedMiscTestCaseMixin(CommonMiscTestCaseMixin):
         self.assertIn("PUT on existing file", self.get_log())
 
 
+class ChunkedUploadTestCaseMixin(object):
+
+    def setUp(self):
+        super(ChunkedUploadTestCaseMixin, self).setUp()
+        self.storage.transport.chunk_size = 4
+
+    def test_save_chunked(self):
+        self.storage._save('test.txt', ContentFile(b'chunked'))
+        self.assertEqual(self.get_file('test.txt'), b'chunked')
+        self.assertEachServerLogIs([('PUT', '/test.txt', 202),
+                                    ('PUT', '/test.txt', 202),
+                                    ('PUT', '/test.txt', 201)])
+
+    def test_save_small_file_not_chunked(self):
+        self.storage._save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.get_file('test.txt'), b'test')
+        self.assertEachServerLogIs([('PUT', '/test.txt', 201)])
+
+    def test_save_chunked_resume(self):
+        self.http_server.partial_files['test.txt'] = (7, b'chun')
+        self.storage._save('test.txt', ContentFile(b'chunked'))
+        self.assertEqual(self.get_file('test.txt'), b'chunked')
+        self.assertServerLogIs([('PUT', '/test.txt', 202),
+                                ('PUT', '/test.txt', 201)])
+
+    def test_save_chunked_out_of_sync(self):
+        # Another client sends a byte behind our back after the first part.
+        http_server = self.http_server
+
+        def get_partial_file(name, total):
+            received = TestHttpServer.get_partial_file(http_server, name, total)
+            if received == b'chun':
+                received = b'chunk'
+                http_server.partial_files[name] = (total, received)
+            return received
+        http_server.get_partial_file = get_partial_file
+        self.storage._save('test.txt', ContentFile(b'chunked'))
+        self.assertEqual(self.get_file('test.txt'), b'chunked')
+        self.assertIn("Resuming upload", self.get_log())
+        self.assertServerLogIs([('PUT', '/test.txt', 202),
+                                ('PUT', '/test.txt', 202),
+                                ('PUT', '/test.txt', 416),
+                                ('PUT', '/test.txt', 202),
+                                ('PUT', '/test.txt', 201)])
+
+    def test_received(self):
+        self.http_server.partial_files['test.txt'] = (7, b'chun')
+        host = '%s:%d' % (self.host, self.port)
+        self.assertEqual(self.storage.transport.received(host, 'test.txt', 7), 4)
+        self.assertEqual(self.storage.transport.received(host, 'test.txt', 8), 0)
+
+
+class ReplicationLagTestCaseMixin(object):
+
+    def setUp(self):
+        super(ReplicationLagTestCaseMixin, self).setUp()
+        self.storage.fallback_url = 'http://app.example.com/media/'
+        self.replicate = self.delay_writes()
+
+    def test_url_during_replication(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.storage.pending_hosts('test.txt'),
+                set(self.storage.hosts))
+        self.assertEqual(self.storage.url('test.txt'),
+                'http://app.example.com/media/test.txt')
+        self.replicate.set()
+        self.assertTrue(self.storage.wait_for_replication('test.txt'))
+        self.assertEqual(self.storage.pending_hosts('test.txt'), set())
+        self.assertEqual(self.storage.url('test.txt'),
+                'http://media.example.com/test.txt')
+
+    def test_wait_for_replication_timeout(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertFalse(self.storage.wait_for_replication('test.txt', 0.01))
+        self.replicate.set()
+        self.assertTrue(self.storage.wait_for_replication('test.txt', 1))
+
+    def test_failed_replication_isnt_pending(self):
+        self.http_server.readonly = True
+        self.replicate.set()
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertTrue(self.storage.wait_for_replication('test.txt', 1))
+        self.assertIn("Failed to upload", self.get_log())
+        self.assertEqual(self.storage.url('test.txt'),
+                'http://media.example.com/test.txt')
+
+
+class SizeTierTestCaseMixin(object):
+
+    def setUp(self):
+        super(SizeTierTestCaseMixin, self).setUp()
+        self.storage.async_threshold = 8
+        self.replicate = self.delay_writes()
+
+    def wait_for_progress(self, name, expected):
+        # Uploads are blocked once the whole body was sent.
+        for _ in range(1000):
+            progress = self.storage.replication_progress(name)
+            if progress == expected:
+                break
+            time.sleep(0.001)
+        return progress
+
+    def test_save_small_file_synchronously(self):
+        self.replicate.set()
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.storage.pending_hosts('test.txt'), set())
+        self.assertEqual(self.get_file('test.txt'), b'test')
+
+    def test_save_large_file_asynchronously(self):
+        host = '%s:%d' % (self.host, self.port)
+        self.storage.save('test.txt', ContentFile(b'large file'))
+        self.assertEqual(self.storage.pending_hosts('test.txt'), set([host]))
+        expected = {host: (10, 10)}
+        self.assertEqual(self.wait_for_progress('test.txt', expected), expected)
+        self.replicate.set()
+        self.assertTrue(self.storage.wait_for_replication('test.txt', 1))
+        self.assertEqual(self.storage.replication_progress('test.txt'), {})
+        self.assertEqual(self.get_file('test.txt'), b'large file')
+
+    def test_progress_of_chunked_upload(self):
+        host = '%s:%d' % (self.host, self.port)
+        self.storage.transport.chunk_size = 4
+        self.storage.save('test.txt', ContentFile(b'large file'))
+        expected = {host: (10, 10)}
+        self.assertEqual(self.wait_for_progress('test.txt', expected), expected)
+        self.replicate.set()
+        self.assertTrue(self.storage.wait_for_replication('test.txt', 1))
+        self.assertEqual(self.get_file('test.txt'), b'large file')
+
+
+class ChainReplicationTestCaseMixin(object):
+
+    http_server_class = RelayHttpServer
+
+    def setUp(self):
+        super(ChainReplicationTestCaseMixin, self).setUp()
+        self.storage.chain_replication = True
+
+    def test_save_through_chain(self):
+        sent = []
+        with http_client.operation(progress=lambda n, total: sent.append(n)):
+            self.storage._save('test.txt', ContentFile(b'test'))
+        self.assertEqual(sent, [4])
+        self.assertEqual(self.alt_http_server.get_file('test.txt'), b'test')
+        self.assertEqual(self.http_server.get_file('test.txt'), b'test')
+        self.assertEachServerLogIs([('PUT', '/test.txt', 201)])
+
+    def test_save_failed_downstream(self):
+        self.http_server.readonly = True
+        self.assertRaises(HTTPError,
+                self.storage._save, 'test.txt', ContentFile(b'test'))
+        self.assertIn("Chain replication of test.txt failed on localhost:4080",
+                self.get_log())
+        self.assertAltServerLogIs([('PUT', '/test.txt', 201)])
+        self.assertServerLogIs([('PUT', '/test.txt', 403),
+                                ('PUT', '/test.txt', 403)])
+
+    def test_save_failed_upstream(self):
+        self.alt_http_server.unavailable = 1
+        self.storage._save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.alt_http_server.get_file('test.txt'), b'test')
+        self.assertAltServerLogIs([('PUT', '/test.txt', 503),
+                                   ('PUT', '/test.txt', 201)])
+        self.assertServerLogIs([('PUT', '/test.txt', 201)])
+
+    def test_save_without_relay(self):
+        self.storage.hosts = ['%s:%d' % (self.host, self.port + 9),
+                '%s:%d' % (self.host, self.port)]
+        self.storage.fatal_exceptions = False
+        self.storage._save('test.txt', ContentFile(b'test'))
+        self.assertIn("Failed to replicate test.txt through localhost:4089",
+                self.get_log())
+        self.assertEqual(self.http_server.get_file('test.txt'), b'test')
+
+
+class RetryTestCaseMixin(object):
+
+    def setUp(self):
+        super(RetryTestCaseMixin, self).setUp()
+        self.storage.transport.retries = 2
+        self.storage.transport.retry_delay = 0.001
+
+    def test_save_retry(self):
+        self.http_server.unavailable = 2
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.get_file('test.txt'), b'test')
+        self.assertIn("Retrying write on test.txt", self.get_log())
+        self.assertServerLogIs([('PUT', '/test.txt', 503),
+                                ('PUT', '/test.txt', 503),
+                                ('PUT', '/test.txt', 201)])
+
+    def test_save_retry_exhausted(self):
+        self.http_server.unavailable = 3
+        self.assertRaises(HTTPError, self.storage.save, 'test.txt',
+                ContentFile(b'test'))
+        self.assertServerLogIs([('PUT', '/test.txt', 503)] * 3)
+
+    def test_save_no_retry_on_client_error(self):
+        self.http_server.readonly = True
+        self.assertRaises(HTTPError, self.storage.save, 'test.txt',
+                ContentFile(b'test'))
+        self.assertServerLogIs([('PUT', '/test.txt', 403)])
+
+    def test_delete_retry(self):
+        self.create_file('test.txt', b'test')
+        self.http_server.unavailable = 1
+        self.storage.delete('test.txt')
+        self.assertFalse(self.has_file('test.txt'))
+        self.assertServerLogIs([('DELETE', '/test.txt', 503),
+                                ('DELETE', '/test.txt', 204)])
+
+    def test_retry_abandoned(self):
+        self.http_server.unavailable = 1
+        host = '%s:%d' % (self.host, self.port)
+        with http_client.operation(sequence=next_sequence('test.txt')):
+            # A more recent write starts before the retry.
+            next_sequence('test.txt')
+            self.assertEqual(
+                    self.storage.transport.create(host, 'test.txt', b'test'),
+                    None)
+        self.assertIn("Abandoned retry", self.get_log())
+        self.assertServerLogIs([('PUT', '/test.txt', 503)])
+
+    def test_stale_write(self):
+        host = '%s:%d' % (self.host, self.port)
+        older = next_sequence('test.txt')
+        self.storage.transport.create(host, 'test.txt', b'new')
+        with http_client.operation(sequence=older):
+            self.assertEqual(
+                    self.storage.transport.create(host, 'test.txt', b'old'),
+                    None)
+        self.assertEqual(self.http_server.get_file('test.txt'), b'new')
+        self.assertIn("Skipped stale write", self.get_log())
+        self.assertServerLogIs([('PUT', '/test.txt', 201),
+                                ('PUT', '/test.txt', 409)])
+
+
+class BatchLookupTestCaseMixin(object):
+
+    names = ['a.txt', 'b.txt', 'c.txt', 'd.txt']
+
+    def test_exists_many(self):
+        self.create_file('a.txt', b'a')
+        self.create_file('b.txt', b'bb')
+        self.assertEqual(self.storage.exists_many(self.names), {
+            'a.txt': True, 'b.txt': True, 'c.txt': False, 'd.txt': False})
+        # The lookups are spread over both servers.
+        self.assertEqual(len(self.http_server.log), 2)
+        self.assertEqual(len(self.alt_http_server.log), 2)
+
+    def test_size_many(self):
+        self.create_file('a.txt', b'a')
+        self.create_file('b.txt', b'bb')
+        self.assertEqual(self.storage.size_many(['a.txt', 'b.txt', 'a.txt']),
+                {'a.txt': 1, 'b.txt': 2})
+
+    def test_size_many_partial_failure(self):
+        self.create_file('a.txt', b'a')
+        with self.assertRaises(BatchError) as context:
+            self.storage.size_many(['a.txt', 'c.txt'])
+        self.assertEqual(context.exception.results, {'a.txt': 1})
+        self.assertEqual(list(context.exception.errors), ['c.txt'])
+        self.assertEqual(context.exception.errors['c.txt'].code, 404)
+        self.assertIn("Failed to get the size of c.txt", self.get_log())
+
+    def test_exists_many_failover(self):
+        self.create_file('a.txt', b'a')
+        self.alt_http_server.unavailable = 4
+        self.assertEqual(self.storage.exists_many(self.names), {
+            'a.txt': True, 'b.txt': False, 'c.txt': False, 'd.txt': False})
+        self.assertEqual(len(self.http_server.log), 4)
+        self.assertIn("Failed to check if", self.get_log())
+
+    def test_exists_many_all_hosts_down(self):
+        self.http_server.unavailable = 1
+        self.alt_http_server.unavailable = 1
+        with self.assertRaises(BatchError) as context:
+            self.storage.exists_many(['a.txt'])
+        self.assertEqual(context.exception.results, {})
+        self.assertEqual(context.exception.errors['a.txt'].code, 503)
+
+
+class WebDavTestCaseMixin(object):
+
+    def setUp(self):
+        super(WebDavTestCaseMixin, self).setUp()
+        self.storage = self.storage_class(hosts=self.storage.hosts,
+                transport=WebDavTransport)
+
+    def test_listdir(self):
+        self.create_file('test/foo.txt', b'foo')
+        self.create_file('test/bar.txt', b'bar')
+        self.create_file('test/baz/quux.txt', b'quux')
+        self.create_file('test/\xe9t\xe9.txt', b'summer')
+        listing = self.storage.listdir('test')
+        self.assertEqual(set(listing[0]), set(['baz']))
+        self.assertEqual(set(listing[1]),
+                set(['foo.txt', 'bar.txt', '\xe9t\xe9.txt']))
+        self.assertEqual(self.storage.listdir(''), (['test'], []))
+        self.assertServerLogIs([('PROPFIND', '/test/', 207),
+                                ('PROPFIND', '/', 207)])
+
+    def test_listdir_non_existing(self):
+        self.assertRaises(EnvironmentError, self.storage.listdir, 'test')
+        self.assertIn("Failed to list test", self.get_log())
+        self.assertServerLogIs([('PROPFIND', '/test/', 404)])
+
+    def test_listdir_stats(self):
+        self.create_file('test/foo.txt', b'foo')
+        self.create_file('test/baz/quux.txt', b'quux')
+        self.http_server.mtimes['test/foo.txt'] = 1000000000
+        self.assertEqual(self.storage.listdir_stats('test'), {
+            'foo.txt': (3, datetime.datetime.fromtimestamp(1000000000))})
+
+    def test_modified_time(self):
+        self.create_file('test.txt', b'test')
+        self.http_server.mtimes['test.txt'] = 1000000000
+        self.assertEqual(self.storage.modified_time('test.txt'),
+                datetime.datetime.fromtimestamp(1000000000))
+        self.assertServerLogIs([('PROPFIND', '/test.txt', 207)])
+
+    def test_modified_time_non_existing(self):
+        self.assertRaises(EnvironmentError, self.storage.modified_time,
+                'test.txt')
+        self.assertIn("Failed to get the modification time", self.get_log())
+
+
+class DeferredDeleteTestCaseMixin(object):
+
+    def setUp(self):
+        super(DeferredDeleteTestCaseMixin, self).setUp()
+        self.storage.deferred_deletes = True
+        self.release = threading.Event()
+        delete = self.storage.transport.delete
+
+        def slow_delete(host, name):
+            self.release.wait()
+            return delete(host, name)
+        self.storage.transport.delete = slow_delete
+
+    def tearDown(self):
+        self.release.set()
+        self.storage.flush_deletes()
+        super(DeferredDeleteTestCaseMixin, self).tearDown()
+
+    def test_delete(self):
+        self.create_file('test.txt', b'test')
+        self.storage.delete('test.txt')
+        self.assertFalse(self.storage.exists('test.txt'))
+        self.assertNotEqual(self.storage.get_available_name('test.txt'),
+                'test.txt')
+        self.assertFalse(self.storage.flush_deletes(0.01))
+        self.assertTrue(self.http_server.has_file('test.txt'))
+        self.release.set()
+        self.assertTrue(self.storage.flush_deletes(1))
+        self.assertFalse(self.http_server.has_file('test.txt'))
+        self.assertEqual(self.storage.get_available_name('test.txt'),
+                'test.txt')
+        self.assertIn(('DELETE', '/test.txt', 204), self.http_server.log)
+
+    def test_delete_many(self):
+        self.release.set()
+        self.storage.delete_batch_size = 2
+        for i in range(5):
+            self.create_file('test%d.txt' % i, b'test')
+        for i in range(5):
+            self.storage.delete('test%d.txt' % i)
+        self.assertTrue(self.storage.flush_deletes(1))
+        self.assertEqual(self.http_server.files, {})
+
+    def test_delete_failure(self):
+        self.release.set()
+        self.create_file('test.txt', b'test')
+        self.http_server.readonly = True
+        self.storage.delete('test.txt')
+        self.assertTrue(self.storage.flush_deletes(1))
+        self.assertIn("Failed to delete test.txt", self.get_log())
+
+    def test_save_cancels_delete(self):
+        self.create_file('test.txt', b'old')
+        self.storage.delete('test.txt')
+        self.release.set()
+        self.storage._save('test.txt', ContentFile(b'new'))
+        self.assertTrue(self.storage.flush_deletes(1))
+        self.assertEqual(self.get_file('test.txt'), b'new')
+
+
+class ZonesTestCaseMixin(object):
+
+    def setUp(self):
+        super(ZonesTestCaseMixin, self).setUp()
+        self.storage.zones = {'paris': ['localhost:4080'],
+                              'tokyo': ['localhost:4081']}
+        self.storage.local_zone = 'paris'
+        self.replicate = self.delay_writes(self.alt_http_server)
+
+    def tearDown(self):
+        self.replicate.set()
+        self.sync_remote()
+        super(ZonesTestCaseMixin, self).tearDown()
+
+    def sync_remote(self):
+        # Wait until only the main thread and the HTTP servers are running.
+        while threading.active_count() > 1 + self.num_threads:
+            time.sleep(0.001)
+
+    def test_split_hosts(self):
+        self.assertEqual(self.storage.split_hosts(),
+                (['localhost:4080'], ['localhost:4081']))
+        self.storage.local_zone = None
+        self.assertEqual(self.storage.split_hosts(),
+                (self.storage.hosts, []))
+
+    def test_save_async_to_remote_zones(self):
+        self.storage._save('test.txt', ContentFile(b'test'))
+        # The upload to the remote zone doesn't delay the save.
+        self.assertServerLogIs([('PUT', '/test.txt', 201)])
+        self.assertFalse(self.alt_http_server.has_file('test.txt'))
+        self.replicate.set()
+        self.sync_remote()
+        self.assertAltServerLogIs([('PUT', '/test.txt', 201)])
+        self.assertEqual(self.alt_http_server.get_file('test.txt'), b'test')
+
+    def test_remote_failure(self):
+        self.replicate.set()
+        self.alt_http_server.readonly = True
+        self.storage._save('test.txt', ContentFile(b'test'))
+        self.sync_remote()
+        self.assertIn("test.txt on localhost:4081", self.get_log())
+
+
+class StripesTestCaseMixin(object):
+
+    def setUp(self):
+        super(StripesTestCaseMixin, self).setUp()
+        self.storage.stripe_size = 4
+
+    def test_open_stripes(self):
+        self.create_file('test.txt', b'0123456789')
+        self.http_server.log = []
+        self.alt_http_server.log = []
+        self.storage.size = lambda name: 10
+        with self.storage.open('test.txt') as f:
+            self.assertEqual(f.size, 10)
+            self.assertEqual(f.read(3), b'012')
+            self.assertEqual(f.read(), b'3456789')
+        # The stripes are spread over both servers.
+        self.assertEqual(sorted(self.http_server.log +
+                self.alt_http_server.log), [('GET', '/test.txt', 206)] * 3)
+        self.assertTrue(self.http_server.log)
+        self.assertTrue(self.alt_http_server.log)
+
+    def test_open_small_file(self):
+        self.create_file('test.txt', b'test')
+        with self.storage.open('test.txt') as f:
+            self.assertEqual(f.read(), b'test')
+        self.assertEqual(sorted(self.http_server.log +
+                self.alt_http_server.log),
+                [('GET', '/test.txt', 200), ('HEAD', '/test.txt', 200)])
+
+    def test_open_stripes_failover(self):
+        self.create_file('test.txt', b'0123456789')
+        self.storage.size = lambda name: 10
+        self.alt_http_server.unavailable = 3
+        with self.storage.open('test.txt') as f:
+            self.assertEqual(f.read(), b'0123456789')
+        self.assertIn("Failed to download test.txt", self.get_log())
+
+    def test_open_stripes_failure(self):
+        self.create_file('test.txt', b'0123456789')
+        self.storage.size = lambda name: 10
+        self.http_server.unavailable = 3
+        self.alt_http_server.unavailable = 3
+        with self.storage.open('test.txt') as f:
+            with self.assertRaises(HTTPError):
+                f.read()
+        while threading.active_count() > 1 + self.num_threads:
+            time.sleep(0.01)
+
+    def test_open_without_ranges(self):
+        self.create_file('test.txt', b'0123456789')
+        self.storage.size = lambda name: 10
+        self.alt_http_server.ranges = False
+        with self.storage.open('test.txt') as f:
+            self.assertEqual(f.read(5), b'01234')
+            self.assertEqual(f.read(), b'56789')
+        self.assertIn(('GET', '/test.txt', 200), self.alt_http_server.log)
+
+    def test_read_after_failed_stripe(self):
+        self.create_file('test.txt', b'0123456789')
+        self.storage.size = lambda name: 10
+        content_range = self.storage.transport.content_range
+
+        def broken_content_range(host, name, start, end):
+            if start == 0:
+                raise URLError("broken")
+            return content_range(host, name, start, end)
+        self.storage.transport.content_range = broken_content_range
+        with self.storage.open('test.txt') as f:
+            with self.assertRaises(URLError):
+                f.read(4)
+            # The rest of the file isn't returned without the first stripe.
+            with self.assertRaises(URLError):
+                f.read()
+
+
 class UseDistributedStorageMixin(object):
 
     storage_class = DistributedStorage
@@ -528,3 +1059,200 @@ class AsyncStorageMiscTestCase(
         StorageUtilitiesMixin, unittest.TestCase):
 
     pass
+
+
+class DistributedStorageChunkedUploadTestCase(
+        UseDistributedStorageMixin, ChunkedUploadTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    pass
+
+
+class HybridStorageChunkedUploadWithTwoServersTestCase(
+        UseHybridStorageMixin, ChunkedUploadTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    pass
+
+
+class AsyncStorageReplicationLagTestCase(
+        UseAsyncStorageMixin, ReplicationLagTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    pass
+
+
+class HybridStorageRetryTestCase(
+        UseHybridStorageMixin, RetryTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    pass
+
+
+class HybridStorageSizeTierTestCase(
+        UseHybridStorageMixin, SizeTierTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    pass
+
+
+class DistributedStorageChainReplicationTestCase(
+        UseDistributedStorageMixin, ChainReplicationTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    pass
+
+
+class HybridStorageChainReplicationTestCase(
+        UseHybridStorageMixin, ChainReplicationTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    def test_save_single_host(self):
+        self.storage.hosts = self.storage.hosts[:1]
+        executed = []
+        execute = self.storage.execute
+
+        def spy(func, url, *args):
+            executed.append(url)
+            return execute(func, url, *args)
+        self.storage.execute = spy
+        self.storage._save('test.txt', ContentFile(b'test'))
+        # Without a chain, the file is uploaded like without chain replication.
+        self.assertEqual(executed, ['test.txt'])
+        self.assertAltServerLogIs([('PUT', '/test.txt', 201)])
+
+
+class DistributedStorageBatchLookupWithTwoServersTestCase(
+        UseDistributedStorageMixin, BatchLookupTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    pass
+
+
+class DistributedStorageWebDavTestCase(
+        UseDistributedStorageMixin, WebDavTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    pass
+
+
+class DistributedStorageDeferredDeleteTestCase(
+        UseDistributedStorageMixin, DeferredDeleteTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    def test_batch_lookups(self):
+        self.create_file('a.txt', b'a')
+        self.create_file('b.txt', b'bb')
+        self.storage.delete('a.txt')
+        self.assertEqual(self.storage.exists_many(['a.txt', 'b.txt']),
+                {'a.txt': False, 'b.txt': True})
+        self.assertRaises(OSError, self.storage.size, 'a.txt')
+        with self.assertRaises(BatchError) as context:
+            self.storage.size_many(['a.txt', 'b.txt'])
+        self.assertEqual(context.exception.results, {'b.txt': 2})
+        self.assertEqual(context.exception.errors['a.txt'].errno, errno.ENOENT)
+        # Deleted files aren't looked up on the media servers.
+        self.assertServerLogIs([('HEAD', '/b.txt', 200)] * 2)
+
+    def test_batch_lookups_from_iterator(self):
+        self.create_file('a.txt', b'a')
+        self.create_file('b.txt', b'bb')
+        self.storage.delete('a.txt')
+        self.assertEqual(self.storage.exists_many(iter(['a.txt', 'b.txt'])),
+                {'a.txt': False, 'b.txt': True})
+        with self.assertRaises(BatchError) as context:
+            self.storage.size_many(name for name in ['a.txt', 'b.txt'])
+        self.assertEqual(context.exception.results, {'b.txt': 2})
+
+
+class HybridStorageDeferredDeleteTestCase(
+        UseHybridStorageMixin, DeferredDeleteTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    pass
+
+
+class DistributedStorageStripesWithTwoServersTestCase(
+        UseDistributedStorageMixin, StripesTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    pass
+
+
+class DistributedStorageZonesTestCase(
+        UseDistributedStorageMixin, ZonesTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    def test_read_from_local_zone(self):
+        self.replicate.set()
+        self.create_file('test.txt', b'test')
+        for _ in range(5):
+            self.assertEqual(self.storage.size('test.txt'), 4)
+        self.assertEqual(self.storage.exists_many(['test.txt', 'a.txt']),
+                {'test.txt': True, 'a.txt': False})
+        self.assertAltServerLogIs([])
+
+    def test_remote_bodies_within_budget(self):
+        # While the storage saves a file, its body counts twice.
+        concurrency._budget = ByteBudget(10)
+        try:
+            self.storage._save('a.txt', ContentFile(b'test'))
+            # The body is kept in memory until the remote zone has it.
+            self.assertEqual(concurrency.get_budget().stats()['in_use'], 4)
+            self.storage._save('b.txt', ContentFile(b'large'))
+            self.assertEqual(concurrency.get_budget().stats()['in_use'], 4)
+            self.replicate.set()
+            self.sync_remote()
+            self.assertEqual(concurrency.get_budget().stats()['in_use'], 0)
+        finally:
+            concurrency._budget = None
+        self.assertEqual(self.alt_http_server.get_file('a.txt'), b'test')
+        self.assertEqual(self.alt_http_server.get_file('b.txt'), b'large')
+
+    def test_remote_setup_failure(self):
+        self.storage.remote_slots = threading.Semaphore(1)
+        spill_body = storage_module._spill_body
+
+        def _spill_body(content):
+            raise IOError("No space left on device.")
+        concurrency._budget = ByteBudget(0)
+        storage_module._spill_body = _spill_body
+        try:
+            self.assertRaises(IOError, self.storage._save, 'a.txt',
+                    ContentFile(b'test'))
+        finally:
+            storage_module._spill_body = spill_body
+            concurrency._budget = None
+        # The slot of the failed action was released.
+        self.assertTrue(self.storage.remote_slots.acquire(False))
+        self.storage.remote_slots.release()
+
+    def test_manifest_statuses(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            storage = self.storage_class(hosts=self.storage.hosts,
+                    manifest=os.path.join(tmpdir, 'manifest.db'))
+            storage.zones = self.storage.zones
+            storage.local_zone = self.storage.local_zone
+            storage._save('test.txt', ContentFile(b'test'))
+            # The remote zone doesn't have the file yet.
+            self.assertEqual(storage.manifest.statuses('test.txt'), {
+                'localhost:4080': 'present', 'localhost:4081': 'missing'})
+            self.replicate.set()
+            self.sync_remote()
+            self.assertEqual(storage.manifest.statuses('test.txt'), {
+                'localhost:4080': 'present', 'localhost:4081': 'present'})
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class HybridStorageZonesTestCase(
+        UseHybridStorageMixin, ZonesTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    def test_pending_remote_zones(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.storage.pending_hosts('test.txt'),
+                set(['localhost:4081']))
+        self.replicate.set()
+        self.assertTrue(self.storage.wait_for_replication('test.txt', 1))
@@ -0,0 +1,113 @@
+from __future__ import unicode_literals
+
+import os.path
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import unittest
+
+from ..replay import Replayer
+from ..trace import Recorder, read_trace
+from .storage import StorageUtilitiesMixin
+from .storage import UseDistributedStorageMixin, UseHybridStorageMixin
+
+
+class TraceTestCaseMixin(object):
+
+    def setUp(self):
+        super(TraceTestCaseMixin, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'trace.jsonl')
+        self.storage.recorder = Recorder(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(TraceTestCaseMixin, self).tearDown()
+
+    def get_trace(self):
+        # Return (operation, name, size, host, outcome) for each request.
+        return [record[1:5] + record[6:]
+                for record in read_trace(self.path)]
+
+
+class DistributedStorageTraceTestCase(
+        UseDistributedStorageMixin, TraceTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    def test_record(self):
+        self.storage._save('test.txt', ContentFile(b'test'))
+        self.assertTrue(self.storage.exists('test.txt'))
+        self.assertEqual(self.storage.open('test.txt').read(), b'test')
+        self.storage.delete('test.txt')
+        self.assertEqual(self.get_trace(), [
+            ('create', 'test.txt', 4, 'localhost:4080', 'ok'),
+            ('exists', 'test.txt', None, 'localhost:4080', 'ok'),
+            ('content', 'test.txt', 4, 'localhost:4080', 'ok'),
+            ('delete', 'test.txt', None, 'localhost:4080', 'ok'),
+        ])
+        for record in read_trace(self.path):
+            self.assertTrue(record[5] >= 0)
+
+    def test_record_failure(self):
+        self.http_server.readonly = True
+        self.assertRaises(Exception, self.storage._save, 'test.txt',
+                ContentFile(b'test'))
+        self.assertEqual(self.get_trace(), [
+            ('create', 'test.txt', 4, 'localhost:4080', '403'),
+        ])
+
+
+class HybridStorageTraceTestCase(
+        UseHybridStorageMixin, TraceTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    def test_record_upload(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        self.assertEqual(self.get_trace(), [
+            ('upload', 'test.txt', 4, 'localhost:4080', 'ok'),
+        ])
+
+
+class ReplayTestCase(unittest.TestCase):
+
+    records = [
+        (1000.0, 'create', 'a.txt', 4, 'h1', 0.01, 'ok'),
+        (1000.0, 'create', 'a.txt', 4, 'h2', 0.02, 'ok'),
+        (1000.1, 'content', 'b.txt', 100, 'h1', 0.01, 'ok'),
+        (1000.1, 'exists', 'c.txt', None, 'h2', 0.01, 'ok'),
+        (1000.2, 'listdir', '', None, 'h1', 0.01, 'ok'),
+        (1000.3, 'delete', 'a.txt', None, 'h1', 0.01, 'ok'),
+        (1000.3, 'delete', 'b.txt', None, 'h1', 0.01, 'ok'),
+    ]
+
+    def test_replay(self):
+        report = Replayer(self.records, speed=10, threads=2).run()
+        self.assertEqual(report['requests'], 6)
+        self.assertEqual(report['skipped'], 1)
+        self.assertEqual(report['errors'], 0)
+        self.assertTrue(report['duration'] >= 0.03)
+        self.assertEqual(report['operations']['create']['count'], 2)
+        self.assertEqual(report['operations']['create']['recorded_p50'], 0.01)
+        self.assertEqual(report['operations']['delete']['count'], 2)
+
+    def test_command(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'trace.jsonl')
+            recorder = Recorder(path)
+            for record in self.records:
+                recorder.record(*record)
+            output = os.path.join(tmpdir, 'output.txt')
+            with open(output, 'w') as stdout:
+                call_command('resto_replay', path, speed=10, stdout=stdout)
+            with open(output) as stdout:
+                report = stdout.read()
+            self.assertIn("Replayed 6 requests", report)
+            self.assertIn("create", report)
+            self.assertRaises(CommandError, call_command, 'resto_replay',
+                    os.path.join(tmpdir, 'missing.jsonl'))
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,176 @@
+from __future__ import unicode_literals
+
+import io
+import json
+import os.path
+import shutil
+import tempfile
+import threading
+
+from django.core.files.base import ContentFile
+from django.utils import unittest
+
+from .. import tracing
+from .storage import StorageUtilitiesMixin, StorageUtilitiesWithTwoServersMixin
+from .storage import UseDistributedStorageMixin, UseHybridStorageMixin
+
+
+class TracingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = tracing.MemoryExporter()
+        tracing.add_exporter(self.exporter)
+
+    def tearDown(self):
+        tracing.remove_exporter(self.exporter)
+
+    def test_span_tree(self):
+        with tracing.span('parent', file='test.txt'):
+            parent = tracing.get_current_span()
+            with tracing.span('child'):
+                pass
+        self.assertIsNone(tracing.get_current_span())
+        child, = self.exporter.get_spans('child')
+        self.assertEqual(self.exporter.get_spans(), [child, parent])
+        self.assertEqual(child.parent_id, parent.span_id)
+        self.assertEqual(child.trace_id, parent.trace_id)
+        self.assertIsNone(parent.parent_id)
+        self.assertEqual(parent.attributes, {'file': 'test.txt'})
+        self.assertTrue(parent.duration >= child.duration >= 0)
+
+    def test_span_error(self):
+        with self.assertRaises(ValueError):
+            with tracing.span('test'):
+                raise ValueError
+        span, = self.exporter.get_spans()
+        self.assertEqual(span.error, 'ValueError')
+
+    def test_activate_in_thread(self):
+        with tracing.span('parent'):
+            parent = tracing.get_current_span()
+
+            def child():
+                with tracing.activate(parent), tracing.span('child'):
+                    pass
+            thread = threading.Thread(target=child)
+            thread.start()
+            thread.join()
+        child, = self.exporter.get_spans('child')
+        self.assertEqual(child.parent_id, parent.span_id)
+
+    def test_no_exporters(self):
+        tracing.remove_exporter(self.exporter)
+        try:
+            self.assertIsNone(tracing.start_span('test'))
+            with tracing.span('test'):
+                self.assertIsNone(tracing.get_current_span())
+        finally:
+            tracing.add_exporter(self.exporter)
+
+    def test_json_lines_exporter(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'spans.jsonl')
+            exporter = tracing.JsonLinesExporter(path)
+            tracing.add_exporter(exporter)
+            try:
+                with tracing.span('parent'):
+                    with tracing.span('child', host='localhost:4080'):
+                        pass
+            finally:
+                tracing.remove_exporter(exporter)
+            with io.open(path, encoding='utf-8') as spans:
+                child, parent = [json.loads(line) for line in spans]
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(child['name'], 'child')
+        self.assertEqual(child['parent'], parent['span'])
+        self.assertEqual(child['attributes'], {'host': 'localhost:4080'})
+        self.assertIsNone(child['error'])
+
+
+class TracingTestCaseMixin(object):
+
+    def setUp(self):
+        super(TracingTestCaseMixin, self).setUp()
+        self.exporter = tracing.MemoryExporter()
+        tracing.add_exporter(self.exporter)
+
+    def tearDown(self):
+        tracing.remove_exporter(self.exporter)
+        super(TracingTestCaseMixin, self).tearDown()
+
+    def get_children(self, span, name=None):
+        return [child for child in self.exporter.get_spans(name)
+                if child.parent_id == span.span_id]
+
+
+class DistributedStorageTracingWithTwoServersTestCase(
+        UseDistributedStorageMixin, TracingTestCaseMixin,
+        StorageUtilitiesWithTwoServersMixin, unittest.TestCase):
+
+    def test_save(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        save, = self.exporter.get_spans('save')
+        self.assertEqual(save.attributes, {'file': 'test.txt'})
+        hosts = self.get_children(save, 'host')
+        self.assertEqual(sorted(span.attributes['host'] for span in hosts),
+                ['localhost:4080', 'localhost:4081'])
+        for host in hosts:
+            self.assertEqual(host.attributes['action'], 'create')
+            send, = self.get_children(host, 'send')
+            self.assertEqual(send.attributes, {'size': 4})
+            self.assertEqual(len(self.get_children(host, 'first_byte')), 1)
+
+    def test_open(self):
+        self.create_file('test.txt', b'test')
+        self.assertEqual(self.storage.open('test.txt').read(), b'test')
+        open_, = self.exporter.get_spans('open')
+        host, = self.get_children(open_, 'host')
+        self.assertEqual(host.attributes['action'], 'content')
+        self.assertEqual(len(self.get_children(host, 'body')), 1)
+
+    def test_failure(self):
+        self.alt_http_server.readonly = True
+        with self.assertRaises(Exception):
+            self.storage.save('test.txt', ContentFile(b'test'))
+        save, = self.exporter.get_spans('save')
+        self.assertEqual(save.error, '403')
+        errors = dict((span.attributes['host'], span.error)
+                for span in self.get_children(save, 'host'))
+        self.assertEqual(errors,
+                {'localhost:4080': None, 'localhost:4081': '403'})
+
+
+class HybridStorageTracingTestCase(
+        UseHybridStorageMixin, TracingTestCaseMixin,
+        StorageUtilitiesMixin, unittest.TestCase):
+
+    def test_save(self):
+        self.storage.save('test.txt', ContentFile(b'test'))
+        save, = self.exporter.get_spans('save')
+        # The local file is saved before the upload runs on the media servers.
+        execute, = self.get_children(save, 'execute')
+        host, = self.get_children(execute, 'host')
+        self.assertEqual(host.attributes['action'], 'upload')
+        read, = self.get_children(host, 'read_content')
+        self.assertEqual(read.attributes, {'size': 4})
+
+    def test_json_lines_exporter(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'spans.jsonl')
+            exporter = tracing.JsonLinesExporter(path)
+            tracing.add_exporter(exporter)
+            try:
+                self.storage.save('test.txt', ContentFile(b'test'))
+                self.storage.delete('test.txt')
+            finally:
+                tracing.remove_exporter(exporter)
+            with io.open(path, encoding='utf-8') as spans:
+                spans = [json.loads(line) for line in spans]
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(len(spans), len(self.exporter.get_spans()))
+        self.assertEqual([span['attributes'] for span in spans
+                if span['name'] == 'execute'], [{'file': 'test.txt'}] * 2)
@@ -0,0 +1,103 @@
+from __future__ import unicode_literals
+
+import os
+import os.path
+
+from django.conf import settings
+from django.utils import unittest
+
+from ..watcher import Inotify, Watcher
+from .storage import StorageUtilitiesMixin, UseHybridStorageMixin
+
+
+try:
+    Inotify().close()
+except OSError:                                             # cover: disable
+    has_inotify = False
+else:
+    has_inotify = True
+
+
+@unittest.skipUnless(has_inotify, "inotify isn't available")
+class WatcherTestCase(
+        UseHybridStorageMixin, StorageUtilitiesMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(WatcherTestCase, self).setUp()
+        self.watcher = Watcher(self.storage, debounce=0)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.close()
+        super(WatcherTestCase, self).tearDown()
+
+    def write(self, name, content):
+        with open(os.path.join(settings.MEDIA_ROOT, name), 'wb') as f:
+            f.write(content)
+
+    def replicate(self):
+        for event in self.watcher.inotify.read(0.1):
+            self.watcher.handle(*event)
+        self.watcher.flush(force=True)
+
+    def test_create_modify_and_delete(self):
+        self.write('test.txt', b'test')
+        self.replicate()
+        self.assertEqual(self.get_file('test.txt'), b'test')
+        self.write('test.txt', b'modified')
+        self.replicate()
+        self.assertEqual(self.get_file('test.txt'), b'modified')
+        os.unlink(os.path.join(settings.MEDIA_ROOT, 'test.txt'))
+        self.replicate()
+        self.assertFalse(self.has_file('test.txt'))
+        self.assertEqual(self.watcher.pending, {})
+
+    def test_rename(self):
+        self.write('test.txt', b'test')
+        self.replicate()
+        os.rename(os.path.join(settings.MEDIA_ROOT, 'test.txt'),
+                os.path.join(settings.MEDIA_ROOT, 'renamed.txt'))
+        self.replicate()
+        self.assertFalse(self.has_file('test.txt'))
+        self.assertEqual(self.get_file('renamed.txt'), b'test')
+
+    def test_new_directory(self):
+        os.mkdir(os.path.join(settings.MEDIA_ROOT, 'dir'))
+        self.replicate()
+        self.write('dir/test.txt', b'test')
+        self.replicate()
+        self.assertEqual(self.get_file('dir/test.txt'), b'test')
+
+    def test_debounce(self):
+        self.watcher.debounce = 60
+        self.write('test.txt', b'test')
+        self.watcher.process_events(0.1)
+        self.assertFalse(self.has_file('test.txt'))
+        self.assertEqual(list(self.watcher.pending), ['test.txt'])
+        self.watcher.flush(force=True)
+        self.assertEqual(self.get_file('test.txt'), b'test')
+
+    def test_file_being_written(self):
+        with open(os.path.join(settings.MEDIA_ROOT, 'test.txt'), 'wb') as f:
+            f.write(b'part1')
+            f.flush()
+            self.replicate()
+            self.assertFalse(self.has_file('test.txt'))
+            f.write(b'part2')
+        self.replicate()
+        self.assertEqual(self.get_file('test.txt'), b'part1part2')
+
+    def test_metadata_change(self):
+        self.write('test.txt', b'test')
+        self.replicate()
+        self.http_server.log = []
+        os.chmod(os.path.join(settings.MEDIA_ROOT, 'test.txt'), 0o600)
+        os.utime(os.path.join(settings.MEDIA_ROOT, 'test.txt'), None)
+        self.replicate()
+        self.assertServerLogIs([])
+
+    def test_changes_made_by_the_storage(self):
+        # Replicating again a file that the storage saved is harmless.
+        self.create_file('test.txt', b'test')
+        self.replicate()
+        self.assertEqual(self.get_file('test.txt'), b'test')
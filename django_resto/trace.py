@@ -0,0 +1,63 @@
+"""Trace of the requests sent to the media servers, for replay by
+resto_replay.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import io
+import json
+import threading
+try:                                                        # cover: disable
+    from urllib.request import HTTPError
+except ImportError:
+    from urllib2 import HTTPError
+
+
+def get_outcome(exc):
+    """Describe the outcome of a request that raised an exception."""
+    if isinstance(exc, HTTPError):
+        return '%d' % exc.code
+    return type(exc).__name__
+
+
+class Recorder(object):
+
+    """Append requests to a trace file.
+
+    Each line of the file is a JSON array: [timestamp, operation, name, size,
+    host, latency, outcome]. size is the length of the body that was sent or
+    received, or null. outcome is 'ok', an HTTP status code, or the name of an
+    exception.
+
+    Like Spool, each record opens the file, so a recorder can be shared
+    between threads and processes, and pickled along with a storage.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def record(self, timestamp, operation, name, size, host, latency,
+            outcome='ok'):
+        """Append a request to the trace."""
+        line = json.dumps([round(timestamp, 6), operation, name, size, host,
+                round(latency, 6), outcome], separators=(',', ':'))
+        with self.lock:
+            with io.open(self.path, 'a', encoding='utf-8') as trace:
+                trace.write(line + '\n')
+
+
+def read_trace(path):
+    """Iterate over the records of a trace file, as tuples."""
+    with io.open(path, encoding='utf-8') as trace:
+        for line in trace:
+            if line.strip():
+                yield tuple(json.loads(line))
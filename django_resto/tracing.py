@@ -0,0 +1,234 @@
+"""Spans that time storage operations, the requests they send to each media
+server and the phases of these requests, for exporters.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import contextlib
+import functools
+import io
+import json
+import logging
+import random
+import threading
+import time
+
+from .settings import get_setting
+from .trace import get_outcome
+
+
+logger = logging.getLogger(__name__)
+
+
+class Span(object):
+
+    """Timing of a part of an operation.
+
+    Spans form a tree: a span of a storage operation is the parent of the
+    spans of the requests sent to each host, which are the parents of the
+    spans of the phases of these requests. All the spans of a tree share the
+    same trace id.
+    """
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.span_id = '%016x' % random.getrandbits(64)
+        if parent is None:
+            self.trace_id = '%016x' % random.getrandbits(64)
+            self.parent_id = None
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self):
+        if self.end is not None:
+            return self.end - self.start
+
+    def finish(self, exc=None):
+        """End the span and export it. exc is the exception that ended it."""
+        if self.end is not None:
+            return
+        self.end = time.time()
+        if exc is not None:
+            self.error = get_outcome(exc)
+        for exporter in get_exporters():
+            try:
+                exporter.export(self)
+            except Exception:
+                logger.exception("Failed to export span %s.", self.name)
+
+    def to_dict(self):
+        """Return the span as a dict that can be serialized to JSON."""
+        return {
+            'trace': self.trace_id,
+            'span': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'start': round(self.start, 6),
+            'duration': round(self.duration, 6),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class MemoryExporter(object):
+
+    """Keep spans in a list, mostly for tests."""
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def get_spans(self, name=None):
+        """Return the spans exported so far, with the given name if any."""
+        with self.lock:
+            return [span for span in self.spans
+                    if name is None or span.name == name]
+
+    def clear(self):
+        with self.lock:
+            self.spans = []
+
+
+class JsonLinesExporter(object):
+
+    """Append spans to a file, one JSON object per line, see Span.to_dict().
+
+    Like Recorder, each span opens the file, so an exporter can be shared
+    between threads and processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), separators=(',', ':'),
+                sort_keys=True)
+        with self.lock:
+            with io.open(self.path, 'a', encoding='utf-8') as spans:
+                spans.write(line + '\n')
+
+
+### Exporters
+
+_exporters = []
+
+_exporters_lock = threading.Lock()
+
+# Exporter for RESTO_SPANS, created on first use. False means none.
+_default_exporter = None
+
+
+def add_exporter(exporter):
+    """Send the spans that end from now on to exporter.export(span)."""
+    with _exporters_lock:
+        _exporters.append(exporter)
+
+
+def remove_exporter(exporter):
+    """Stop sending spans to an exporter."""
+    with _exporters_lock:
+        _exporters.remove(exporter)
+
+
+def get_exporters():
+    """Return the list of exporters, including the one of RESTO_SPANS."""
+    global _default_exporter
+    if _default_exporter is None:
+        path = get_setting('SPANS')
+        _default_exporter = False if path is None else JsonLinesExporter(path)
+    exporters = list(_exporters)
+    if _default_exporter:
+        exporters.append(_default_exporter)
+    return exporters
+
+
+### Current span
+
+_local = threading.local()
+
+
+def get_current_span():
+    """Return the span running in this thread, or None."""
+    return getattr(_local, 'span', None)
+
+
+@contextlib.contextmanager
+def activate(span):
+    """Context manager that makes span the parent of new spans in this thread.
+
+    Capture the current span before starting a thread and activate it in the
+    thread to attach the spans of the thread to it.
+    """
+    previous = get_current_span()
+    _local.span = span
+    try:
+        yield
+    finally:
+        _local.span = previous
+
+
+def start_span(name, **attributes):
+    """Start a child of the current span and return it, or None if there are
+    no exporters. The caller must call finish() on the span.
+
+    The span doesn't become the current span.
+    """
+    if not _exporters and _default_exporter is False:
+        return None
+    if not get_exporters():
+        return None
+    return Span(name, get_current_span(), attributes)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Context manager that runs a child of the current span.
+
+    The span becomes the current span until it ends. Spans are only created
+    when there are exporters.
+    """
+    current = start_span(name, **attributes)
+    if current is None:
+        yield
+        return
+    with activate(current):
+        try:
+            yield
+        except BaseException as exc:
+            current.finish(exc)
+            raise
+        finally:
+            current.finish()
+
+
+def traced(func=None, index=0):
+    """Decorator that runs a storage method in a span, named after it.
+
+    The argument of the method at index, the first one by default, is
+    recorded as 'file', if there is one. Use @traced(index=...) to record
+    another argument.
+    """
+    if func is None:
+        return functools.partial(traced, index=index)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        attributes = {}
+        if len(args) > index:
+            attributes['file'] = args[index]
+        with span(func.__name__.lstrip('_'), **attributes):
+            return func(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,43 @@
+"""Views exposing the state of django-resto.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import json
+
+from django.core.files.storage import default_storage
+from django.http import Http404, HttpResponse
+
+from .settings import get_setting
+
+
+def host_status(request, storage=None, max_unhealthy=None):
+    """Return the health of the media servers of a storage as JSON.
+
+    The storage defaults to the default storage. 'healthy' is False when a
+    media server is unhealthy. The response is "503 Service Unavailable" when
+    no media server is healthy, or more than max_unhealthy are unhealthy, for
+    load balancers and monitoring systems. max_unhealthy defaults to
+    RESTO_HEALTH_MAX_UNHEALTHY.
+    """
+    if storage is None:
+        storage = default_storage
+    if max_unhealthy is None:
+        max_unhealthy = get_setting('HEALTH_MAX_UNHEALTHY')
+    try:
+        get_status = storage.host_status
+    except AttributeError:
+        raise Http404("The storage doesn't use media servers.")
+    hosts = get_status()
+    unhealthy = sum(1 for status in hosts.values() if not status['healthy'])
+    available = unhealthy < len(hosts) and (
+            max_unhealthy is None or unhealthy <= max_unhealthy)
+    content = json.dumps({
+        'healthy': unhealthy == 0,
+        'degraded': available and unhealthy > 0,
+        'hosts': hosts,
+    }, indent=2, sort_keys=True)
+    return HttpResponse(content, content_type='application/json',
+            status=200 if available else 503)
@@ -0,0 +1,234 @@
+"""Replication of changes made in MEDIA_ROOT outside the storage API, run by
+resto_watch. It relies on inotify, so it only works on Linux.
+
+See the README for more information.
+"""
+
+from __future__ import unicode_literals
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import os.path
+import select
+import signal
+import struct
+import sys
+import time
+
+from .concurrency import map_in_threads
+
+
+logger = logging.getLogger(__name__)
+
+
+# Constants from <sys/inotify.h>.
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+EVENT = struct.Struct(str('iIII'))
+
+
+class Inotify(object):
+
+    """Minimal wrapper around the inotify API of Linux, with ctypes."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify isn't available.")
+        self.libc = libc
+        self.fd = self._check(libc.inotify_init1(IN_CLOEXEC))
+
+    def _check(self, result):
+        if result < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return result
+
+    def add_watch(self, path, mask):
+        """Watch a file or a directory and return the watch descriptor."""
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        return self._check(self.libc.inotify_add_watch(self.fd, path, mask))
+
+    def read(self, timeout=None):
+        """Return a list of (wd, mask, cookie, name) tuples.
+
+        Wait up to timeout seconds for events, forever if timeout is None.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie,
+                    name.decode(sys.getfilesystemencoding())))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+
+    """Replicate the changes made in the directory of a HybridStorage.
+
+    Files that are closed after writing, moved or deleted are replicated
+    once they haven't changed for `debounce` seconds, with up to `threads`
+    concurrent replications. Whether a file is uploaded or deleted on the
+    media servers depends on whether it still exists then. Files that are
+    still open for writing wait until they're closed.
+    """
+
+    # Maximum time to wait for events before checking if the watcher should
+    # stop.
+    poll_interval = 0.5
+
+    # Creating a file and changing its metadata don't trigger replication.
+    # Writes only delay the replication of a file that is already pending.
+    file_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | \
+            IN_MODIFY
+    dir_mask = file_mask | IN_CREATE | IN_ONLYDIR
+
+    def __init__(self, storage, threads=4, debounce=1.0):
+        self.storage = storage
+        self.threads = threads
+        self.debounce = debounce
+        self.inotify = None
+        # watches maps watch descriptors to directories relative to the root.
+        # pending maps names of files to replicate to a deadline.
+        self.watches = {}
+        self.pending = {}
+        self.running = False
+
+    def start(self):
+        """Start watching the directory of the storage."""
+        self.inotify = Inotify()
+        self.add_directory('', scan=False)
+
+    def close(self):
+        """Stop watching and forget the changes that weren't replicated."""
+        self.inotify.close()
+        self.inotify = None
+        self.watches = {}
+        self.pending = {}
+
+    def add_directory(self, directory, scan=True):
+        # Directories created after the watcher started may contain files
+        # that were written before they were watched.
+        path = self.storage.path(directory) if directory else \
+                self.storage.location
+        try:
+            wd = self.inotify.add_watch(path, self.dir_mask)
+            entries = os.listdir(path)
+        except OSError as exc:
+            logger.warning("Failed to watch %s: %s.", path, exc)
+            return
+        self.watches[wd] = directory
+        for entry in entries:
+            name = directory + '/' + entry if directory else entry
+            if os.path.isdir(os.path.join(path, entry)):
+                self.add_directory(name, scan)
+            elif scan:
+                self.pending[name] = time.time() + self.debounce
+
+    def handle(self, wd, mask, cookie, entry):
+        """Process an inotify event."""
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("Some changes were lost. Synchronize the media "
+                    "servers with the master copy.")
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        name = directory + '/' + entry if directory else entry
+        if not mask & IN_ISDIR:
+            if mask & IN_MODIFY:
+                if name in self.pending:
+                    self.pending[name] = time.time() + self.debounce
+            elif not mask & IN_CREATE:
+                self.pending[name] = time.time() + self.debounce
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+            self.add_directory(name)
+        elif mask & IN_MOVED_FROM:
+            logger.warning("Directory %s was moved away. Its files weren't "
+                    "deleted from the media servers.", name)
+
+    def process_events(self, timeout=None):
+        """Wait for events and process them.
+
+        Then, replicate the files that haven't changed for long enough.
+        """
+        if self.pending:
+            delay = max(0, min(self.pending.values()) - time.time())
+            timeout = delay if timeout is None else min(timeout, delay)
+        for event in self.inotify.read(timeout):
+            self.handle(*event)
+        self.flush()
+
+    def flush(self, force=False):
+        """Replicate the pending changes.
+
+        Unless force is True, only replicate files that haven't changed for
+        `debounce` seconds.
+        """
+        now = time.time()
+        names = sorted(name for name, deadline in self.pending.items()
+                if force or deadline <= now)
+        for name in names:
+            del self.pending[name]
+        map_in_threads(self.replicate, names, self.threads)
+
+    def replicate(self, name):
+        """Upload or delete a file on the media servers."""
+        if os.path.isfile(self.storage.path(name)):
+            func = self.storage.upload
+        else:
+            func = self.storage.transport.delete
+        try:
+            self.storage.execute(func, name)
+        except Exception:
+            pass    # failures are logged by execute
+
+    def run(self):
+        """Replicate changes until stop() is called or the process is
+        terminated.
+
+        This must be called from the main thread.
+        """
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        self.start()
+        try:
+            while self.running:
+                self.process_events(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.flush(force=True)
+            self.close()
+
+    def stop(self, *args):
+        """Stop the watcher after replicating the pending changes."""
+        self.running = False